@@ -3,120 +3,149 @@
 from libversion import ModuleBase, modules, PythonIdentifier
 import os, re, sys
 import recordset
+from support import PersistentCache
 from arginfo import *
 
 __all__ = ['AutoSubstitution']
 
 # This iterator will find any $(...) macro in line. The number of ( brackets
-# ) and brackets in the expression will match
+# ) and brackets in the expression will match.  Macros nested within a macro
+# are returned before the macro containing them, and a macro which is not
+# closed by the end of the line is ignored together with any macros nested
+# within it.
 def find_macros(line):
-    bracket = 0
-    i = 0
-    macro = ''
-
-    while i < len(line):
-        if bracket > 0:
-            # we're in a macro
-            match = bracket_open.match(line, i)
-            if match:
-                # we've opened another bracket
-                bracket += 1
-            else:
-                # we've closed a bracket
-                match = bracket_close.match(line, i)
-                bracket -= 1
-            if bracket == 0:
-                # we've closed the macro bracket
-                if macro_start.search(macro):
-                    for m in find_macros(macro):
-                        yield m
-                yield macro
-                macro = ''
-                i += 1
-            else:
-                # we've closed a non-macro bracket
-                macro += match.groups()[0]
-                i = match.end()
-        else:
-            # we're not in a macro, find the start of the next one
-            match = macro_start.search(line, i)
-            if match:
-                i = match.end()
-                macro += match.groups()[0]
-                bracket = 1
-            else:
-                i = len(line)
+    # For each open bracket, the start of the macro text if it opens a macro
+    # or None for a plain bracket within a macro.
+    stack = []
+    # Macros closed within the current outermost macro.
+    found = []
+    for match in macro_token_re.finditer(line):
+        token = match.group()
+        if token == ')':
+            if stack:
+                start = stack.pop()
+                if start is not None:
+                    found.append(line[start:match.start()])
+                if not stack:
+                    for macro in found:
+                        yield macro
+                    found = []
+        elif token == '$(':
+            stack.append(match.end())
+        elif stack:
+            # brackets only count inside a macro
+            stack.append(None)
 
-def populate_class(cls, template_file):
-    '''Returns list of keys and dictionary of defaults.'''
+# Scans a template file for the macros it uses, returning its signature: a
+# dictionary of the required, default and optional macro names, the default
+# values, the macro descriptions, the gui tags and the docstring, together
+# with any warnings.  The warnings are (warn_macros, message) pairs, where
+# warn_macros is set for warnings only printed for classes with WarnMacros.
+def scan_template(template_file):
     text = open(template_file).read()
+    warnings = []
+    # The names are kept in order in lists, with sets for fast lookup.
     required_names = []
+    required_set = set()
     default_names = []
-    default_values = []
+    defaults = {}
     optional_names = []
+    optional_set = set()
     Obs = {}
     doc = ''
-    for line in text.splitlines():
-        # find all macro names
-        for mtext in find_macros(line):
-            if '=' in mtext:
-                # this a macro with a default value
-                mtext, default = mtext.split('=', 1)
-                # check it's not a required value
-                if mtext in required_names + optional_names:
-                    print >> sys.stderr, \
-                    '***Warning: Redefining non-default macro "%s" to have '\
-                    'default "%s" in "%s"' % (mtext, default, template_file)
-                    required_names = [x for x in required_names if x != mtext]
-                    optional_names = [x for x in optional_names if x != mtext]                    
-                if mtext in default_names:
-                    # if it's a default value already, check it matches
-                    old_default = default_values[default_names.index(mtext)]
-                    if default != old_default: 
-                        print >> sys.stderr, \
-                        '***Warning: Cannot set macro "%s" to "%s", already '\
-                        'defined with value "%s" in "%s"' % (mtext, default, \
-                            old_default, template_file)
-                else:
-                    # add it as a default value
-                    default_names.append(mtext)
-                    default_values.append(default)
+    # Find # % gui tags and store them in guiTags.
+    gui_tags = []
+    # (name, description) for each #% macro description, and the
+    # description being read.
+    descriptions = []
+    description = None
+    for text_line in text.split('\n'):
+        # Descriptions and gui tags are only found in comments
+        comment = text_line.startswith('#')
+        # a macro description runs on until a 'blank' line
+        if description is not None:
+            if comment and macro_desc_more_re.match(text_line):
+                description[1].append(text_line)
             else:
-                # this is a required or optional macro
-                # strip off any msi ,undefined and ,recursive stuff
-                if mtext.endswith(',undefined'):
-                    mtext = mtext.replace(',undefined', '')
-                elif mtext.endswith(',recursive'):
-                    mtext = mtext.replace(',recursive', '')
-                if mtext in default_names:
-                    print >> sys.stderr, \
-                    '***Warning: Cannot define non-default macro "%s", already '\
-                    'defined as default macro in "%s"' % (mtext, template_file)
-                elif line.startswith('#'):
-                    # comments are optional if they are epics_parser lines
-                    if epics_parser_re.match(line):
-                        if mtext not in optional_names:
-                            optional_names.append(mtext)
-                else:
-                    if mtext not in required_names:
-                        required_names.append(mtext)
+                descriptions.append(description)
+                description = None
+        if comment and description is None:
+            match = macro_desc_start_re.match(text_line)
+            if match:
+                description = (match.group(1), [match.group(2)])
+        if '#' in text_line:
+            match = gui_re.search(text_line)
+            if match:
+                gui_tags.append(match.group(1))
 
-    # Find # % gui tags and store them in cls.guiTags.
-    cls.guiTags = gui_re.findall(text)
+        for line in text_line.splitlines():
+            # find all macro names
+            for mtext in find_macros(line):
+                if '=' in mtext:
+                    # this a macro with a default value
+                    mtext, default = mtext.split('=', 1)
+                    # check it's not a required value
+                    if mtext in required_set or mtext in optional_set:
+                        warnings.append((False,
+                        '***Warning: Redefining non-default macro "%s" to '\
+                        'have default "%s" in "%s"' % (
+                            mtext, default, template_file)))
+                        if mtext in required_set:
+                            required_names.remove(mtext)
+                            required_set.remove(mtext)
+                        if mtext in optional_set:
+                            optional_names.remove(mtext)
+                            optional_set.remove(mtext)
+                    if mtext in defaults:
+                        # if it's a default value already, check it matches
+                        old_default = defaults[mtext]
+                        if default != old_default:
+                            warnings.append((False,
+                            '***Warning: Cannot set macro "%s" to "%s", '\
+                            'already defined with value "%s" in "%s"' % (
+                                mtext, default, old_default, template_file)))
+                    else:
+                        # add it as a default value
+                        default_names.append(mtext)
+                        defaults[mtext] = default
+                else:
+                    # this is a required or optional macro
+                    # strip off any msi ,undefined and ,recursive stuff
+                    if mtext.endswith(',undefined'):
+                        mtext = mtext.replace(',undefined', '')
+                    elif mtext.endswith(',recursive'):
+                        mtext = mtext.replace(',recursive', '')
+                    if mtext in defaults:
+                        warnings.append((False,
+                        '***Warning: Cannot define non-default macro "%s", '\
+                        'already defined as default macro in "%s"' % (
+                            mtext, template_file)))
+                    elif line.startswith('#'):
+                        # comments are optional if they are epics_parser lines
+                        if epics_parser_re.match(line):
+                            if mtext not in optional_set:
+                                optional_names.append(mtext)
+                                optional_set.add(mtext)
+                    else:
+                        if mtext not in required_set:
+                            required_names.append(mtext)
+                            required_set.add(mtext)
+    if description is not None:
+        descriptions.append(description)
 
     # find all the descriptions for ArgInfo objects
     def add_ob(name, ob):
         Obs[name] = ob
-        for l in (required_names, default_names, optional_names):
-            if name in l:
+        for l, names in ((required_names, required_set),
+                         (default_names, defaults),
+                         (optional_names, optional_set)):
+            if name in names:
                 # shift it to the end
-                if l is default_names:
-                    default_values.append(
-                        default_values.pop(default_names.index(name)))
-                l.append(l.pop(l.index(name)))
-
+                l.remove(name)
+                l.append(name)
 
-    for name, desc in macro_desc_re.findall(text):
+    for name, desc in descriptions:
+        desc = '\n'.join(desc)
         desc = desc.strip() # needed in case of CRLF separators in template (e.g. windows based modules)
         search = re.search(r'\n#[ \t]*', desc)
         if search:
@@ -124,21 +153,62 @@ def populate_class(cls, template_file):
         # a __doc__ macro is the docstring for the object
         if name == '__doc__':
             doc = desc
-        elif name in required_names + default_names + optional_names:
-            add_ob(name, Simple(desc))
-        elif cls.WarnMacros:
-            print >> sys.stderr, \
+        elif name in required_set or name in defaults or \
+                name in optional_set:
+            add_ob(name, desc)
+        else:
+            warnings.append((True,
                 '***Warning: Describing non-existent macro "%s" in "%s"' % \
-                    (name, template_file)
+                    (name, template_file)))
     for name in required_names + default_names + optional_names:
         if name not in Obs:
-            if cls.WarnMacros:
-                print >> sys.stderr, \
-                    '***Warning: Undescribed macro "%s" in "%s"' % \
-                    (name, template_file)
-            add_ob(name, Simple('Template argument'))
+            warnings.append((True,
+                '***Warning: Undescribed macro "%s" in "%s"' % \
+                    (name, template_file)))
+            add_ob(name, 'Template argument')
     # make sure optional_names aren't also required names
-    optional_names = [x for x in optional_names if x not in required_names]
+    optional_names = [x for x in optional_names if x not in required_set]
+    default_values = [defaults[x] for x in default_names]
+
+    return dict(
+        required_names = required_names,
+        default_names = default_names,
+        default_values = default_values,
+        optional_names = optional_names,
+        descriptions = Obs,
+        gui_tags = gui_tags,
+        doc = doc,
+        warnings = warnings)
+
+
+# The signatures of templates are cached between runs, keyed by the template
+# file and revalidated against its modification time and size.
+_signature_cache = PersistentCache('templates')
+
+# Changed whenever the scanner changes the signature it returns for a
+# template, so that signatures cached by an older scanner are not used.
+_ScannerVersion = 1
+
+def populate_class(cls, template_file):
+    '''Returns list of keys and dictionary of defaults.'''
+    filename = os.path.abspath(template_file)
+    key = (filename, _ScannerVersion)
+    signature = _signature_cache.Lookup(key)
+    if signature is None:
+        signature = scan_template(template_file)
+        _signature_cache.Store(key, [filename], signature)
+
+    for warn_macros, message in signature['warnings']:
+        if cls.WarnMacros or not warn_macros:
+            print >> sys.stderr, message
+    cls.guiTags = list(signature['gui_tags'])
+    required_names = list(signature['required_names'])
+    default_names = list(signature['default_names'])
+    default_values = list(signature['default_values'])
+    optional_names = list(signature['optional_names'])
+    doc = signature['doc']
+    Obs = dict((name, Simple(desc))
+        for name, desc in signature['descriptions'].items())
 
     # Create all the important attributes we need if they're not already
     # given.
@@ -164,25 +234,72 @@ def populate_class(cls, template_file):
         cls.ArgInfo.optional_names = optional_names
 
 
+# Metaclass for AutoSubstitution.  Classes declared with LazyScan set scan
+# their template when the attributes created by scanning are first looked up.
+# Arguments and __doc__ are inherited or set when the class is created, so
+# these lookups are intercepted before the class dictionary is searched.
+class _AutoSubstitutionMeta(type(recordset.Substitution)):
+    _ScannedAttributes = set(
+        ['ArgInfo', 'Defaults', 'guiTags', 'Arguments', '__doc__'])
+
+    def __getattribute__(cls, name):
+        if name in _AutoSubstitutionMeta._ScannedAttributes:
+            cls_dict = type.__getattribute__(cls, '__dict__')
+            if cls_dict.get('LazyScan') and not cls_dict.get('Scanned'):
+                type.__getattribute__(cls, 'Scan')()
+        return type.__getattribute__(cls, name)
+
+
 ## Subclass of Substitution that scans its template file to find the macros it
 # uses, and creates an ArgInfo object from them.
 class AutoSubstitution(recordset.Substitution):
+    __metaclass__ = _AutoSubstitutionMeta
+
     BaseClass = True
     ## Set this to False to supress warnings on undescribed macros
     WarnMacros = True
     ## This is set to True to disable scanning of the template file in
     # other subclasses of this
     Scanned = False
+    ## If this is set in a class the template file is not scanned until the
+    # class is first used: when it is instantiated or when its \c ArgInfo,
+    # \c Defaults, \c guiTags, \c Arguments or docstring are looked up.
+    LazyScan = False
+    # Scanning the template only caches what is read from the template.
+    _CachedAttributes = (
+        'Scanned', 'ArgInfo', 'Defaults', 'guiTags', 'Arguments', '__doc__')
 
     def __init_meta__(cls, first_call):
         assert not hasattr(cls, "Templatefile"), \
             "Cls %s defines 'Templatefile'. It should be 'TemplateFile'" % \
             cls.__name__
+        if not cls.__dict__.get('LazyScan'):
+            cls.Scan()
+
+    ## Scans the template file, if this has not already been done, to
+    # populate Arguments, Descriptions etc.
+    @classmethod
+    def Scan(cls):
         if cls.TemplateFile is not None and not cls.Scanned:
-            # populate Arguments, Descriptions etc.
-            populate_class(cls, cls.ModuleFile(
-                os.path.join('db', cls.TemplateFile)))
+            # Set first as populate_class looks up the attributes it creates.
             cls.Scanned = True
+            try:
+                populate_class(cls, cls.ModuleFile(
+                    os.path.join('db', cls.TemplateFile)))
+            except:
+                cls.Scanned = False
+                raise
+
+    ## Returns True if this class has an ArgInfo, or will have once its
+    # template has been scanned, without scanning the template.
+    @classmethod
+    def HasArgInfo(cls):
+        return bool(cls.__dict__.get('LazyScan') and not cls.Scanned) or \
+            hasattr(cls, 'ArgInfo')
+
+    def __init__(self, **args):
+        self.Scan()
+        self.__super.__init__(**args)
 
 
     @classmethod
@@ -207,19 +324,14 @@ class AutoSubstitution(recordset.Substitution):
                     ModuleName = moduleVersion.Name()
                     TemplateFile = db
                     TrueName = clsname
+                    LazyScan = True
                 setattr(moduleVersion.module, clsname, temp)
 
 # This re matches an line like #% autosave 1 or # % gda_tag, template, ...
 epics_parser_re = re.compile(r'^#[ \t]*%')
 
-# This re matches the $( msi syntax until the first ) or (
-macro_start = re.compile(r'\$\(([^\(\)]*)')
-
-# This re matches a ( until the next ) or (
-bracket_open = re.compile(r'(\([^\(\)]*)')
-
-# This re matches a ) until the next ) or (
-bracket_close = re.compile(r'(\)[^\(\)]*)')
+# This re matches the start of a $( macro and any other bracket
+macro_token_re = re.compile(r'\$\(|[()]')
 
 # This re matches and gui tags
 gui_re = re.compile(r'#[ \t]*%[ \t]*gui[ \t]*,[ \t]*(.*)')
@@ -235,5 +347,11 @@ macro_desc_re = re.compile(
     r'([^, \t]+)[ \t]*,[ \t]*' # Captures the macro name and discards comma
     r'([^\n]+' # This start the description capture and the first line
     r'(?:\n#[ \t]*[^\n \t%#][^\n]*)*)', # subsequent non-'blank' line
-    re.MULTILINE)  
+    re.MULTILINE)
+
+# These match the first line of a macro description, as above, and each
+# subsequent line, for scanning a template a line at a time.
+macro_desc_start_re = re.compile(
+    r'#[ \t]*%[ \t]*macro[ \t]*,[ \t]*([^, \t]+)[ \t]*,[ \t]*([^\n]+)')
+macro_desc_more_re = re.compile(r'#[ \t]*[^\n \t%#]')
 
@@ -6,6 +6,8 @@ from dbd import records
 
 def Extend_mbbiDirect(mbbiDirect):
     class mbbiDirect(mbbiDirect):
+        __slots__ = []
+
         def bit(self, offset):
             return _Bits(self, BIT_INPUT, records.bi, offset, 1)
 
@@ -17,6 +19,8 @@ def Extend_mbbiDirect(mbbiDirect):
 
 def Extend_mbboDirect(mbboDirect):
     class mbboDirect(mbboDirect):
+        __slots__ = []
+
         def bit(self, offset):
             return _Bits(self, BIT_OUTPUT, records.bo, offset, 1)
 
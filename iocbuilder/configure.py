@@ -4,12 +4,15 @@ import os, sys
 
 from support import Singleton
 import recordnames
+import manifest
+import timings
 
 
 __all__ = [
     'Configure', 'LoadVersionFile', 'ConfigureIOC', 'ConfigureTemplate',
     'Architecture', 'TargetOS', 'Call_TargetOS',
-    'ParseEtcArgs', 'ParseAndConfigure']
+    'ParseEtcArgs', 'ParseAndConfigure', 'ParseRelease', 'ReleaseModules',
+    'LoadReleaseModules', 'ResetIoc']
 
 
 def Architecture():
@@ -95,6 +98,25 @@ class Configure(Singleton):
     # \param epics_base
     #   Can be used to override the default selection of \c EPICS_BASE taken
     #   from the environment.
+    # \param python_dbd
+    #   If set the dbd files are read and record fields validated in Python
+    #   rather than through \c libdbStaticHost, which then need not be
+    #   built for the host architecture.
+    # \param cache_path
+    #   Directory used to cache parsed dbd files between runs, overrides
+    #   \c IOCBUILDER_CACHE in the environment.  Parsed dbd files are only
+    #   cached when \c python_dbd is set.
+    # \param internal_msi
+    #   If set templates are expanded by the builder's own implementation in
+    #   \ref iocbuilder.msi "msi" rather than by running msi.
+    # \param lazy_load
+    #   If set the definitions of each support module declared after this
+    #   call are only loaded when the module is first used, see
+    #   \ref libversion.LazyLoading "LazyLoading".
+    # \param profile
+    #   If set the time taken by each phase of the build is reported at exit,
+    #   see \ref iocbuilder.timings "timings".  If this is a file name a
+    #   JSON trace of the phases is also written to this file.
     def __call__(self,
             module_path  = None,    # Configures where ModuleVersion looks
             record_names = None,    # Configure how records are named
@@ -104,6 +126,11 @@ class Configure(Singleton):
             register_dbd = False,   # Call register function in st.cmd?
             simulation = False,     # Enable simulation mode
             epics_base = None,      # Path to EPICS base, overrides env
+            python_dbd = False,     # Read dbd files without libdbStatic
+            cache_path = None,      # Cache for parsed files, overrides env
+            internal_msi = False,   # Expand templates without msi
+            lazy_load = False,      # Load module definitions when used
+            profile = False,        # Report time taken by each phase
         ):
 
         assert not self.__called, 'Cannot call Configure more than once!'
@@ -114,8 +141,16 @@ class Configure(Singleton):
         import iocinit
         import recordnames
         import iocwriter
+        import dbd
+        import msi
 
+        if profile:
+            timings.Enable(isinstance(profile, str) and profile or None)
         libversion.simulation_mode = simulation
+        dbd.PythonDbd = python_dbd
+        msi.ExternalMsi = not internal_msi
+        if cache_path is not None:
+            paths.cache_path = cache_path
 
         if epics_base:
             # If epics_base is explicitly specified, override it now
@@ -140,6 +175,8 @@ class Configure(Singleton):
         # module is complete, in particular this can't be called from within
         # __init__.py.  So now instead.
         iocinit.iocInit.Initialise()
+        # EPICS_BASE is declared by iocinit, so is always loaded.
+        libversion.LazyLoading = lazy_load
 
         # Configure core ioc parameters.
         self.dynamic_load = dynamic_load
@@ -281,6 +318,15 @@ be run from the etc/makeIocs directory, and will create iocs/<ioc_name>''')
         help='Create an ioc with arch=SIMARCH in simulation mode')
     parser.add_option('--arch', dest='architecture', default = architecture,
         help='Specify target system architecture')
+    parser.add_option('--python-dbd', action='store_true', dest='python_dbd',
+        help='Read dbd files in Python instead of using libdbStaticHost')
+    parser.add_option('--internal-msi', action='store_true',
+        dest='internal_msi', help='Expand templates without running msi')
+    parser.add_option('--lazy-load', action='store_true', dest='lazy_load',
+        help='Only load the definitions of modules that are used')
+    parser.add_option('--profile', dest='profile', metavar='TRACE',
+        help='Report the time taken by each phase of the build and write '
+            'a JSON trace to TRACE')
     (options, args) = parser.parse_args()
     if len(args) < 1:
         parser.error(
@@ -330,42 +376,15 @@ be run from the etc/makeIocs directory, and will create iocs/<ioc_name>''')
 #    created from <tt>\<iocname>_RELEASE</tt> and
 #    <tt>../../configure/RELEASE</tt>
 def ParseAndConfigure(options, dependency_tree=None):
-    # import iocwriter and set default iocwriter
-    if options.ioc_writer is None:
-        import iocwriter
-        options.ioc_writer = iocwriter.DiamondIocWriter
-
+    # start timing now to include the RELEASE parsing
+    profile = getattr(options, 'profile', None)
+    if profile:
+        timings.Enable(profile)
     # if we have a dependency_tree class, then parse RELEASE file
     if dependency_tree is not None:
-        # If we have a release file, then parse it
-        release = os.path.join(options.build_root,
-            '..', '..', 'configure', 'RELEASE')
-        release_tree = dependency_tree(None, release, warnings=False)
-        # If we have an extra tree then use that as the tree instead
-        extra_release = os.path.join(options.build_root,
-            options.iocname + '_RELEASE')
-        if os.path.isfile(extra_release):
-            tree = dependency_tree(None, extra_release, warnings=False)
-            tree.leaves.append(release_tree)
-        else:
-            tree = release_tree
-        # If we have a RELEASE.blah.Common then include the text from that in
-        # the built IOC
-        relCommon = os.path.join(options.build_root,
-            '..', '..', 'configure', 'RELEASE.%s' % options.architecture)
-        if os.path.isfile(relCommon):
-            options.ioc_writer.WINDOWS_RELEASE_COMMON = open(relCommon).read()
-        elif os.path.isfile(relCommon + ".Common"):
-            options.ioc_writer.WINDOWS_RELEASE_COMMON = \
-                open(relCommon + ".Common").read()
-        if options.debug:
-            print '# Release tree'
-            tree.print_tree()
-        if 'EPICS_BASE' in tree.macros:
-            options.epics_base = tree.macros['EPICS_BASE']
-        if hasattr(options.ioc_writer, "macros"):
-            filt_macros = {k: v for k,v in tree.macros.items() if "#" not in k}
-            options.ioc_writer.macros.update(filt_macros)
+        tree = ParseRelease(options, dependency_tree)
+    else:
+        _DefaultIocWriter(options)
 
     # do the relevant configure call
     Configure(
@@ -375,7 +394,11 @@ def ParseAndConfigure(options, dependency_tree=None):
         architecture = options.architecture,
         register_dbd = True,
         simulation   = options.simarch,
-        epics_base   = options.epics_base)
+        epics_base   = options.epics_base,
+        python_dbd   = getattr(options, 'python_dbd', False),
+        internal_msi = getattr(options, 'internal_msi', False),
+        lazy_load    = getattr(options, 'lazy_load', False),
+        profile      = profile)
 
     # set debugging
     import libversion
@@ -385,44 +408,160 @@ def ParseAndConfigure(options, dependency_tree=None):
     # do the ModuleVersion calls on a dependency tree
     vs = []
     if dependency_tree is not None:
-        # now flatten the leaves of the tree, and remove duplicates
-        leaves = []
-        for leaf in tree.flatten(include_self=True):
-            duplicates = [l for l in leaves if l.name == leaf.name]
-            # invalid modules don't have a configure/RELEASE, so won't have a
-            # builder object
-            if leaf.version == 'invalid' and \
-                    not os.path.isfile(os.path.join(
-                        leaf.path, "configure", "RELEASE")):
-                pass
-            elif duplicates:
-                print '***Warning: Module "%s" defined with' % leaf.name, \
-                    'multiple versions, using "%s"' % duplicates[0].version
-                if max(["R3.14.11" in x.path for x in duplicates+[leaf]]) and \
-                    max(["R3.14.12.3" in x.path for x in duplicates+[leaf]]):
-                    print 'Multiple epics versions detected. Have you set your EPICS_HOST_ARCH correctly?'
-            else:
-                leaves.append(leaf)
-        from libversion import ModuleVersion
-        for name, version, path in [
-                (l.name, l.version, l.path) for l in leaves if l.path]:
-            # if we don't have a name, it can't be a useful module
-            if name is None:
-                continue
-            # for work and local modules, just tell iocbuilder the path
-            if version in ['work', 'local', 'invalid']:
-                home = os.path.abspath(path)
-                use_name = False
-                version = None
-            # prod modules need more hacking of the path to look right
-            else:
-                home = os.path.abspath(os.path.join(path, '..', '..'))
-                use_name = True
-            # iocs need to be treated more like support modules
-            if '/' in name:
-                name = name.split('/')[-1]
-            # add the ModuleVersion object to the list
-            vs.append(ModuleVersion(name, version, use_name=use_name,
-                    home=home))
-
+        vs = LoadReleaseModules(ReleaseModules(tree))
     return vs
+
+
+# import iocwriter and set default iocwriter
+def _DefaultIocWriter(options):
+    if options.ioc_writer is None:
+        import iocwriter
+        options.ioc_writer = iocwriter.DiamondIocWriter
+
+
+## Parses the RELEASE files for the IOC described by \c options as
+# described for ParseAndConfigure(), returning the release tree.  This also
+# sets \c options.epics_base and the RELEASE settings of the IOC writer.
+def ParseRelease(options, dependency_tree):
+    timings.Begin('release', options.iocname)
+    try:
+        return _ParseRelease(options, dependency_tree)
+    finally:
+        timings.End()
+
+def _ParseRelease(options, dependency_tree):
+    _DefaultIocWriter(options)
+
+    # If we have a release file, then parse it
+    release = os.path.join(options.build_root,
+        '..', '..', 'configure', 'RELEASE')
+    release_tree = dependency_tree(None, release, warnings=False)
+    manifest.AddInput(release)
+    # If we have an extra tree then use that as the tree instead
+    extra_release = os.path.join(options.build_root,
+        options.iocname + '_RELEASE')
+    # The files looked for are recorded whether or not they exist, so that
+    # creating one of them later makes the IOC out of date.
+    manifest.AddInput(extra_release)
+    if os.path.isfile(extra_release):
+        tree = dependency_tree(None, extra_release, warnings=False)
+        tree.leaves.append(release_tree)
+    else:
+        tree = release_tree
+    # If we have a RELEASE.blah.Common then include the text from that in
+    # the built IOC
+    relCommon = os.path.join(options.build_root,
+        '..', '..', 'configure', 'RELEASE.%s' % options.architecture)
+    _SaveWriterDefaults(options.ioc_writer)
+    manifest.AddInput(relCommon)
+    if os.path.isfile(relCommon):
+        options.ioc_writer.WINDOWS_RELEASE_COMMON = open(relCommon).read()
+    else:
+        manifest.AddInput(relCommon + ".Common")
+        if os.path.isfile(relCommon + ".Common"):
+            options.ioc_writer.WINDOWS_RELEASE_COMMON = \
+                open(relCommon + ".Common").read()
+    if options.debug:
+        print '# Release tree'
+        tree.print_tree()
+    if 'EPICS_BASE' in tree.macros:
+        options.epics_base = tree.macros['EPICS_BASE']
+    if hasattr(options.ioc_writer, "macros"):
+        filt_macros = {k: v for k,v in tree.macros.items() if "#" not in k}
+        options.ioc_writer.macros.update(filt_macros)
+    return tree
+
+
+# The RELEASE settings of each IOC writer class before ParseRelease() first
+# changed them, so that ResetIoc() can put them back.  Indexed by writer
+# class, each entry is the macros dictionary and WINDOWS_RELEASE_COMMON.
+_writer_defaults = {}
+
+def _SaveWriterDefaults(writer):
+    if writer not in _writer_defaults:
+        _writer_defaults[writer] = (
+            dict(getattr(writer, 'macros', {})),
+            writer.__dict__.get('WINDOWS_RELEASE_COMMON'))
+
+def _RestoreWriterDefaults():
+    for writer, (macros, release_common) in _writer_defaults.items():
+        if hasattr(writer, 'macros'):
+            writer.macros.clear()
+            writer.macros.update(macros)
+        if release_common is not None:
+            writer.WINDOWS_RELEASE_COMMON = release_common
+        elif 'WINDOWS_RELEASE_COMMON' in writer.__dict__:
+            del writer.WINDOWS_RELEASE_COMMON
+
+
+## Returns the modules listed in a release tree returned by ParseRelease()
+# as a list of (name, version, home, use_name) tuples ready to be passed to
+# libversion::ModuleVersion.
+def ReleaseModules(tree):
+    # now flatten the leaves of the tree, and remove duplicates
+    leaves = []
+    for leaf in tree.flatten(include_self=True):
+        duplicates = [l for l in leaves if l.name == leaf.name]
+        # invalid modules don't have a configure/RELEASE, so won't have a
+        # builder object
+        if leaf.version == 'invalid' and \
+                not os.path.isfile(os.path.join(
+                    leaf.path, "configure", "RELEASE")):
+            pass
+        elif duplicates:
+            print '***Warning: Module "%s" defined with' % leaf.name, \
+                'multiple versions, using "%s"' % duplicates[0].version
+            if max(["R3.14.11" in x.path for x in duplicates+[leaf]]) and \
+                max(["R3.14.12.3" in x.path for x in duplicates+[leaf]]):
+                print 'Multiple epics versions detected. Have you set your EPICS_HOST_ARCH correctly?'
+        else:
+            leaves.append(leaf)
+    modules = []
+    for name, version, path in [
+            (l.name, l.version, l.path) for l in leaves if l.path]:
+        # if we don't have a name, it can't be a useful module
+        if name is None:
+            continue
+        # for work and local modules, just tell iocbuilder the path
+        if version in ['work', 'local', 'invalid']:
+            home = os.path.abspath(path)
+            use_name = False
+            version = None
+        # prod modules need more hacking of the path to look right
+        else:
+            home = os.path.abspath(os.path.join(path, '..', '..'))
+            use_name = True
+        # iocs need to be treated more like support modules
+        if '/' in name:
+            name = name.split('/')[-1]
+        modules.append((name, version, home, use_name))
+    return modules
+
+
+## Does a libversion::ModuleVersion call for each module in a list returned
+# by ReleaseModules(), returning the list of ModuleVersion objects.
+def LoadReleaseModules(modules):
+    from libversion import ModuleVersion
+    return [ModuleVersion(name, version, use_name=use_name, home=home)
+        for name, version, home, use_name in modules]
+
+
+## Discards the state of the IOC being built: records, hardware, data files,
+# all ModuleBase instances and the RELEASE settings of the IOC writer.  The
+# loaded modules and dbd definitions are kept so that another IOC using the
+# same modules can be built without the cost of loading them again.
+#
+# Returns False if the state left by the IOC in the loaded modules could not
+# be reset, in which case the builder must be imported and configured again
+# before building another IOC.
+def ResetIoc():
+    import recordset, libversion, iocinit
+    from liblist import Hardware
+    recordset.Reset()
+    Hardware.Reset()
+    reset = libversion.ModuleBase.ResetInstances()
+    iocinit.IocDataSet.Reset()
+    iocinit.iocInit.Reset()
+    manifest.Reset()
+    _RestoreWriterDefaults()
+    return reset
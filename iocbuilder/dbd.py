@@ -1,12 +1,16 @@
 '''Implements the set of records provided by a dbd'''
 
 import os, os.path
+import re
 import ctypes
+import collections
+import threading
 
 import mydbstatic   # Pick up interface to EPICS dbd files
 import paths
 import arginfo
-from support import Singleton, OrderedDict
+import timings
+from support import Singleton, OrderedDict, PersistentCache
 
 from recordbase import Record
 
@@ -37,6 +41,13 @@ class RecordTypes(Singleton):
     def __contains__(self, recordType):
         return recordType in self.__RecordTypes
 
+    ## Returns a dictionary mapping each record type to the (hits, misses)
+    # counts of its field value verification cache.
+    def VerifyCacheStatistics(self):
+        return dict(
+            (recordType, getattr(self, recordType)._validate.CacheStatistics())
+            for recordType in self.__RecordTypes)
+
 
 ## Every record type loaded from a DBD is present as an attribute of this
 ## class with the name of the record type.
@@ -61,89 +72,593 @@ DCT_OUTLINK = 6
 DCT_FWDLINK = 7
 DCT_NOACCESS = 8
 
+
+# Converts a field description into the associated arginfo definition, or
+# None for a field with no access.
+def _FieldArgInfo(desc, typ, choices):
+    if typ in [DCT_STRING, DCT_INLINK, DCT_OUTLINK, DCT_FWDLINK]:
+        return arginfo.Simple(desc, str)
+    elif typ in [DCT_INTEGER]:
+        return arginfo.Simple(desc, int)
+    elif typ in [DCT_REAL]:
+        return arginfo.Simple(desc, float)
+    elif typ in [DCT_MENU, DCT_MENUFORM]:
+        if choices:
+            return arginfo.Choice(desc, choices)
+        else:
+            return arginfo.Simple(desc, str)
+    else:
+        # No access field.
+        return None
+
+
+# Incremented every time a dbd file is loaded.  A later dbd file can add
+# menu and device choices, so cached verification results from an earlier
+# generation are discarded.
+_generation = 0
+
+# Common interface to field validation.  The subclasses below provide the
+# dbd specific parts: _ProcessDbd() must fill in _FieldInfo and
+# _ValidNamesSet, and _Verify() returns None if the given value can be
+# written to the given field, otherwise an error message.
+#   The same values are written to the same fields over and over again, so
+# the results of _Verify() are remembered in a small LRU cache.
+class _FieldValidator:
+    ## Maximum number of verification results remembered per record type.
+    VerifyCacheSize = 1024
+
+    def __init__(self):
+        self._FieldInfo = None
+        self._ValidNamesSet = None
+        self.__cache = collections.OrderedDict()
+        self.__generation = _generation
+        self.__hits = 0
+        self.__misses = 0
+
+    ## Returns the number of hits and misses in the verification cache.
+    def CacheStatistics(self):
+        return self.__hits, self.__misses
+
+    # Returns the result of _Verify(name, value), using the cache if
+    # possible.
+    def __CachedVerify(self, name, value):
+        if self.__generation != _generation:
+            self.__cache.clear()
+            self.__generation = _generation
+        key = (name, value)
+        try:
+            message = self.__cache.pop(key)
+        except KeyError:
+            self.__misses += 1
+            message = self._Verify(name, value)
+            if len(self.__cache) >= self.VerifyCacheSize:
+                self.__cache.popitem(last = False)
+        else:
+            self.__hits += 1
+        # Reinserting the entry makes it the most recently used.
+        self.__cache[key] = message
+        return message
+
+    def FieldInfo(self):
+        if self._FieldInfo is None:
+            self._ProcessDbd()
+        return self._FieldInfo
+
+    def ValidNamesSet(self):
+        if self._ValidNamesSet is None:
+            self._ProcessDbd()
+        return self._ValidNamesSet
+
+    # This method raises an attribute error if the given field name is
+    # invalid.
+    def ValidFieldName(self, name):
+        if name not in self.ValidNamesSet():
+            raise AttributeError, 'Invalid field name %s' % name
+
+    # This method raises an exeption if the given field name does not exist
+    # or if the value cannot be validly written.
+    def ValidFieldValue(self, name, value):
+        # First check the field name is valid.
+        self.ValidFieldName(name)
+        value = str(value)
+
+        # Now see if we can write the value to it.
+        message = self.__CachedVerify(name, value)
+        assert message == None, \
+            'Can\'t write "%s" to field %s: %s' % (value, name, message)
+
+    # Checks a list of values for a single field, returning a list of
+    # (value, message) pairs for the values which cannot be written.
+    def VerifyValues(self, name, values):
+        self.ValidFieldName(name)
+        errors = []
+        for value in values:
+            message = self.__CachedVerify(name, value)
+            if message is not None:
+                errors.append((value, message))
+        return errors
+
+
 # This class uses a the static database to validate whether the associated
 # record type allows a given value to be written to a given field.
-class ValidateDbField:
+class ValidateDbField(_FieldValidator):
     def __init__(self, dbEntry):
+        _FieldValidator.__init__(self)
         self.dbEntry = mydbstatic.dbCopyEntry(dbEntry)
-        self._FieldInfo = None
-        self._ValidNamesSet = None
+        self._FieldEntries = None
 
     # Computes list of valid names and creates associated arginfo
     # definitions.  This is postponed quite late to try and ensure the menus
     # are fully populated, in other words we don't want to fire this until
     # all the dbd files have been loaded.
-    def __ProcessDbd(self):
+    #   As we walk the fields we also take a copy of the database entry
+    # positioned on each field so that validation can go straight to the
+    # field without rescanning the field list.
+    def _ProcessDbd(self):
         # ordered dict of field_name -> arginfo
         self._FieldInfo = OrderedDict()
+        self._FieldEntries = {}
         valid_names = []
         status = mydbstatic.dbFirstField(self.dbEntry, 0)
         while status == 0:
             name = mydbstatic.dbGetFieldName(self.dbEntry)
             desc = mydbstatic.dbGetPrompt(self.dbEntry)
             typ = mydbstatic.dbGetFieldType(self.dbEntry)
-            group = mydbstatic.dbGetPromptGroup(self.dbEntry)
-            if typ in [DCT_STRING, DCT_INLINK, DCT_OUTLINK, DCT_FWDLINK]:
-                ArgInfo = arginfo.Simple(desc, str)
-            elif typ in [DCT_INTEGER]:
-                ArgInfo = arginfo.Simple(desc, int)
-            elif typ in [DCT_REAL]:
-                ArgInfo = arginfo.Simple(desc, float)
-            elif typ in [DCT_MENU, DCT_MENUFORM]:
+            choices = []
+            if typ in [DCT_MENU, DCT_MENUFORM]:
                 n_choices = mydbstatic.dbGetNMenuChoices(self.dbEntry)
                 if n_choices > 0:
                     menu_void = mydbstatic.dbGetMenuChoices(self.dbEntry)
                     menu_p = ctypes.cast(menu_void,
                         ctypes.POINTER(ctypes.c_char_p * n_choices))
-                    ArgInfo = arginfo.Choice(desc, list(menu_p[0]))
-                else:
-                    ArgInfo = arginfo.Simple(desc, str)
-            else:
-                # No access field.
-                ArgInfo = None
+                    choices = list(menu_p[0])
+            ArgInfo = _FieldArgInfo(desc, typ, choices)
             if name != "NAME":
                 valid_names.append(name)
+                self._FieldEntries[name] = \
+                    mydbstatic.dbCopyEntry(self.dbEntry)
                 if ArgInfo is not None:
                     self._FieldInfo[name] = ArgInfo
             status = mydbstatic.dbNextField(self.dbEntry, 0)
 
         self._ValidNamesSet = set(valid_names)
 
-    def FieldInfo(self):
-        if self._FieldInfo is None:
-            self.__ProcessDbd()
-        return self._FieldInfo
+    # Uses the entry already positioned on the field to verify the value.
+    def _Verify(self, name, value):
+        return mydbstatic.dbVerify(self._FieldEntries[name], value)
 
-    def ValidNamesSet(self):
-        if self._ValidNamesSet is None:
-            self.__ProcessDbd()
-        return self._ValidNamesSet
 
-    # This method raises an attribute error if the given field name is
-    # invalid.  As an important side effect it also sets the database
-    # cursor to the appropriate database descriptor.
-    def ValidFieldName(self, name):
-        if name not in self.ValidNamesSet():
-            raise AttributeError, 'Invalid field name %s' % name
 
-    # This method raises an exeption if the given field name does not exist
-    # or if the value cannot be validly written.
-    def ValidFieldValue(self, name, value):
-        # First check the field name is valid and set the cursor in focus.
-        self.ValidFieldName(name)
-        value = str(value)
+# ----------------------------------------------------------------------------
+#  Python dbd reader
+#
+# As an alternative to libdbStaticHost the dbd files can be read and the
+# field values checked entirely in Python.  This is selected by passing
+# python_dbd=True to Configure.  The rules below follow dbVerify(), except
+# that the expressions written to CALC fields are not checked.
 
-        # Set the database cursor to the field
-        status = mydbstatic.dbFirstField(self.dbEntry, 0)
-        while status == 0:
-            if mydbstatic.dbGetFieldName(self.dbEntry) == name:
-                break
-            status = mydbstatic.dbNextField(self.dbEntry, 0)
+# Field types understood by the Python reader, mapped onto the values
+# returned by dbGetFieldType.
+_DbfTypes = {
+    'DBF_STRING':   DCT_STRING,
+    'DBF_CHAR':     DCT_INTEGER,
+    'DBF_UCHAR':    DCT_INTEGER,
+    'DBF_SHORT':    DCT_INTEGER,
+    'DBF_USHORT':   DCT_INTEGER,
+    'DBF_LONG':     DCT_INTEGER,
+    'DBF_ULONG':    DCT_INTEGER,
+    'DBF_INT64':    DCT_INTEGER,
+    'DBF_UINT64':   DCT_INTEGER,
+    'DBF_ENUM':     DCT_INTEGER,
+    'DBF_FLOAT':    DCT_REAL,
+    'DBF_DOUBLE':   DCT_REAL,
+    'DBF_MENU':     DCT_MENU,
+    'DBF_DEVICE':   DCT_MENUFORM,
+    'DBF_INLINK':   DCT_INLINK,
+    'DBF_OUTLINK':  DCT_OUTLINK,
+    'DBF_FWDLINK':  DCT_FWDLINK,
+    'DBF_NOACCESS': DCT_NOACCESS,
+}
 
-        # Now see if we can write the value to it
-        message = mydbstatic.dbVerify(self.dbEntry, value)
-        assert message == None, \
-            'Can\'t write "%s" to field %s: %s' % (value, name, message)
+# Integer ranges checked by dbVerify, signed types are parsed with strtol,
+# unsigned with strtoul.  A range of None means no range is checked.
+_SignedRanges = {
+    'DBF_CHAR':     (-128, 127),
+    'DBF_SHORT':    (-32768, 32767),
+    'DBF_LONG':     None,
+    'DBF_INT64':    None,
+}
+_UnsignedRanges = {
+    'DBF_UCHAR':    255,
+    'DBF_USHORT':   65535,
+    'DBF_ENUM':     65535,
+    'DBF_ULONG':    None,
+    'DBF_UINT64':   None,
+}
+
+# Integers as accepted by strtol(s, &end, 0) with nothing left over.
+_strtol_re = re.compile(
+    r'[ \t\n\v\f\r]*([+-]?)(0[xX][0-9a-fA-F]+|0[0-7]*|[1-9][0-9]*)\Z')
+# Floating point numbers as accepted by strtod with nothing left over.
+_strtod_re = re.compile(
+    r'[ \t\n\v\f\r]*[+-]?('
+        r'([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?|'
+        r'0[xX]([0-9a-fA-F]+\.?[0-9a-fA-F]*|\.[0-9a-fA-F]+)'
+            r'([pP][+-]?[0-9]+)?|'
+        r'inf(inity)?|nan(\([0-9a-zA-Z_]*\))?)\Z', re.IGNORECASE)
+
+# Lexical structure of a dbd file.  Lines starting with % are C declarations
+# and are ignored, as are comments.
+_dbd_token_re = re.compile(r'''
+    (?P<space>[ \t\r\n]+|\#[^\n]*|^%[^\n]*) |
+    (?P<string>"(?:\\.|[^"\\\n])*") |
+    (?P<word>[a-zA-Z0-9_\-+:.\[\]<>;]+) |
+    (?P<punct>[(){},])''', re.VERBOSE | re.MULTILINE)
+
+
+# The definitions read from a dbd file and all of its includes are gathered
+# into these tables.  Each record type is an ordered dict mapping field names
+# to field definitions, and menus and device choices are lists of choice
+# strings.
+class DbdDefinitions:
+    def __init__(self):
+        self.menus = OrderedDict()
+        self.recordtypes = OrderedDict()
+        self.devices = OrderedDict()
+
+    # Adds the given definitions to this set.  As with dbReadDatabase, the
+    # first definition of a menu or record type wins.
+    def Merge(self, other):
+        for name, choices in other.menus.items():
+            self.menus.setdefault(name, choices)
+        for name, fields in other.recordtypes.items():
+            self.recordtypes.setdefault(name, fields)
+        for name, choices in other.devices.items():
+            devices = self.devices.setdefault(name, [])
+            for choice in choices:
+                if choice not in devices:
+                    devices.append(choice)
+
+    # Definitions are saved in the dbd cache as plain lists and tuples.
+    def __getstate__(self):
+        return (
+            self.menus.items(),
+            [(name, [(field_name, field.dbf, field.prompt, field.size,
+                      field.menu) for field_name, field in fields.items()])
+                for name, fields in self.recordtypes.items()],
+            self.devices.items())
+
+    def __setstate__(self, state):
+        menus, recordtypes, devices = state
+        self.__init__()
+        for name, choices in menus:
+            self.menus[name] = choices
+        for name, fields in recordtypes:
+            table = OrderedDict()
+            for field_name, dbf, prompt, size, menu in fields:
+                field = _DbdField(dbf)
+                field.prompt = prompt
+                field.size = size
+                field.menu = menu
+                table[field_name] = field
+            self.recordtypes[name] = table
+        for name, choices in devices:
+            self.devices[name] = choices
+
+
+# A single field definition: the dbf type, prompt, size (for strings) and
+# menu name (for menu fields).
+class _DbdField:
+    __slots__ = ['dbf', 'prompt', 'size', 'menu']
+
+    def __init__(self, dbf):
+        self.dbf = dbf
+        self.prompt = ''
+        self.size = 0
+        self.menu = None
+
+
+# Finds a dbd file in the same way as dbReadDatabase run from directory: a
+# name containing / is relative to directory, and any other name is searched
+# for on the path.
+def _FindDbdFile(filename, path, directory):
+    if '/' not in filename:
+        for search in path:
+            full_name = os.path.join(search, filename)
+            if os.access(full_name, os.R_OK):
+                return full_name
+    return os.path.join(directory, filename)
+
+# Returns the directories of a path or addpath statement read from a dbd
+# file, with relative directories taken relative to directory.
+def _DbdPathValue(value, directory):
+    return [os.path.join(directory, search) for search in value.split(':')]
+
+
+# Reads a dbd file into a DbdDefinitions table, returning the table and the
+# list of files read (the given file and all of its includes).
+class _DbdReader:
+    def __init__(self, filename, path, directory):
+        self.path = list(path)
+        self.directory = directory
+        self.files = []
+        self.definitions = DbdDefinitions()
+        self.tokens = self.__Tokens(filename)
+        self.token = None
+        self.__Next()
+        while self.token:
+            self.__Statement()
+
+    # Generates (kind, value, filename) for each token, expanding include
+    # and path statements inline.
+    def __Tokens(self, filename):
+        filename = _FindDbdFile(filename, self.path, self.directory)
+        self.files.append(filename)
+        text = open(filename).read()
+        pending = None
+        position = 0
+        while position < len(text):
+            match = _dbd_token_re.match(text, position)
+            assert match, '%s: syntax error at line %d' % (
+                filename, text.count('\n', 0, position) + 1)
+            position = match.end()
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == 'space':
+                continue
+            elif kind == 'string':
+                value = value[1:-1]
+            if pending is not None:
+                assert kind == 'string', \
+                    '%s: expected string after %s' % (filename, pending)
+                if pending == 'include':
+                    for token in self.__Tokens(value):
+                        yield token
+                elif pending == 'path':
+                    self.path = _DbdPathValue(value, self.directory)
+                else:
+                    self.path.extend(_DbdPathValue(value, self.directory))
+                pending = None
+            elif kind == 'word' and value in ['include', 'path', 'addpath']:
+                pending = value
+            else:
+                yield kind, value, filename
+        assert pending is None, '%s: unexpected end of file' % filename
+
+    def __Next(self):
+        try:
+            self.token = self.tokens.next()
+        except StopIteration:
+            self.token = None
+
+    def __Expect(self, value):
+        assert self.token and self.token[1] == value, \
+            '%s: expected "%s"' % (self.token and self.token[2], value)
+        self.__Next()
+
+    # Parses a statement of the form
+    #   keyword [ ( arg, ... ) ] [ { statement ... } ]
+    # returning the keyword, argument list and list of body statements.
+    # Only top level statements define menus, record types and devices: a
+    # menu statement within a field names the menu of the field.
+    def __Statement(self, top = True):
+        assert self.token[0] in ['word', 'string'], \
+            '%s: unexpected "%s"' % (self.token[2], self.token[1])
+        keyword = self.token[1]
+        self.__Next()
+        args = []
+        if self.token and self.token[1] == '(':
+            self.__Next()
+            while self.token and self.token[1] != ')':
+                if self.token[1] != ',':
+                    args.append(self.token[1])
+                self.__Next()
+            self.__Expect(')')
+        body = []
+        if self.token and self.token[1] == '{':
+            self.__Next()
+            while self.token and self.token[1] != '}':
+                body.append(self.__Statement(False))
+            self.__Expect('}')
+
+        definitions = self.definitions
+        if not top:
+            pass
+        elif keyword == 'menu':
+            definitions.menus.setdefault(args[0],
+                [choice[1][1] for choice in body if choice[0] == 'choice'])
+        elif keyword == 'recordtype':
+            fields = OrderedDict()
+            for field_keyword, field_args, field_body in body:
+                if field_keyword == 'field':
+                    fields[field_args[0]] = self.__Field(field_args, field_body)
+            definitions.recordtypes.setdefault(args[0], fields)
+        elif keyword == 'device':
+            devices = definitions.devices.setdefault(args[0], [])
+            if args[3] not in devices:
+                devices.append(args[3])
+        return keyword, args, body
+
+    def __Field(self, args, body):
+        assert args[1] in _DbfTypes, 'Unknown field type %s' % args[1]
+        field = _DbdField(args[1])
+        for keyword, field_args, _ in body:
+            if keyword == 'prompt':
+                field.prompt = field_args[0]
+            elif keyword == 'size':
+                field.size = int(field_args[0])
+            elif keyword == 'menu':
+                field.menu = field_args[0]
+        return field
+
+
+# Adds the given dbd file and every file it includes to files, following
+# include, path and addpath statements as the reader does but without
+# parsing the definitions.
+def _ScanDbdFiles(filename, path, directory, files):
+    filename = _FindDbdFile(filename, path, directory)
+    files.append(filename)
+    try:
+        text = open(filename).read()
+    except IOError:
+        return
+    pending = None
+    for match in _dbd_token_re.finditer(text):
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'space':
+            continue
+        elif pending is not None:
+            if kind == 'string':
+                value = value[1:-1]
+                if pending == 'include':
+                    _ScanDbdFiles(value, path, directory, files)
+                elif pending == 'path':
+                    path[:] = _DbdPathValue(value, directory)
+                else:
+                    path.extend(_DbdPathValue(value, directory))
+            pending = None
+        elif kind == 'word' and value in ['include', 'path', 'addpath']:
+            pending = value
+
+## Returns every dbd file read by LoadDbdFile(): the files loaded together
+# with all of the files they include.
+def ListDbdFiles():
+    files = []
+    for dbdDir, dbdfile in _loaded:
+        _ScanDbdFiles(dbdfile, _DbdPath(dbdDir), dbdDir, files)
+    return map(os.path.abspath, files)
+
+
+## Reads a dbd file in Python, returning a DbdDefinitions table and the list
+# of files read.  The file and its includes are searched for on the given
+# list of directories, except that names with a directory part, and the
+# directories of path statements, are taken relative to directory.
+def ReadDbdFile(filename, path, directory = ''):
+    reader = _DbdReader(filename, path, directory)
+    return reader.definitions, reader.files
+
+
+# This class uses the tables read from the dbd files by ReadDbdFile to
+# validate field values without calling into libdbStaticHost.
+class PyValidateDbField(_FieldValidator):
+    def __init__(self, definitions, recordType):
+        _FieldValidator.__init__(self)
+        self.definitions = definitions
+        self.recordType = recordType
+
+    # As for ValidateDbField this is postponed until first use so that menus
+    # and device choices are complete.
+    def _ProcessDbd(self):
+        self._FieldInfo = OrderedDict()
+        valid_names = []
+        for name, field in self.__Fields().items():
+            ArgInfo = _FieldArgInfo(
+                field.prompt, _DbfTypes[field.dbf], self.__Choices(field))
+            if name != "NAME":
+                valid_names.append(name)
+                if ArgInfo is not None:
+                    self._FieldInfo[name] = ArgInfo
+        self._ValidNamesSet = set(valid_names)
+
+    def __Fields(self):
+        return self.definitions.recordtypes[self.recordType]
+
+    # Returns the list of menu or device choices for the given field.
+    def __Choices(self, field):
+        if field.dbf == 'DBF_MENU':
+            return self.definitions.menus.get(field.menu, [])
+        elif field.dbf == 'DBF_DEVICE':
+            return self.definitions.devices.get(self.recordType, [])
+        else:
+            return []
+
+    # Follows the rules implemented by dbVerify, returning the same
+    # messages.
+    def _Verify(self, name, value):
+        field = self.__Fields()[name]
+        dbf = field.dbf
+        if '$(' in value or '${' in value:
+            return None
+        elif dbf == 'DBF_STRING':
+            if len(value) >= field.size:
+                return 'string to big. max=%d' % field.size
+        elif dbf in _SignedRanges or dbf in _UnsignedRanges:
+            if value:
+                match = _strtol_re.match(value)
+                if not match:
+                    return 'not an integer number'
+                number = int(match.group(1) + match.group(2), 0)
+                if dbf in _SignedRanges:
+                    limits = _SignedRanges[dbf]
+                    if limits and not limits[0] <= number <= limits[1]:
+                        return 'must have %d<=value<=%d' % limits
+                else:
+                    if number < 0:
+                        # strtoul negates in unsigned arithmetic
+                        number += 1 << 64
+                    limit = _UnsignedRanges[dbf]
+                    if limit is not None and number > limit:
+                        return 'must have 0<=value<=%d' % limit
+        elif dbf in ['DBF_FLOAT', 'DBF_DOUBLE']:
+            if value and not _strtod_re.match(value):
+                return 'not a number'
+        elif dbf == 'DBF_MENU':
+            # dbVerify accepts anything for a field with an undefined menu
+            choices = self.definitions.menus.get(field.menu)
+            if choices is not None and value not in choices:
+                return 'Not a valid menu choice'
+        elif dbf == 'DBF_DEVICE':
+            # and for a record type with no device support
+            choices = self.__Choices(field)
+            if choices and value not in choices:
+                return 'Not a valid menu choice'
+        elif dbf not in ['DBF_INLINK', 'DBF_OUTLINK', 'DBF_FWDLINK']:
+            return 'Not a legal field type'
+        return None
+
+
+## Set this to True to read dbd files in Python rather than through
+# libdbStaticHost.  Normally set by passing python_dbd=True to Configure.
+PythonDbd = False
+
+# All dbd files read in Python are accumulated into this single table, in
+# the same way that _db below accumulates the static database.
+_definitions = DbdDefinitions()
+
+# The definitions read from each dbd file are cached between runs, keyed by
+# the file and EPICS_BASE, and revalidated against every file read.  The
+# cached tables are those built by the Python reader, so the cache is only
+# used when PythonDbd is set: it never changes how field values are
+# validated.
+_dbd_cache = PersistentCache('dbd')
+
+# Changed whenever the reader changes what it reads from a dbd file, so that
+# tables cached by an older reader are not used.
+_ReaderVersion = 3
+
+# Returns the key identifying a dbd file in the cache.
+def _DbdKey(dbdDir, dbdfile):
+    return (os.path.abspath(os.path.join(dbdDir, dbdfile)), paths.EPICS_BASE,
+        _ReaderVersion)
+
+# Returns the search path used to find a dbd file and its includes without a
+# directory part.
+def _DbdPath(dbdDir):
+    return [dbdDir, os.path.join(paths.EPICS_BASE, 'dbd')]
+
+def _LoadPythonDbdFile(device, dbdDir, dbdfile):
+    key = _DbdKey(dbdDir, dbdfile)
+    definitions = _dbd_cache.Lookup(key)
+    if definitions is None:
+        definitions, files = ReadDbdFile(dbdfile, _DbdPath(dbdDir), dbdDir)
+        _dbd_cache.Store(key, map(os.path.abspath, files), definitions)
+    _definitions.Merge(definitions)
+
+    for recordType in _definitions.recordtypes:
+        if not hasattr(RecordTypes, recordType):
+            validate = PyValidateDbField(_definitions, recordType)
+            RecordTypes._PublishRecordType(device, recordType, validate)
 
 
 
@@ -151,20 +666,49 @@ class ValidateDbField:
 # the DBD entries are accumulated into a single large database.
 _db = ctypes.c_void_p()
 
+## List of the dbd files loaded by LoadDbdFile.
+LoadedDbdFiles = []
+# The (dbdDir, dbdfile) pairs passed to LoadDbdFile.
+_loaded = []
+
+# Serialises loading of dbd files, as all files are accumulated into the
+# same database.
+_load_lock = threading.Lock()
+
 def LoadDbdFile(device, dbdDir, dbdfile):
+    _load_lock.acquire()
+    timings.Begin('dbd', os.path.join(dbdDir, dbdfile))
+    try:
+        _LoadDbdFile(device, dbdDir, dbdfile)
+    finally:
+        timings.End()
+        _load_lock.release()
+
+def _LoadDbdFile(device, dbdDir, dbdfile):
+    global _generation
+    _generation += 1
+    LoadedDbdFiles.append(os.path.abspath(os.path.join(dbdDir, dbdfile)))
+    _loaded.append((dbdDir, dbdfile))
+
+    if PythonDbd:
+        _LoadPythonDbdFile(device, dbdDir, dbdfile)
+        return
+
     # Read the specified dbd file into the current database.  This allows
     # us to see any new definitions.  The device used to load the record is
-    # also recorded for later use.
-    curdir = os.getcwd()
-    os.chdir(dbdDir)
-
+    # also recorded for later use.  The file and its includes are searched
+    # for in dbdDir and then in EPICS_BASE, so the working directory is left
+    # alone.  A file name with a directory part is taken relative to dbdDir,
+    # though libdbStatic opens includes with a directory part from the
+    # working directory.
+    filename = dbdfile
+    if '/' in filename:
+        filename = os.path.join(dbdDir, filename)
     status = mydbstatic.dbReadDatabase(
-        ctypes.byref(_db), dbdfile, '.:%s/dbd' % paths.EPICS_BASE, None)
+        ctypes.byref(_db), filename, ':'.join(_DbdPath(dbdDir)), None)
     assert status == 0, 'Error reading database %s/%s (status %d)' % \
         (dbdDir, dbdfile, status)
 
-    os.chdir(curdir)
-
 
     # Enumerate all the record types and build a record generator class
     # for each one that we've not seen before.
@@ -129,6 +129,12 @@ class Device(libversion.ModuleBase):
         # called only the once per class.
         cls._OncePhases = set()
 
+    # Called by ModuleBase.ResetInstances to forget which InitialiseOnce
+    # methods have been called.
+    @classmethod
+    def _ResetClass(cls):
+        cls._OncePhases = set()
+
     BaseClass = True
 
     FIRST = _FIRST      # To be withdrawn at first opportunity!
@@ -6,8 +6,10 @@ from autosubst import populate_class
 import support
 import dbd
 import arginfo
+import timings
+import manifest
 import os
-import xml.dom.minidom
+import xml.dom.pulldom
 
 __all__ = ['Xml']
 
@@ -82,6 +84,7 @@ class Xml(ModuleBase):
         # read in the xml file
         xml = self.ModuleFile(
             os.path.join('etc', 'makeIocs', self.TemplateFile))
+        manifest.AddInput(xml)
         xml_text = open(xml).read()
 
         # substitute the args
@@ -143,25 +146,56 @@ def constructArgDict(el, objects, classes, ident_lookup=True):
                 else:
                     print "***Warning: Can't lookup object %s" % value
         # otherwise make it the right type
-        elif desc.typ == bool:
-            if value and value.lower() != 'false':
-                value = True
-            else:
-                value = False
-        elif desc.typ == str:
-            value = value.decode('string_escape')
-        elif desc.typ == float:
-            # pass a string to retain formatting
-            float(value)            
         else:
-            value = desc.typ(value)
+            value = convertArg(desc, value)
         # add it to the dict
         d[attr] = value
     return name, ob, d
 
+# Converts the string value of an xml attribute to the type given by its
+# argument description.
+def convertArg(desc, value):
+    if desc.typ == bool:
+        if value and value.lower() != 'false':
+            value = True
+        else:
+            value = False
+    elif desc.typ == str:
+        value = value.decode('string_escape')
+    elif desc.typ == float:
+        # pass a string to retain formatting
+        float(value)
+    else:
+        value = desc.typ(value)
+    return value
+
+# The class lookup is cached until new classes are defined, and the record
+# classes until more dbd files are loaded.
+_class_lookup = None
+_class_lookup_key = None
+_record_classes = None
+_record_generation = None
+
+# Returns a dictionary of the classes which can be instantiated from xml,
+# keyed by element name.  The dictionary is shared between calls, so it must
+# be copied by a caller which changes it.
 def createClassLookup():
-    classes = {}
-    # create some record classes
+    global _class_lookup, _class_lookup_key
+    key = (list(ModuleBase.ModuleBaseClasses), dbd._generation)
+    if key != _class_lookup_key:
+        _class_lookup = buildClassLookup()
+        _class_lookup_key = key
+    return _class_lookup
+
+# Returns a class wrapping each record type with an ArgInfo.
+def recordClasses():
+    global _record_classes, _record_generation
+    if _record_generation != dbd._generation:
+        _record_classes = makeRecordClasses()
+        _record_generation = dbd._generation
+    return _record_classes
+
+def makeRecordClasses():
     records = []
     for recordtype in dbd.records.GetRecords():
         cls = getattr(dbd.records, recordtype)
@@ -180,10 +214,19 @@ def createClassLookup():
         o.__name__ = recordtype
         # add it to our list
         records.append(o)
+    return records
+
+def buildClassLookup():
+    classes = {}
     # create the class dict
-    for o in ModuleBase.ModuleBaseClasses + records:
-        # make sure we have an ArgInfo
-        if not hasattr(o, 'ArgInfo') or o.__name__.startswith('_'):
+    for o in ModuleBase.ModuleBaseClasses + recordClasses():
+        # make sure we have an ArgInfo, without scanning the templates of
+        # AutoSubstitutions which haven't been used yet
+        if hasattr(o, 'HasArgInfo'):
+            has_arginfo = o.HasArgInfo()
+        else:
+            has_arginfo = hasattr(o, 'ArgInfo')
+        if not has_arginfo or o.__name__.startswith('_'):
             continue
         # add it to our class dict
         name = o.ModuleName + '.' + o.__name__
@@ -193,24 +236,206 @@ def createClassLookup():
         classes[name] = o
     return classes
 
+# Loads the module defining the class named by an xml element if loading of
+# the module was deferred by libversion.LazyLoading.
+def loadElementModule(obname):
+    # Undo the special case for names starting with a digit
+    if obname[:1] == '_' and obname[1:2].isdigit():
+        obname = obname[1:]
+    module_version = libversion._ModuleVersionTable.get(
+        obname.rsplit('.', 1)[0])
+    if module_version is not None:
+        module_version.Load()
+
+# Generates each element under the root node of xml_text in turn, reading
+# the text as it goes so that the document is never held in memory.
+def iterComponents(xml_text):
+    events = xml.dom.pulldom.parseString(xml_text)
+    depth = 0
+    for event, node in events:
+        if event == xml.dom.pulldom.START_ELEMENT:
+            if depth == 1:
+                # read the whole component, including its END_ELEMENT
+                events.expandNode(node)
+                yield node
+            else:
+                depth += 1
+        elif event == xml.dom.pulldom.END_ELEMENT:
+            depth -= 1
+
 def instantiateXml(xml_text, objects=None):
     if objects is None:
         objects = {}
 
-    xml_root = xml.dom.minidom.parseString(xml_text)
-    # find the root node
-    components = support.elements(xml_root)[0]
     # create class dict
     classes = createClassLookup()
-    # find elements under it
-    for node in support.elements(components):
-        # lookup arguments
-        name, ob, d = constructArgDict(node, objects, classes)
-        # instantiate it
-        inst = ob(**d)
+    # find elements under the root node
+    for node in iterComponents(xml_text):
+        obname = str(node.nodeName)
+        if obname not in classes:
+            # the module may not be loaded yet
+            loadElementModule(obname)
+            classes = createClassLookup()
+        timings.Begin('xml', obname)
+        try:
+            # lookup arguments
+            name, ob, d = constructArgDict(node, objects, classes)
+            # instantiate it
+            inst = ob(**d)
+        finally:
+            timings.End()
         # store it if we are given a name
         if name is not None:
             objects[name] = inst
             if libversion.Debug:
                 print 'Setting %s = %s' %(name, inst)
     return objects
+
+
+# A component of an xml file being checked by checkXml().
+class _Component(object):
+    def __init__(self, index, node, classes):
+        self.index = index
+        self.obname = str(node.nodeName)
+        self.node = node
+        self.ob = classes.get(self.obname)
+        nameKey = getattr(self.ob, 'UniqueName', 'name')
+        if node.hasAttribute(nameKey):
+            self.name = str(node.getAttribute(nameKey))
+        else:
+            self.name = None
+        # records are named by their record argument
+        if self.name is None and node.hasAttribute('record'):
+            self.label = str(node.getAttribute('record'))
+        else:
+            self.label = self.name
+        # indices of the earlier components this one refers to
+        self.depends = set()
+        self.errors = []
+
+    def __str__(self):
+        if self.label is None:
+            return 'component %d <%s>' % (self.index + 1, self.obname)
+        else:
+            return 'component %d <%s> "%s"' % (
+                self.index + 1, self.obname, self.label)
+
+# Checks the arguments of a single component, appending any problems found to
+# component.errors.  Returns a list of (field, value) pairs to be checked if
+# the component is a record.
+def _checkComponent(component, components, names):
+    ob = component.ob
+    if ob is None:
+        component.errors.append('Can\'t find object "%s"' % component.obname)
+        return []
+    nameKey = getattr(ob, 'UniqueName', 'name')
+    descriptions = ob.ArgInfo.descriptions
+    given = set()
+    fields = []
+    for attr, value in component.node.attributes.items():
+        attr = str(attr)
+        value = str(value)
+        if attr == nameKey and nameKey not in descriptions:
+            continue
+        if attr not in descriptions:
+            component.errors.append(
+                '%s is not a valid argument for %s' % (attr, component.obname))
+            continue
+        given.add(attr)
+        desc = descriptions[attr]
+        if getattr(desc, 'ident', False):
+            if value not in names:
+                component.errors.append(
+                    '%s refers to unknown object "%s"' % (attr, value))
+                continue
+            target = components[names[value]]
+            if target.index >= component.index:
+                component.errors.append(
+                    '%s refers to "%s" before it is defined' % (attr, value))
+                continue
+            component.depends.add(target.index)
+            try:
+                matches = target.ob is None or issubclass(target.ob, desc.typ)
+            except TypeError:
+                matches = True
+            if not matches:
+                component.errors.append(
+                    '%s refers to "%s" which is a %s, not a %s' % (
+                        attr, value, target.obname, desc.typ.__name__))
+        else:
+            try:
+                convertArg(desc, value)
+            except Exception, error:
+                component.errors.append(
+                    'Invalid value "%s" for %s: %s' % (value, attr, error))
+                continue
+            if hasattr(ob, 'r') and attr != 'record':
+                fields.append((attr, value))
+    # every required argument without a default must be given
+    defaults = getattr(ob, 'Defaults', {})
+    missing = [name for name in ob.ArgInfo.required_names
+        if name not in given and name not in defaults]
+    if missing:
+        component.errors.append(
+            'Missing required arguments: %s' % ', '.join(missing))
+    return fields
+
+## Checks the components of xml_text without instantiating any of them,
+# returning a list of error messages, which is empty if no problems were
+# found.  The class, the type of each argument and each reference to
+# another component are checked, as are missing required arguments and the
+# field values of records.
+#
+# The components are checked in document order.  A component can only refer
+# to components before it, so these have been checked already and an error
+# is reported against any component which refers to a component with errors.
+# The field values of records are then all checked together.
+def checkXml(xml_text):
+    # load every module used before checking anything
+    classes = createClassLookup()
+    nodes = []
+    for node in iterComponents(xml_text):
+        obname = str(node.nodeName)
+        if obname not in classes:
+            loadElementModule(obname)
+            classes = createClassLookup()
+        nodes.append(node)
+    components = [_Component(index, node, classes)
+        for index, node in enumerate(nodes)]
+
+    names = {}
+    for component in components:
+        if component.name is not None:
+            if component.name in names:
+                component.errors.append('Name "%s" is already used by %s' % (
+                    component.name, components[names[component.name]]))
+            else:
+                names[component.name] = component.index
+
+    # Indexed by (validator, field name), each entry maps each value to the
+    # components it is assigned to.
+    groups = {}
+    for component in components:
+        fields = _checkComponent(component, components, names)
+        failed = [components[index].name
+            for index in sorted(component.depends)
+            if components[index].errors]
+        if failed:
+            component.errors.append('Refers to %s which %s errors' % (
+                ', '.join(['"%s"' % name for name in failed]),
+                len(failed) == 1 and 'has' or 'have'))
+        for field, value in fields:
+            groups.setdefault((component.ob.r._validate, field), {}) \
+                .setdefault(value, []).append(component)
+
+    # the record field values are checked together once all the components
+    # have been checked, so that each value is only verified once
+    for (validate, field), values in groups.items():
+        for value, message in validate.VerifyValues(field, values):
+            for component in values[value]:
+                component.errors.append('Can\'t write "%s" to field %s: %s' % (
+                    value, field, message))
+
+    return ['%s: %s' % (component, error)
+        for component in components
+        for error in component.errors]
@@ -25,7 +25,6 @@
 #       Adds file to be copied into IOC directory tree.
 
 import os
-import shutil
 
 import support
 from support import autosuper, quote_c_string
@@ -35,6 +34,7 @@ from configure import TargetOS, Get_TargetOS, Get_TargetOS_dict, Call_TargetOS
 from configure import Architecture
 import paths
 import mydbstatic
+import dbd
 
 
 
@@ -99,10 +99,10 @@ class iocInit(support.Singleton):
         # We can't import the IOC until we've finished importing (at least,
         # not if we want EPICS_BASE to behave like other modules), so we have
         # to put off creating it until configure tells us to initialise.
-        mydbstatic.ImportFunctions()
+        if not dbd.PythonDbd:
+            mydbstatic.ImportFunctions()
         ModuleVersion('EPICS_BASE', home = paths.EPICS_BASE, use_name = False)
-        from modules.EPICS_BASE import epicsBase
-        epicsBase(self)
+        self.__CreateEpicsBase()
 
         # Now the architecture has been set (assuming it has), set up the
         # appropriate IOC string quoting function.
@@ -112,6 +112,17 @@ class iocInit(support.Singleton):
         print_setenv = Get_TargetOS_dict(globals(), 'setenv', _no_architecture)
 
 
+    def __CreateEpicsBase(self):
+        from modules.EPICS_BASE import epicsBase
+        epicsBase(self)
+
+    ## Discards the state of the IOC being built, leaving this in the same
+    # state as after Initialise().
+    def Reset(self):
+        self.__init__()
+        self.__CreateEpicsBase()
+
+
     def SetIocName(self, ioc_name, substitute_boot = False):
         self.ioc_name = ioc_name
         self.substitute_boot = substitute_boot
@@ -195,7 +206,13 @@ class iocInit(support.Singleton):
 
 
     # Writes out a complete IOC startup script.
-    def PrintIoc(self, ioc_root=None):
+    # Prints the startup script to output, or stdout if not specified.  The
+    # startup script is generated by the individual devices using print, so
+    # for now we have to redirect stdout to write to output.
+    def PrintIoc(self, ioc_root=None, output=None):
+        support.CallWithStdout(output, self.__PrintIoc, ioc_root)
+
+    def __PrintIoc(self, ioc_root):
         self.PrintHeader(ioc_root)
         Hardware.PrintBody()
         self.PrintFooter()
@@ -276,6 +293,10 @@ class IocDataSet(support.Singleton):
     __DataPath = None
     __DataFileList = {}
 
+    def Reset(self):
+        self.__DataPath = None
+        self.__DataFileList = {}
+
     def SetDataPath(self, DataPath):
         self.__DataPath = DataPath
 
@@ -287,7 +308,7 @@ class IocDataSet(support.Singleton):
         assert self.__DataPath is not None, 'IOC data path not yet defined'
         if self.__DataFileList:
             targetDir = os.path.join(targetDir, self.__DataPath)
-            if make_dirs:
+            if make_dirs and not os.path.isdir(targetDir):
                 os.makedirs(targetDir)
             for filename, file_object in self.__DataFileList.items():
                 file_object._CopyFile(os.path.join(targetDir, filename))
@@ -295,6 +316,13 @@ class IocDataSet(support.Singleton):
     def DataFileCount(self):
         return len(self.__DataFileList)
 
+    # Returns the source files copied into the data directory.
+    def DataFileSources(self):
+        return sorted(
+            file_object.source
+            for file_object in self.__DataFileList.values()
+            if isinstance(file_object, IocDataFile))
+
     def _AddDataFile(self, file_object, name):
         try:
             file_entry = self.__DataFileList[name]
@@ -343,7 +371,7 @@ class IocDataFile(_IocDataBase):
         self.__super.__init__(name)
 
     def _CopyFile(self, filename):
-        shutil.copyfile(self.source, filename)
+        support.CopyOutputFile(self.source, filename)
 
     # Treat two instances wrapping the same file as equal.
     def __cmp__(self, other):   return cmp(self.source, other.source)
@@ -365,14 +393,14 @@ class IocDataStream(_IocDataBase):
         self.content.append(text)
 
     def _CopyFile(self, filename):
-        output = file(filename, 'w')
+        output = support.OpenOutputFile(filename)
         for content in self.content:
             if callable(content):
                 content = content()
             output.write(content)
         output.close()
         if self.mode is not None:
-            os.chmod(filename, self.mode)
+            support.ChmodOutputFile(filename, self.mode)
         self.written = True
 
 
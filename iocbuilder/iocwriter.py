@@ -5,6 +5,7 @@ import sys, time, textwrap
 import os, os.path
 import shutil
 import types
+import re
 import fnmatch
 
 import iocinit
@@ -14,6 +15,10 @@ import libversion
 import hardware
 import paths
 import support
+import manifest
+import dbd
+import msi
+import timings
 
 from liblist import Hardware
 
@@ -35,7 +40,7 @@ def SetAdditionalHeaderText(additional):
     global _HeaderText
     _HeaderText = additional
 
-def PrintDisclaimer(s, m=None, e=''):
+def PrintDisclaimer(s, m=None, e='', output=None):
     if m is None:  m = s
     wrapper = textwrap.TextWrapper(width=110,
         replace_whitespace=False)
@@ -50,18 +55,18 @@ source: %(source)s
 %(header_text)s
 *** Please do not edit this file: edit the source file instead. ***
 ''' % locals()
-    print s + ('\n' + m).join(message.split('\n')) + e
+    print >> output, s + ('\n' + m).join(message.split('\n')) + e
 
-def PrintDisclaimerScript():
-    PrintDisclaimer('# ')
+def PrintDisclaimerScript(output=None):
+    PrintDisclaimer('# ', output=output)
 
-def PrintDisclaimerC():
-    PrintDisclaimer('/* ', ' * ', ' */')
+def PrintDisclaimerC(output=None):
+    PrintDisclaimer('/* ', ' * ', ' */', output=output)
 
 def PrintDisclaimerCommand(cmd):
-    def f():
-        print '#!' + cmd
-        PrintDisclaimerScript()
+    def f(output=None):
+        print >> output, '#!' + cmd
+        PrintDisclaimerScript(output)
     return f
 
 
@@ -72,54 +77,131 @@ def PrintDisclaimerCommand(cmd):
 #     output.Close()
 # By default the standard disclaimer header is printed at the start of the
 # generated file.
+#
+# If redirect is False then stdout is left alone and the wrapper is instead
+# used as an output stream thus:
+#     output = WriteFileWrapper(filename, redirect=False)
+#     ... output.write(text) or print >>output ...
+#     output.Close()
+# This allows several files to be written at once.  In this case the header
+# function is called with the wrapper as its output argument.
 class WriteFileWrapper:
 
     # Set header=None to suppress header output.
     def __init__(self, filename,
-            header=PrintDisclaimerScript, maxLineLength=0, mode='w'):
+            header=PrintDisclaimerScript, maxLineLength=0, mode='w',
+            redirect=True):
         self.__stdout = sys.stdout
-        self.__output = open(filename, mode)
-        self.__line = ''
+        self.__filename = filename
+        self.__output = support.OpenOutputFile(filename, mode)
+        self.__redirect = redirect
+
+        # Line length checking: the current line number and column, and a
+        # list of (line number, length) for each overlong line.
+        self.__lineNumber = 1
+        self.__column = 0
+        self.__longLines = []
 
         self.__maxLineLength = maxLineLength
         if self.__maxLineLength:
-            sys.stdout = self
+            self.write = self.__CheckedWrite
         else:
-            sys.stdout = self.__output
+            self.write = self.__output.write
+
+        if redirect:
+            if self.__maxLineLength:
+                sys.stdout = self
+            else:
+                sys.stdout = self.__output
+            if header:
+                header()
+        elif header:
+            header(self)
+
+    # Checks that no line exceeds the maximum line length, keeping track of
+    # the current column rather than the text of the current line.  Any long
+    # lines are reported when the file is closed.
+    def __CheckedWrite(self, string):
+        self.__output.write(string)
 
-        if header:
-            header()
+        newline = string.rfind('\n')
+        if self.__column + len(string) <= self.__maxLineLength:
+            # Quick path: no line in string can be too long.
+            if newline < 0:
+                self.__column += len(string)
+            else:
+                self.__lineNumber += string.count('\n')
+                self.__column = len(string) - newline - 1
+            return
+
+        start = 0
+        while True:
+            end = string.find('\n', start)
+            if end < 0:
+                break
+            self.__CheckLength(self.__column + end - start)
+            self.__lineNumber += 1
+            self.__column = 0
+            start = end + 1
+        self.__column += len(string) - start
+
+    def __CheckLength(self, length):
+        if length > self.__maxLineLength:
+            self.__longLines.append((self.__lineNumber, length))
+
+    # This can be installed as sys.stdout, so the other file methods used on
+    # stdout are provided.
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
 
-    def write(self, string):
-        # Check that no line exceeds the maximum line length
-        lines = string.split('\n')
-        for line in lines[:-1]:
-            full_line = self.__line + line
-            self.__line = ''
-            assert len(full_line) <= self.__maxLineLength, \
-                'Line %s too long' % repr(full_line)
-        self.__line = self.__line + lines[-1]
+    def flush(self):
+        self.__output.flush()
 
-        self.__output.write(string)
+    def isatty(self):
+        return False
 
     # Call this to close the file being written and to restore normal output
     # to stdout.
     def Close(self):
         assert self.__output != None, 'Close called out of sequence.'
-        assert len(self.__line) <= self.__maxLineLength, \
-            'Unterminated line %s too long' % repr(self.__line)
+        self.__CheckLength(self.__column)
         self.__output.close()
         self.__output = None
-        sys.stdout = self.__stdout
+        if self.__redirect:
+            sys.stdout = self.__stdout
+        assert not self.__longLines, '\n'.join([
+            '%s:%d: line length %d exceeds maximum of %d' % (
+                self.__filename, line, length, self.__maxLineLength)
+            for line, length in self.__longLines])
 
 
 def WriteFile(filename, writer, *argv, **argk):
-    output = WriteFileWrapper(filename, **argk)
-    if callable(writer):
-        writer(*argv)
-    else:
-        print writer
-    output.Close()
+    timings.Begin('write', filename)
+    try:
+        output = WriteFileWrapper(filename, **argk)
+        if callable(writer):
+            writer(*argv)
+        else:
+            print writer
+        output.Close()
+    finally:
+        timings.End()
+
+
+# As for WriteFile, but instead of redirecting stdout the output stream is
+# passed to writer as its output argument.
+def WriteStream(filename, writer, *argv, **argk):
+    timings.Begin('write', filename)
+    try:
+        output = WriteFileWrapper(filename, redirect=False, **argk)
+        if callable(writer):
+            writer(output=output, *argv)
+        else:
+            print >> output, writer
+        output.Close()
+    finally:
+        timings.End()
 
 
 # Class to support the creation of data files, either dynamically generated
@@ -175,19 +257,12 @@ class Makefile:
     def AddRule(self, rule):
         self.rules.append(rule)
 
-    def __print(self, lines):
-        for line in lines:
-            print line
-
     def Generate(self, root):
-        output = WriteFileWrapper(os.path.join(root, self.path, self.name))
-        self.__print(self.header)
-        print
-        self.__print(self.lines)
-        print
-        self.__print(self.footer)
-        print
-        self.__print(self.rules)
+        output = WriteFileWrapper(
+            os.path.join(root, self.path, self.name), redirect=False)
+        for lines in [self.header, self.lines, self.footer]:
+            output.write(''.join([line + '\n' for line in lines]) + '\n')
+        output.write(''.join([rule + '\n' for rule in self.rules]))
         output.Close()
 
 
@@ -246,6 +321,13 @@ class IocWriter:
             filename = os.path.join(*filename)
         WriteFile(os.path.join(self.iocRoot, filename), writer, *argv, **argk)
 
+    # As for WriteFile, but writer is passed an explicit output stream.
+    def WriteStream(self, filename, writer, *argv, **argk):
+        if not isinstance(filename, types.StringTypes):
+            filename = os.path.join(*filename)
+        WriteStream(
+            os.path.join(self.iocRoot, filename), writer, *argv, **argk)
+
 
     # This method resets only the record data but not the remaining IOC state.
     # This should only be used if incremental record creation without building
@@ -267,18 +349,21 @@ class SimpleIocWriter(IocWriter):
     ## Writes all the currently generated records to the given file.
     # The set of records will be reset after this has been done, and so
     # further records can be generated and written.
-    def WriteRecords(self, filename):
+    #
+    # If \c workers is greater than one then template instances are expanded
+    # in parallel by this many workers.
+    def WriteRecords(self, filename, workers = None):
         # Let the IOC know about this database.
         self.AddDatabase(filename)
         # Write out the database: record set and template expansions.  In
         # this version we fully expand template instances.
-        self.WriteFile(filename, self.PrintAndExpandRecords)
+        self.WriteStream(filename, self.PrintAndExpandRecords, workers)
         # Finally reset the record set.
         self.ResetRecords()
 
-    def PrintAndExpandRecords(self):
-        self.PrintRecords()
-        self.ExpandSubstitutions()
+    def PrintAndExpandRecords(self, workers = None, output = None):
+        self.PrintRecords(output)
+        self.ExpandSubstitutions(workers, output)
 
     ## Writes out the IOC startup command file.  The entire internal state
     # (apart from configuration) is reset: this allows a new IOC application
@@ -400,9 +485,9 @@ class DbOnlyWriter(IocWriter):
         db = self.ioc_name + '.db'
         substitutions = self.ioc_name + '_expanded.substitutions'
         if self.CountRecords():
-            self.WriteFile(db, self.PrintRecords)
+            self.WriteStream(db, self.PrintRecords)
         if self.CountSubstitutions():
-            self.WriteFile(substitutions, self.PrintSubstitutions)
+            self.WriteStream(substitutions, self.PrintSubstitutions)
         else:
             self.WriteFile(substitutions, '')
 
@@ -535,10 +620,18 @@ EPICS_BASE = %(EPICS_BASE)s
 
     macros = dict((k, v) for k, v in macros.iteritems() if v is not None)
 
+    # Matches the variable part of the disclaimer written by PrintDisclaimer
+    # so that files differing only in their timestamp are not rewritten.
+    DISCLAIMER_PATTERN = re.compile(
+        r'automatically generated on .*?'
+        r'\*\*\* Please do not edit this file', re.S)
+
     # Directory helper routines
 
     def MakeDirectory(self, *dir_names):
-        os.makedirs(os.path.join(self.iocRoot, *dir_names))
+        path = os.path.join(self.iocRoot, *dir_names)
+        if not (self.incremental and os.path.isdir(path)):
+            os.makedirs(path)
 
     def DeleteIocDirectory(self, makefile_name):
         # Checks that the newly computed iocBoot directory is a plausible IOC
@@ -550,14 +643,19 @@ EPICS_BASE = %(EPICS_BASE)s
         # directories.  Anything else is suspicious!
         dirlist = os.listdir(self.iocRoot)
         require_list = ['configure', 'iocBoot']
-        ignore_list = ['bin', 'db', 'dbd', 'Makefile', 'data'] + \
+        ignore_list = ['bin', 'db', 'dbd', 'Makefile', 'data',
+                support.OutputFileSet.ListFile, manifest.ManifestFile] + \
             fnmatch.filter(dirlist, '%sApp' % (self.ioc_name)) + \
             self.keep_files + [makefile_name]
         checklist = set(dirlist) - set(ignore_list)
         assert checklist <= set(require_list), \
             'Directory %s doesn\'t appear to be an IOC directory' % \
                 self.iocRoot
-        if self.keep_files:
+        if self.incremental:
+            # Leave the existing files in place: files which are no longer
+            # generated are removed when the new files are committed.
+            pass
+        elif self.keep_files:
             for file in dirlist:
                 if file not in self.keep_files:
                     file = os.path.join(self.iocRoot, file)
@@ -630,8 +728,8 @@ EPICS_BASE = %(EPICS_BASE)s
     #        <ioc>.substitutions   Substitutions file
     # \endverbatim
     #
-    # The target directory is erased unless the \c keep_files parameter is
-    # set.
+    # The target directory is erased unless the \c keep_files or
+    # \c incremental parameters are set.
     #
     # \param path
     #   Directory where IOC will be written
@@ -650,11 +748,19 @@ EPICS_BASE = %(EPICS_BASE)s
     #   the IOC directory is completely erased.
     # \param makefile_name
     #   Name of the makefile for the generated IOC, defaults to \c Makefile.
+    # \param incremental
+    #   If set an existing IOC directory is updated in place instead of being
+    #   erased: only files whose contents have changed are rewritten, and
+    #   files generated by the previous build which are no longer generated
+    #   are removed.  This preserves the state of the previous build so that
+    #   \c make only rebuilds what has changed.
     def __init__(self, path, ioc_name,
             check_release = True, substitute_boot = False, edm_screen = False,
-            keep_files = [], makefile_name = 'Makefile', build_debug = False):
+            keep_files = [], makefile_name = 'Makefile', build_debug = False,
+            incremental = False):
         # Remember parameters
         IocWriter.__init__(self, path)  # Sets up iocRoot
+        self.incremental = incremental
         self.check_release = check_release
         self.substitute_boot = substitute_boot
         self.keep_files = keep_files
@@ -673,8 +779,19 @@ EPICS_BASE = %(EPICS_BASE)s
         self.StartMakefiles(makefile_name)
         self.CreateSkeleton(makefile_name)
 
-        # Actually generate the IOC
-        self.GenerateIoc()
+        # Actually generate the IOC.  All the files are first collected in
+        # memory so that in incremental mode only changed files are written,
+        # and so that the manifest can record the generated files.
+        self.output_files = support.OutputFileSet(
+            self.iocRoot, self.DISCLAIMER_PATTERN)
+        support.SetOutputFileSet(self.output_files)
+        try:
+            self.GenerateIoc()
+            self.output_files.Flush()
+            self.WriteManifest(makefile_name)
+            self.output_files.Commit()
+        finally:
+            support.SetOutputFileSet(None)
 
     def CreateIocNames(self, ioc_name):
         # Create the names of the important components: configure, boot, app.
@@ -739,6 +856,35 @@ EPICS_BASE = %(EPICS_BASE)s
         # Finally generate the make files
         self.WriteMakefiles()
 
+    # Returns the settings recorded in the manifest: together with the input
+    # files these determine the generated IOC.
+    def ManifestSettings(self, makefile_name):
+        return dict(
+            ioc_name = self.ioc_name,
+            architecture = configure.Architecture(),
+            epics_base = paths.EPICS_BASE,
+            check_release = self.check_release,
+            substitute_boot = self.substitute_boot,
+            edm_screen = self.edm_screen,
+            build_debug = self.build_debug,
+            makefile_name = makefile_name,
+            python_dbd = bool(dbd.PythonDbd),
+            internal_msi = not msi.ExternalMsi,
+            simulation = bool(libversion.simulation_mode),
+            dynamic_load = bool(configure.Configure.dynamic_load),
+            register_dbd = bool(configure.Configure.register_dbd),
+            macros = self.macros,
+            windows_release_common = self.WINDOWS_RELEASE_COMMON)
+
+    # Writes the manifest of input and generated files, see manifest.
+    def WriteManifest(self, makefile_name):
+        self.WriteFile(manifest.ManifestFile,
+            manifest.FormatManifest(
+                self.ManifestSettings(makefile_name),
+                manifest.ListInputs(_Source),
+                self.output_files.Files()),
+            header = None)
+
     # Outputs all the individual make files.
     def WriteMakefiles(self):
         self.makefile_top.Generate(self.iocRoot)
@@ -765,12 +911,12 @@ EPICS_BASE = %(EPICS_BASE)s
         # Generate the .db and substitutions files and compute the
         # appropriate makefile targets.
         if self.CountSubstitutions():
-            self.WriteFile(
+            self.WriteStream(
                 (self.iocDbDir, substitutions), self.PrintSubstitutions)
             self.AddDatabase(os.path.join('db', expanded))
             makefile.AddLine('DB += %s' % expanded)
         if self.CountRecords():
-            self.WriteFile((self.iocDbDir, db), self.PrintRecords)
+            self.WriteStream((self.iocDbDir, db), self.PrintRecords)
             self.AddDatabase(os.path.join('db', db))
             makefile.AddLine('DB += %s' % db)
         for func in _DbMakefileHooks:
@@ -865,7 +1011,8 @@ EPICS_BASE = %(EPICS_BASE)s
         ioc = self.ioc_name
         self.WriteFile((self.iocBootDir, 'st%s.bat' % ioc),
             self.WINDOWS_CMD % dict(ioc = ioc),
-            header = lambda: PrintDisclaimer('@rem '))
+            header = lambda output=None:
+                PrintDisclaimer('@rem ', output=output))
         if not self.substitute_boot:
             self.makefile_boot.AddLine('%s += envPaths' % scripts)
         self.makefile_boot.AddLine(
@@ -913,9 +1060,10 @@ EPICS_BASE = %(EPICS_BASE)s
         template_files = os.listdir(template_dir)
         for file in template_files:
             if file not in ['RELEASE']:
-                shutil.copyfile(
+                support.CopyOutputFile(
                     os.path.join(template_dir, file),
                     os.path.join(self.iocRoot, 'configure', file))
+                manifest.AddInput(os.path.join(template_dir, file))
 
         self.WriteConfigFile('CONFIG_SITE' in template_files)
 
@@ -980,6 +1128,9 @@ EPICS_BASE = %(EPICS_BASE)s
         self.CopyDataFiles(self.iocRoot, True)
 
     def CreateEdlFiles(self):
+        # The edm screens are written directly by GuiBuilder, which also
+        # reads configure/RELEASE, so any buffered files must be written now.
+        self.output_files.Flush()
         # First we make a GuiBuilder object that knows how to make edm screens
         from dls_edm import GuiBuilder, SILENT
         gb = GuiBuilder(self.ioc_name, errors = SILENT)
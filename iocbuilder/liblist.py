@@ -34,6 +34,11 @@ class Hardware(Singleton):
         self.__IntVector = 0xC0
 
 
+    # Discards all libraries and hardware ready to build another IOC.
+    def Reset(self):
+        self.__init__()
+
+
     # The code below follows Pete Owen's algorithm as implemented in
     # support/utility/Rx-y/utilityApp/src/newInterruptVector.c.  This is used
     # to safely allocate interrupt vectors to hardware.
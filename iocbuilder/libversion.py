@@ -10,6 +10,7 @@ import types
 import support
 import hardware
 import paths
+import timings
 
 
 __all__ = [
@@ -52,6 +53,29 @@ Debug = False
 # Enable reporting of missing module files
 ReportMissingModuleFiles = True
 
+# If set the definitions of each module are only loaded when first needed:
+# when an attribute of iocbuilder.modules.<module> is first accessed or when
+# a class from the module is referenced by an XML IOC definition.  Modules
+# declared with auto_instantiate set are always loaded immediately.
+LazyLoading = False
+
+
+# Module type used for the modules in iocbuilder.modules: looking up an
+# undefined attribute loads the definitions of the module if loading was
+# deferred by LazyLoading.
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, name):
+        # Special names such as __file__ are probed by generic code: this
+        # should not cause the module to load.
+        module_version = self.__dict__.get('ModuleVersion')
+        if not name.startswith('__') and \
+                module_version is not None and module_version.Load():
+            return getattr(self, name)
+        raise AttributeError(
+            "'module' object %s has no attribute '%s'" % (
+                self.__name__, name))
+
+
 ## Specifies module version and imports definitions.
 #
 # Declares the version of an EPICS support module and loads its definitions
@@ -149,14 +173,16 @@ class ModuleVersion:
         # this module.
         _ModuleVersionTable[libname] = self
         self.__CreateVersionModule()
+        # Set to (load_path,) while loading of the definitions is deferred,
+        # with the hooks to call once they are loaded.
+        self.__pending = None
+        self.__load_hooks = []
         if suppress_import:
             print >>sys.stderr, 'Import of %s skipped' % self.__name
+        elif LazyLoading and not auto_instantiate:
+            self.__pending = (load_path,)
         else:
-            ModuleVersion._AutoInstances = []
-            self.__LoadModuleDefinitions(load_path)
-            if auto_instantiate:
-                for subclass in ModuleVersion._AutoInstances:
-                    subclass._AutoInstantiate()
+            self.__LoadModule(load_path, auto_instantiate)
 
 
     ## Returns the path to the module directory defined by this entry.
@@ -199,6 +225,29 @@ class ModuleVersion:
     def ModuleName(self):
         return self.__module_name
 
+    ## Loads the definitions of this module if loading was deferred by
+    # LazyLoading.  Returns True if the definitions were loaded by this call.
+    def Load(self):
+        if self.__pending is None:
+            return False
+        load_path, = self.__pending
+        self.__pending = None
+        self.__LoadModule(load_path, False)
+        return True
+
+    ## Returns False if loading of the definitions of this module has been
+    # deferred and has not yet happened.
+    def Loaded(self):
+        return self.__pending is None
+
+    ## Calls hook(module_version) once the definitions of this module have
+    # been loaded: immediately unless loading has been deferred.
+    def OnLoad(self, hook):
+        if self.__pending is None:
+            hook(self)
+        else:
+            self.__load_hooks.append(hook)
+
     # The following definitions ensure that when hashed and when compared
     # this class behaves exactly like its name: this ensures that sets and
     # sorted lists of modules behave predicably.
@@ -211,7 +260,7 @@ class ModuleVersion:
         # modules.  If we can find any module definitions then they will be
         # loaded into this module.
         ModuleName = 'iocbuilder.modules.%s' % self.__module_name
-        self.module = support.CreateModule(ModuleName)
+        self.module = support.CreateModule(ModuleName, _LazyModule)
         setattr(modules, self.__module_name, self.module)
         self.ClassesList = []
         modules.LoadedModules[self.__module_name] = self.ClassesList
@@ -223,6 +272,39 @@ class ModuleVersion:
             setattr(self.module, attr, getattr(self, attr))
 
 
+    def __LoadModule(self, load_path, auto_instantiate):
+        # Loading can be triggered while another module is loading, so the
+        # list of classes to auto instantiate has to be saved.
+        timings.Begin('module', self.__name)
+        AutoInstances = ModuleVersion._AutoInstances
+        ModuleVersion._AutoInstances = []
+        first_class = len(ModuleBase.ModuleBaseClasses)
+        try:
+            self.__LoadModuleDefinitions(load_path)
+            _RecordLoadedState(
+                self.module, ModuleBase.ModuleBaseClasses[first_class:])
+            if auto_instantiate:
+                for subclass in ModuleVersion._AutoInstances:
+                    subclass._AutoInstantiate()
+                    _LoadedStates.append((subclass, None, None))
+        finally:
+            ModuleVersion._AutoInstances = AutoInstances
+            timings.End()
+
+        # The hooks must not see the module that triggered a deferred load
+        # as the module being loaded.
+        LoadingModule = ModuleVersion._LoadingModule
+        ModuleVersion._LoadingModule = []
+        timings.Begin('onload', self.__name)
+        try:
+            for hook in self.__load_hooks:
+                hook(self)
+        finally:
+            ModuleVersion._LoadingModule = LoadingModule
+            timings.End()
+        self.__load_hooks = []
+
+
     def __LoadModuleDefinitions(self, load_path):
         if load_path:
             ModuleFile, IsPackage = _CheckPythonModule(load_path, self.__name)
@@ -258,7 +340,11 @@ class ModuleVersion:
             self.module.__path__ = [os.path.dirname(ModuleFile)]
 
         ModuleVersion._LoadingModule.append(self)
-        execfile(ModuleFile, self.module.__dict__)
+        timings.Begin('builder', ModuleFile)
+        try:
+            execfile(ModuleFile, self.module.__dict__)
+        finally:
+            timings.End()
         assert ModuleVersion._LoadingModule.pop() == self, \
             'Something went wrong during module loading!'
 
@@ -281,6 +367,70 @@ class ModuleVersion:
 
 
 
+# Returns a copy of value which can later be compared with a copy of the
+# same value to see whether it has changed.  Containers are copied all the
+# way down, anything else is kept as it is and so is compared by its own
+# equality, which is usually identity.
+def _CopyState(value):
+    if isinstance(value, dict):
+        return dict((key, _CopyState(item)) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [_CopyState(item) for item in value]
+    elif isinstance(value, (set, frozenset)):
+        return set(value)
+    else:
+        return value
+
+# Returns a copy of the state held in the given class or module.  Attributes
+# which are reset by ModuleBase.ResetInstances() or which only cache what
+# can be computed from the module files are left out.
+def _OwnerState(owner, names = None):
+    if isinstance(owner, types.ModuleType):
+        ignore = set()
+    else:
+        ignore = set(getattr(owner, '_CachedAttributes', ()))
+        ignore.add('_Instantiated')
+    namespace = owner.__dict__
+    if names is None:
+        names = [name for name in namespace
+            if not (name.startswith('__') and name.endswith('__'))]
+    return _CopyState(dict(
+        (name, namespace.get(name)) for name in names
+        if name not in ignore))
+
+# The state of each module builder as it was loaded: a list of (owner,
+# names, state) for each builder module and ModuleBase subclass defined by
+# it.  The names are None for a class, for which all of its attributes are
+# checked, and are the names defined when the module was loaded for a
+# module, as more names are added later by the load hooks.  The state is
+# None if it cannot be checked, which is also recorded for classes
+# instantiated as they were loaded.
+_LoadedStates = []
+
+def _RecordLoadedState(module, classes):
+    for owner in [module] + classes:
+        try:
+            state = _OwnerState(owner)
+        except Exception:
+            state = None
+        if isinstance(owner, types.ModuleType) and state is not None:
+            names = sorted(state)
+        else:
+            names = None
+        _LoadedStates.append((owner, names, state))
+
+# Returns True if every module builder is in the state it was loaded in.
+# Any error while comparing counts as a change.
+def _LoadedStateUnchanged():
+    for owner, names, state in _LoadedStates:
+        try:
+            if state is None or _OwnerState(owner, names) != state:
+                return False
+        except Exception:
+            return False
+    return True
+
+
 ## All entities which need to depend on module versions should subclass
 # this class to obtain access to their configuration information.
 #
@@ -392,6 +542,27 @@ class ModuleBase(support.autosuper):
     ## List of all instances
     _ModuleBaseInstances = []
 
+    ## Names of class attributes which only cache values computed from the
+    # module files, and so can be kept from one IOC to the next.
+    _CachedAttributes = ()
+
+    ## Forgets all instances of ModuleBase subclasses so that another IOC can
+    # be built from the classes already loaded.  Any per class state is reset
+    # by calling the _ResetClass method where one is defined.  Returns False
+    # if any module builder class or module is not left in the state it was
+    # loaded in, or if classes were instantiated as they were loaded: in
+    # this case the modules must be loaded again before building another IOC.
+    @classmethod
+    def ResetInstances(cls):
+        for subclass in ModuleBase.ModuleBaseClasses:
+            subclass._Instantiated = False
+            if hasattr(subclass, '_ResetClass'):
+                subclass._ResetClass()
+        ModuleBase._ReferencedModules.clear()
+        del ModuleBase._ReferencedClasses[:]
+        del ModuleBase._ModuleBaseInstances[:]
+        return _LoadedStateUnchanged()
+
     # This can be called to ensure that an instance of the invoked class
     # exists.
     @classmethod
@@ -474,7 +645,13 @@ class ModuleBase(support.autosuper):
         for x in l:
             f = getattr(x, name, None)
             if f is not None:
-                f(**args)
+                timings.Begin(name, '%s.%s' % (
+                    getattr(x, 'ModuleName', ''), getattr(
+                        x, '__name__', x.__class__.__name__)))
+                try:
+                    f(**args)
+                finally:
+                    timings.End()
 
 
 ## This is a decorator helper function designed to be used with functions
@@ -0,0 +1,168 @@
+'''Manifest of the inputs and outputs of a generated IOC.'''
+
+## Content hash manifest for generated IOCs.
+#
+# When an IOC is written by DiamondIocWriter a manifest is written to the
+# root of the IOC recording the SHA-256 of every file generated together
+# with the SHA-256 of every input file the IOC was generated from:
+#
+#   - the generating script or XML file,
+#   - any files registered with AddInput(), such as RELEASE files, the
+#     configure files copied from EPICS base and nested Xml files,
+#   - the builder definitions of every loaded module,
+#   - the template files used by the IOC and, if they were expanded in
+#     process, the files they include,
+#   - the dbd files loaded and the files they include,
+#   - the data files copied into the IOC,
+#   - the IOC builder itself.
+#
+# Input files which were looked for but do not exist are recorded with no
+# hash, so that creating one of them also makes the IOC out of date.
+#
+# IocUpToDate() can then be called before doing any of the work of loading
+# modules to determine whether regenerating the IOC would be a waste of
+# time.
+
+import os
+import hashlib
+import json
+
+
+__all__ = []
+
+
+## Name of the manifest file written to the root of the IOC.
+ManifestFile = '.iocbuilder_manifest'
+
+# Format of the manifest, changed whenever the set of recorded inputs changes
+# so that older manifests are ignored.
+_ManifestVersion = 2
+
+# Additional input files registered with AddInput().
+_inputs = []
+
+
+## Records filename as an input to the IOC being generated.  A file which
+# was looked for but does not exist is recorded as missing, so that creating
+# it makes the IOC out of date.
+def AddInput(filename):
+    filename = os.path.abspath(filename)
+    if filename not in _inputs:
+        _inputs.append(filename)
+
+
+## Forgets the input files registered with AddInput().
+def Reset():
+    del _inputs[:]
+
+
+## Returns the SHA-256 of the given file as a hex string, or None if the file
+# cannot be read.
+def FileHash(filename):
+    try:
+        input = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        hash = hashlib.sha256()
+        while True:
+            block = input.read(65536)
+            if not block:
+                break
+            hash.update(block)
+        return hash.hexdigest()
+    finally:
+        input.close()
+
+
+# Returns the python files defining the given module version.
+def _BuilderFiles(module_version):
+    module = module_version.module
+    if not hasattr(module, '__file__'):
+        return []
+    elif hasattr(module, '__path__'):
+        # A builder package: all of its files can contribute.
+        return [os.path.join(path, filename)
+            for path in module.__path__
+            for filename in sorted(os.listdir(path))
+            if filename.endswith('.py')]
+    else:
+        return [module.__file__]
+
+
+## Returns the list of input files for the IOC currently being built, given
+# the source file it is being built from, if any.
+def ListInputs(source = None):
+    # Imported here to avoid import cycles: configure imports this module.
+    import libversion, recordset, dbd, iocinit
+
+    files = list(_inputs)
+    if source is not None:
+        files.insert(0, source)
+    for name in sorted(libversion._ModuleVersionTable):
+        files.extend(_BuilderFiles(libversion._ModuleVersionTable[name]))
+    # The includes of a template are only known if it was expanded in
+    # process, as they are resolved by msi otherwise.
+    for template in sorted(set(
+            substitution.TemplateName(False)
+            for substitution in recordset.AllSubstitutions()
+            if substitution.TemplateDir is not None)):
+        files.extend(recordset.SubstitutionSet.TemplateFiles(template))
+    files.extend(dbd.ListDbdFiles())
+    files.extend(iocinit.IocDataSet.DataFileSources())
+    builder_dir = os.path.dirname(os.path.abspath(__file__))
+    files.extend([os.path.join(builder_dir, filename)
+        for filename in sorted(os.listdir(builder_dir))
+        if filename.endswith('.py')])
+
+    result = []
+    for filename in map(os.path.abspath, files):
+        if filename not in result:
+            result.append(filename)
+    return result
+
+
+## Returns the text of a manifest recording the given settings and inputs
+# and the list of (filename, content) pairs of the generated files.
+def FormatManifest(settings, inputs, outputs):
+    manifest = dict(
+        version = _ManifestVersion,
+        settings = settings,
+        inputs = [[filename, FileHash(filename)] for filename in inputs],
+        outputs = [[filename, hashlib.sha256(content).hexdigest()]
+            for filename, content in outputs])
+    return json.dumps(manifest, indent = 1, sort_keys = True)
+
+
+## Returns the manifest stored in the IOC at path, or None if there is no
+# readable manifest.
+def ReadManifest(path):
+    try:
+        manifest = json.load(open(os.path.join(path, ManifestFile)))
+    except (IOError, ValueError):
+        return None
+    if manifest.get('version') != _ManifestVersion:
+        return None
+    return manifest
+
+
+## Returns True if the IOC at path was generated with the given settings
+# from input files which are all unchanged and all of the generated files
+# are still present and unchanged.  Only the settings passed are checked, so
+# the caller only needs to pass the settings it knows about.  This is cheap
+# as only the input and generated files are read.
+def IocUpToDate(path, **settings):
+    manifest = ReadManifest(path)
+    if manifest is None:
+        return False
+    recorded = manifest['settings']
+    for name, value in settings.items():
+        if name not in recorded or recorded[name] != value:
+            return False
+    for filename, hash in manifest['inputs']:
+        if FileHash(filename) != hash:
+            return False
+    for filename, hash in manifest['outputs']:
+        if FileHash(os.path.join(path, filename)) != hash:
+            return False
+    return True
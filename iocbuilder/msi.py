@@ -0,0 +1,421 @@
+'''In process implementation of msi template expansion.'''
+
+## Template expansion without running msi.
+#
+# This module implements the macro substitution performed by the msi tool
+# (and by macLib, which msi uses) so that templates can be expanded without
+# starting an msi process for every template instance.  The following are
+# supported, following the behaviour of msi as closely as possible:
+#
+#   - Macro references $(A) and ${A}, including references nested within
+#     macro names, values and defaults.
+#   - Default values $(A=default) and scoped definitions $(A,B=value).
+#   - Undefined macros are left in place as $(A), recursive definitions are
+#     replaced by $(A,recursive).
+#   - Quotes and escapes: text in single quotes is not expanded, a \ escapes
+#     the following character.  Quotes and escapes in the template are
+#     copied through, but are discarded from macro values, defaults and
+#     names.
+#   - The include "file" and substitute "a=b,c=d" template commands.
+#
+# Templates are parsed once into lines of literal text and macro references
+# so that each expansion only needs to look up the macros used.
+
+import os
+import sys
+import re
+
+
+__all__ = []
+
+
+## Templates are expanded by running the external msi tool unless this is
+# set to False, normally by passing internal_msi=True to Configure.  msi
+# remains the default until expansion in process has been compared with msi
+# over the templates of every module.
+ExternalMsi = True
+
+
+# ----------------------------------------------------------------------------
+#  Macro definitions
+
+## Parses a list of macro definitions of the form a=xxx,b=yyy as accepted by
+# msi -M and by the substitute command, returning a list of (name, value)
+# pairs.  As for macParseDefns quotes and escapes are removed, and white
+# space around names and values is ignored.
+def ParseDefinitions(text):
+    definitions = []
+    name = None
+    chars = []
+    quote = None
+    i = 0
+    while i <= len(text):
+        ch = text[i:i+1]
+        if ch == '' or (ch == ',' and not quote):
+            # End of definition.  Definitions without a value are ignored.
+            if name is not None:
+                definitions.append((name, _Trim(chars)))
+            name = None
+            chars = []
+        elif quote:
+            if ch == quote:
+                quote = None
+            else:
+                if ch == '\\' and i + 1 < len(text):
+                    i += 1
+                    ch = text[i]
+                chars.append((ch, True))
+        elif ch in '"\'':
+            quote = ch
+        elif ch == '\\' and i + 1 < len(text):
+            i += 1
+            chars.append((text[i], True))
+        elif ch == '=' and name is None:
+            name = _Trim(chars)
+            chars = []
+        else:
+            chars.append((ch, False))
+        i += 1
+    return definitions
+
+# Joins a list of (character, quoted) pairs, discarding unquoted white space
+# at either end.
+def _Trim(chars):
+    start = 0
+    end = len(chars)
+    while start < end and not chars[start][1] and chars[start][0].isspace():
+        start += 1
+    while end > start and not chars[end-1][1] and chars[end-1][0].isspace():
+        end -= 1
+    return ''.join([ch for ch, _ in chars[start:end]])
+
+
+## A table of macro definitions.  As with macLib the values of macros are
+# themselves expanded before use, and are recomputed whenever a definition
+# changes.
+class Macros:
+    def __init__(self, definitions = {}):
+        self.__raw = dict(definitions)
+        self.__values = None
+        # The stack of scoped definitions is only used while expanding a
+        # $(A,B=value) reference.
+        self.__scopes = []
+        # The set of macros currently being expanded, used to detect
+        # recursive definitions.
+        self.__visiting = set()
+
+    ## Adds or replaces the given list of (name, value) definitions.
+    def Install(self, definitions):
+        for name, value in definitions:
+            self.__raw[name] = value
+        self.__values = None
+
+    # Returns the raw definition of name, or None if not defined.
+    def __Raw(self, name):
+        for scope in reversed(self.__scopes):
+            if name in scope:
+                return scope[name]
+        return self.__raw.get(name)
+
+    # Computes the expanded value of every macro.  While this is done, and
+    # while scoped definitions are in force, references are expanded from
+    # their raw definitions.  As in macLib's expand() values are expanded at
+    # level 1, so quotes and escapes are removed from the values however
+    # they are referenced.
+    def __Expand(self):
+        if self.__values is None:
+            values = {}
+            for name, raw in self.__raw.items():
+                self.__visiting.add(name)
+                values[name] = self._Translate(raw, 0, 1, '')[0]
+                self.__visiting.remove(name)
+            self.__values = values
+
+    ## Returns the given text with all macros expanded.
+    def Expand(self, text):
+        self.__Expand()
+        return self._Translate(text, 0, 0, '')[0]
+
+    # Returns the value of a simple macro reference, expanding the values if
+    # necessary.  Used to render parsed templates without rescanning text.
+    def _Lookup(self, name):
+        self.__Expand()
+        try:
+            return self.__values[name]
+        except KeyError:
+            return '$(%s)' % name
+
+    # Translates text starting at index i until one of the characters in
+    # term (or the end of the text) is reached, returning the translated
+    # text and the index of the terminating character.  At level 0 quotes
+    # and escapes are copied, otherwise they are discarded.
+    def _Translate(self, text, i, level, term):
+        discard = level > 0
+        result = []
+        quote = None
+        length = len(text)
+        while i < length and text[i] not in term:
+            ch = text[i]
+            if quote:
+                if ch == quote:
+                    quote = None
+                    if discard:
+                        i += 1
+                        continue
+            elif ch in '"\'':
+                quote = ch
+                if discard:
+                    i += 1
+                    continue
+            if ch == '$' and i + 1 < length and text[i + 1] in '({' \
+                    and quote != '\'':
+                value, i = self.__Refer(text, i, level)
+                result.append(value)
+                continue
+            elif ch == '\\' and i + 1 < length:
+                if not discard:
+                    result.append('\\')
+                i += 1
+                result.append(text[i])
+            else:
+                result.append(ch)
+            i += 1
+        return ''.join(result), i
+
+    # Expands the macro reference starting at text[i], returning the
+    # expansion and the index of the first character after the reference.
+    def __Refer(self, text, i, level):
+        start = i
+        close = text[i + 1] == '(' and ')' or '}'
+        name, i = self._Translate(text, i + 2, level + 1, '=,' + close)
+
+        default = None
+        if i < len(text) and text[i] == '=':
+            default, i = self._Translate(text, i + 1, level + 1, ',' + close)
+
+        scope = {}
+        while i < len(text) and text[i] == ',':
+            scoped_name, i = self._Translate(
+                text, i + 1, level + 1, '=,' + close)
+            if i < len(text) and text[i] == '=':
+                scoped_value, i = self._Translate(
+                    text, i + 1, level + 1, ',' + close)
+                scope[scoped_name.strip()] = scoped_value
+
+        if i >= len(text):
+            # Unterminated reference: give up and copy the rest unchanged.
+            return text[start:], i
+        i += 1
+
+        if scope:
+            # Scoped definitions force expansion from raw definitions.
+            self.__scopes.append(scope)
+            self.__values = None
+        try:
+            raw = self.__Raw(name)
+            if raw is not None:
+                if name in self.__visiting:
+                    return '$(%s,recursive)' % name, i
+                elif self.__values is not None:
+                    return self.__values[name], i
+                else:
+                    self.__visiting.add(name)
+                    value = self._Translate(raw, 0, level + 1, '')[0]
+                    self.__visiting.remove(name)
+                    return value, i
+            elif default is not None:
+                return default, i
+            else:
+                return '$(%s)' % name, i
+        finally:
+            if scope:
+                self.__scopes.pop()
+
+
+# ----------------------------------------------------------------------------
+#  Template parsing
+
+# Matches a macro reference which is just a name and so can be rendered by
+# a simple lookup.
+_simple_reference = re.compile(r'\$[({]([^$=,(){}"\'\\]*)[)}]\Z')
+
+# Returns the index of the first character after the macro reference
+# starting at text[i].  The extent of a reference does not depend on the
+# macro definitions, so this can be computed when the template is parsed.
+def _ReferenceEnd(text, i):
+    close = text[i + 1] == '(' and ')' or '}'
+    i = _ScanEnd(text, i + 2, '=,' + close)
+    while i < len(text) and text[i] in '=,':
+        i = _ScanEnd(text, i + 1, '=,' + close)
+    return i + 1
+
+# Follows Macros._Translate at level > 0 returning only the end index.
+def _ScanEnd(text, i, term):
+    quote = None
+    length = len(text)
+    while i < length and text[i] not in term:
+        ch = text[i]
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in '"\'':
+            quote = ch
+        if ch == '$' and i + 1 < length and text[i + 1] in '({' \
+                and quote != '\'':
+            i = _ReferenceEnd(text, i)
+            continue
+        elif ch == '\\' and i + 1 < length:
+            i += 1
+        i += 1
+    return i
+
+
+# Splits a line of template into a list of literal strings and macro
+# references.  Each macro reference is stored as a tuple of its text and,
+# for simple references, the macro name.
+def _ParseLine(line):
+    parts = []
+    quote = None
+    start = 0
+    i = 0
+    length = len(line)
+    while i < length:
+        ch = line[i]
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in '"\'':
+            quote = ch
+        if ch == '$' and i + 1 < length and line[i + 1] in '({' \
+                and quote != '\'':
+            end = _ReferenceEnd(line, i)
+            if start < i:
+                parts.append(line[start:i])
+            reference = line[i:end]
+            simple = _simple_reference.match(reference)
+            parts.append((reference, simple and simple.group(1)))
+            start = i = end
+            continue
+        elif ch == '\\' and i + 1 < length:
+            i += 1
+        i += 1
+    if start < length:
+        parts.append(line[start:])
+    return parts
+
+
+# Splits text into lines keeping the trailing newline, in the same way as
+# msi reads its input.
+def _SplitLines(text):
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+# Recognises the include and substitute commands, returning the command and
+# its argument, or None if the line is not a command.  This follows the
+# rather loose matching done by msi: anything after the quoted argument is
+# ignored.
+_command_argument = re.compile(r'"((?:\\"|[^"])*)"')
+def _ParseCommand(line):
+    command = line.lstrip()
+    if command[:1] not in ['i', 's']:
+        return None
+    found = None
+    for name in ['include', 'substitute']:
+        if name in command:
+            found = name
+    if found is None:
+        return None
+    match = _command_argument.match(command[len(found):].lstrip())
+    if match:
+        return found, match.group(1)
+    else:
+        return None
+
+
+## A template parsed into a list of commands ready for expansion.  Each
+# command is one of
+#   ('text', parts)         A line of text to be expanded
+#   ('substitute', defs)    Definitions to install
+#   ('include', template)   An included template, or None if not found
+class Template:
+    ## Parses the given template text.  Included files are searched for in
+    # the given list of directories, or opened as named if the list is empty.
+    def __init__(self, text, includes = [], filename = '<string>'):
+        self.filename = filename
+        self.commands = []
+        # Every file the expansion depends on, including those of included
+        # files which could not be found.
+        self.files = []
+        if filename != '<string>':
+            self.files.append(filename)
+        for line in _SplitLines(text):
+            command = _ParseCommand(line)
+            if command is None:
+                self.commands.append(('text', _ParseLine(line)))
+            elif command[0] == 'substitute':
+                self.commands.append(
+                    ('substitute', ParseDefinitions(command[1])))
+            else:
+                include, template = _IncludeTemplate(command[1], includes)
+                if template is None:
+                    self.files.append(include)
+                else:
+                    self.files.extend(template.files)
+                self.commands.append(('include', template))
+
+    ## Returns the expansion of this template using the given Macros
+    # table.  Note that substitute commands update the table.
+    def Expand(self, macros):
+        result = []
+        self.__Expand(macros, result)
+        return ''.join(result)
+
+    def __Expand(self, macros, result):
+        for command, argument in self.commands:
+            if command == 'text':
+                for part in argument:
+                    if isinstance(part, str):
+                        result.append(part)
+                    elif part[1] is not None:
+                        result.append(macros._Lookup(part[1]))
+                    else:
+                        result.append(macros.Expand(part[0]))
+            elif command == 'substitute':
+                macros.Install(argument)
+            elif argument is not None:
+                argument.__Expand(macros, result)
+
+
+## Reads and parses a template file.
+def ReadTemplate(filename, includes = []):
+    return Template(open(filename).read(), includes, filename)
+
+# Returns the name of an included file together with the parsed file, or
+# None if it can't be read.
+def _IncludeTemplate(filename, includes):
+    if includes and '/' not in filename:
+        for directory in includes:
+            path = os.path.join(directory, filename)
+            if os.access(path, os.R_OK):
+                filename = path
+                break
+    try:
+        return filename, ReadTemplate(filename, includes)
+    except IOError:
+        # msi reports a missing include file and carries on.
+        print >> sys.stderr, 'msi: Can\'t open file \'%s\'' % filename
+        return filename, None
+
+
+## Expands the given template file with a dictionary of macro values.
+def ExpandFile(filename, definitions, includes = []):
+    return ReadTemplate(filename, includes).Expand(Macros(definitions))
+
+## Expands the given text with a dictionary of macro values.
+def ExpandText(text, definitions):
+    return Template(text).Expand(Macros(definitions))
@@ -22,6 +22,12 @@
 #   msiPath
 #       This is used to compute the location of the msi executable.  This is
 #       optional if msi is on the path.
+#
+#   cache_path
+#       Directory where the results of parsing dbd and template files are
+#       cached between runs.  Caching is disabled if this is not set.  Can
+#       be set from IOCBUILDER_CACHE in the environment or in a Configure()
+#       call.
 
 import os
 
@@ -84,6 +90,8 @@ module_path = None
 module_work_path = None
 msiPath = None
 
+cache_path = os.environ.get('IOCBUILDER_CACHE')
+
 # If EPICS_BASE has been set in the environment set this version by default.
 # This can be overridden subsequently by another call to SetEpicsBase.
 if 'EPICS_BASE' in os.environ:
@@ -1,5 +1,6 @@
 '''Support for generating epics records.'''
 
+import sys
 import string
 
 import support
@@ -7,7 +8,23 @@ import recordnames
 import recordset
 
 
-__all__ = ['PP', 'CP', 'MS', 'NP', 'ImportRecord', 'ImportName']
+__all__ = [
+    'PP', 'CP', 'MS', 'NP', 'ImportRecord', 'ImportName',
+    'SetDeferredValidation']
+
+
+# Set by SetDeferredValidation.
+_DeferValidation = False
+
+## Enables or disables deferred validation of record field values.
+#
+# Normally each value assigned to a record field is checked immediately.
+# When deferred validation is enabled only the field name is checked on
+# assignment, and all field values are checked together when the records
+# are written out.  All invalid values are then reported in a single error.
+def SetDeferredValidation(defer = True):
+    global _DeferValidation
+    _DeferValidation = defer
 
 
 
@@ -29,6 +46,14 @@ def _unbind(function):
 # support modules) are subclasses of this class and are published as
 # attributes of the \ref iocbuilder.dbd.records "records" class.
 class Record(object):
+    # Records are created in very large numbers, so instances have no
+    # __dict__.  Note that subclasses need to declare __slots__ too to
+    # preserve this.
+    __slots__ = ['__fields', '__aliases', 'name']
+
+    # The name of the field aliased by 'address', computed on first use for
+    # each record class.
+    _address = None
 
     # Creates a subclass of the record with the given record type and
     # validator bound to the subclass.  The device used to load the record is
@@ -38,6 +63,7 @@ class Record(object):
         # Each record we publish is a class so that individual record
         # classes can be subclassed when convenient.
         class BuildRecord(Record):
+            __slots__ = []
             _validate = validate
             _type = recordType
             _device = device
@@ -72,11 +98,26 @@ class Record(object):
 
     def __setattr(self, name, value):
         # Because we have hooked into __setattr__, we need to dance a little
-        # to write names into our dictionary.
+        # to write names into our slots.
         if name[:2] == '__':
-            self.__dict__['_Record' + name] = value
-        else:
-            self.__dict__[name] = value
+            name = '_Record' + name
+        object.__setattr__(self, name, value)
+
+    # Returns the field aliased by 'address', which is either INP or OUT if
+    # exactly one of those exists.
+    @classmethod
+    def __AddressField(cls):
+        if '_address' not in cls.__dict__:
+            address = [field
+                for field in ['INP', 'OUT']
+                if cls.ValidFieldName(field)]
+            if len(address) == 1:
+                cls._address = address[0]
+            else:
+                cls._address = None
+        if cls._address is None:
+            raise AttributeError, 'Invalid field name address'
+        return cls._address
 
 
     # Record constructor.  Needs to be told the type of record that this will
@@ -123,20 +164,15 @@ class Record(object):
         # Make sure the Device class providing this record is instantiated
         self._device._AutoInstantiate()
 
-        # These assignment have to be directly into the dictionary to
-        # bypass the tricksy use of __setattr__.
+        # These assignment have to be directly into the slots to bypass the
+        # tricksy use of __setattr__.  Most records have no aliases, so the
+        # alias set is only created when needed.
         self.__setattr('__fields', {})
-        self.__setattr('__aliases', set())
+        self.__setattr('__aliases', None)
         self.__setattr('name', self.RecordName(record))
 
-        # Support the special 'address' field as an alias for either INP or
-        # OUT, depending on which of those exists.  We only set up this field
-        # if exactly one of INP or OUT is present as a valid field.
-        address = [field
-            for field in ['INP', 'OUT']
-            if self.ValidFieldName(field)]
-        if len(address) == 1:
-            self.__setattr('__address', address[0])
+        # The special 'address' field is an alias for either INP or OUT,
+        # depending on which of those exists: see __AddressField.
 
         # Make sure all the fields are properly processed and validated.
         for name, value in fields.items():
@@ -146,17 +182,21 @@ class Record(object):
 
 
     def add_alias(self, alias):
+        if self.__aliases is None:
+            self.__setattr('__aliases', set())
         self.__aliases.add(alias)
 
 
     # Call to generate database description of this record.  Outputs record
-    # definition in .db file format.  Hooks for meta-data can go here.
-    def Print(self):
-        print
+    # definition in .db file format to output, or to stdout if not
+    # specified.  Hooks for meta-data can go here.
+    def Print(self, output = None):
+        if output is None:
+            output = sys.stdout
+        output.write('\n')
         for hook in self.__MetadataHooks:
-            hook(self)
-        print 'record(%s, "%s")' % (self._type, self.name)
-        print '{'
+            support.CallWithStdout(output, hook, self)
+        lines = ['record(%s, "%s")' % (self._type, self.name), '{']
         # Print the fields in alphabetical order.  This is more convenient
         # to the eye and has the useful side effect of bypassing a bug
         # where DTYPE needs to be specified before INP or OUT fields.
@@ -168,10 +208,11 @@ class Record(object):
                 self.__ValidateField(k, value)
             value = str(value)
             padding = ''.ljust(4-len(k))  # To align field values
-            print '    field(%s, %s"%s")' % (k, padding, value)
-        for alias in sorted(list(self.__aliases)):
-            print '    alias("%s")' % alias
-        print '}'
+            lines.append('    field(%s, %s"%s")' % (k, padding, value))
+        for alias in sorted(self.__aliases or []):
+            lines.append('    alias("%s")' % alias)
+        lines.append('}\n')
+        output.write('\n'.join(lines))
 
 
     ## The string for a record is just its name.
@@ -185,13 +226,18 @@ class Record(object):
 
     # Calling the record generates a self link with a list of specifiers.
     def __call__(self, *specifiers):
-        return _Link(self, None, *specifiers)
+        return self._GetLink(None, specifiers)
+
+    # Returns the link to the given field with the given specifiers.  Links
+    # are shared, so the same link object is returned each time.
+    def _GetLink(self, fieldname, specifiers = ()):
+        return _InternLink(self, fieldname, specifiers)
 
 
     ## Assigning to a record attribute updates a field.
     def __setattr__(self, fieldname, value):
         if fieldname == 'address':
-            fieldname = self.__address
+            fieldname = self.__AddressField()
         if value is None:
             # Treat assigning None to a field the same as deleting that field.
             # This is convenient for default arguments.
@@ -204,7 +250,11 @@ class Record(object):
             # always possible...
             if callable(value):
                 value = value()
-            if not getattr(value, 'ValidateLater', False):
+            if getattr(value, 'ValidateLater', False):
+                pass
+            elif _DeferValidation:
+                self._validate.ValidFieldName(fieldname)
+            else:
                 self.__ValidateField(fieldname, value)
             self.__fields[fieldname] = value
 
@@ -221,16 +271,24 @@ class Record(object):
     # Allow individual fields to be deleted from the record.
     def __delattr__(self, fieldname):
         if fieldname == 'address':
-            fieldname = self.__address
+            fieldname = self.__AddressField()
         del self.__fields[fieldname]
 
 
     ## Reading a record attribute returns a link to the field.
     def __getattr__(self, fieldname):
+        if fieldname[:1] == '_':
+            # Not a field name, and most likely a slot which hasn't been
+            # assigned yet.  Don't go looking for links.
+            raise AttributeError, 'Invalid field name %s' % fieldname
         if fieldname == 'address':
-            fieldname = self.__address
+            fieldname = self.__AddressField()
+        # A field we've already linked to needs no further validation.
+        link = _links.get((self, fieldname, ()))
+        if link is not None:
+            return link
         self._validate.ValidFieldName(fieldname)
-        return _Link(self, fieldname)
+        return self._GetLink(fieldname)
 
     ## Can be called to validate the given field name, returns True iff this
     # record type supports the given field name.
@@ -278,9 +336,14 @@ class ImportRecord:
         return '<external record %s "%s">' % (self.__type, self.name)
 
     def __call__(self, *specifiers):
-        return _Link(self, None, *specifiers)
+        return self._GetLink(None, specifiers)
+
+    def _GetLink(self, fieldname, specifiers = ()):
+        return _InternLink(self, fieldname, specifiers)
 
     def __getattr__(self, fieldname):
+        if fieldname[:1] == '_':
+            raise AttributeError, 'Invalid field name %s' % fieldname
         if self.__validate:
             self.__validate.ValidFieldName(fieldname)
         else:
@@ -288,7 +351,36 @@ class ImportRecord:
             ValidChars = set(string.ascii_uppercase + string.digits)
             if not set(fieldname) <= ValidChars:
                 raise AttributeError, 'Invalid field name %s' % fieldname
-        return _Link(self, fieldname)
+        return self._GetLink(fieldname)
+
+
+# Validates the field values of all the given records, as needed when
+# validation has been deferred.  The values are gathered by record type and
+# field so that each distinct value is only checked once, and all errors are
+# reported together.
+def ValidateRecords(records):
+    errors = []
+    # Indexed by (validator, field name), each entry maps each value to
+    # the records it has been assigned to.
+    groups = {}
+    for record in records:
+        for fieldname, value in record._Record__fields.items():
+            if hasattr(value, 'Validate'):
+                try:
+                    value.Validate(record, fieldname)
+                except (AssertionError, AttributeError), error:
+                    errors.append('%s: %s' % (record.name, error))
+            else:
+                groups.setdefault((record._validate, fieldname), {}) \
+                    .setdefault(str(value), []).append(record.name)
+    for (validate, fieldname), values in groups.items():
+        for value, message in validate.VerifyValues(fieldname, values):
+            for name in values[value]:
+                errors.append('%s: Can\'t write "%s" to field %s: %s' % (
+                    name, value, fieldname, message))
+    errors.sort()
+    assert not errors, \
+        '%d invalid field values:\n%s' % (len(errors), '\n'.join(errors))
 
 
 def ImportName(name):
@@ -296,30 +388,63 @@ def ImportName(name):
     return ImportRecord(recordnames.RecordName(name))
 
 
+# All the links made to records, indexed by (record, field, specifiers).
+# Only a small fraction of records are linked to, so a single table costs
+# far less than a table for each record.
+_links = {}
+
+# Returns the link to field of record with the given specifiers, creating it
+# if necessary.
+def _InternLink(record, field, specifiers):
+    key = (record, field, specifiers)
+    try:
+        return _links[key]
+    except KeyError:
+        link = _Link(record, field, *specifiers)
+        _links[key] = link
+        return link
+
+# Forgets all links, called when the records are reset.
+def ResetLinks():
+    _links.clear()
+
+
 # A link is a class to encapsulate a process variable link.  It remembers
 # the record, the linked field, and a list of specifiers (such as PP, CP,
-# etcetera).
-class _Link:
+# etcetera).  Links are shared (see _InternLink) and so should not be
+# modified once created.  As with records there can be very many links, so
+# instances have no __dict__.
+class _Link(object):
+    __slots__ = ['record', 'field', 'specifiers', '__string']
+
     def __init__(self, record, field, *specifiers):
         self.record = record
         self.field = field
         self.specifiers = specifiers
+        self.__string = None
 
     def __str__(self):
-        result = self.record.name
-        if self.field:
-            result += '.' + self.field
-        for specifier in  self.specifiers:
-            result += ' ' + specifier
-        return result
+        # The record name is fixed, so the string need only be computed once.
+        if self.__string is None:
+            parts = [self.record.name]
+            if self.field:
+                parts.extend(['.', self.field])
+            for specifier in self.specifiers:
+                parts.extend([' ', specifier])
+            self.__string = ''.join(parts)
+        return self.__string
 
     def __call__(self, *specifiers):
-        return _Link(self.record, self.field, *self.specifiers + specifiers)
+        return self.record._GetLink(self.field, self.specifiers + specifiers)
 
     # Returns the value currently assigned to this field.
     def Value(self):
         return self.record._Record__fields[self.field]
 
+    # Links are pickled with the record they link to.
+    def __reduce__(self):
+        return (_Link, (self.record, self.field) + self.specifiers)
+
 
 
 # Some helper routines for building links
@@ -1,12 +1,16 @@
 '''Collections of records.'''
 
 import os.path
+import sys
 import subprocess
+import multiprocessing, multiprocessing.pool
 
 import recordnames
 import libversion
 import support
 import paths
+import msi
+import timings
 
 
 __all__ = ['LookupRecord', 'Substitution']
@@ -31,14 +35,24 @@ class RecordSet(support.Singleton):
     def LookupRecord(self, record):
         return self.__RecordSet[recordnames.RecordName(record)]
 
-    # Output complete set of records to stdout.
-    def Print(self):
-        for line in self.__HeaderLines:
-            print line
-        # Print the records in alphabetical order: gives the reader a fighting
-        # chance to find their way around the generated database!
-        for record in sorted(self.__RecordSet.keys()):
-            self.__RecordSet[record].Print()
+    # Output complete set of records to output, or stdout if not specified.
+    def Print(self, output = None):
+        if output is None:
+            output = sys.stdout
+        import recordbase
+        timings.Begin('records', 'print')
+        try:
+            if recordbase._DeferValidation:
+                recordbase.ValidateRecords(self.__RecordSet.values())
+            for line in self.__HeaderLines:
+                output.write(line + '\n')
+            # Print the records in alphabetical order: gives the reader a
+            # fighting chance to find their way around the generated
+            # database!
+            for record in sorted(self.__RecordSet.keys()):
+                self.__RecordSet[record].Print(output)
+        finally:
+            timings.End()
 
     # Returns the number of published records.
     def CountRecords(self):
@@ -50,6 +64,16 @@ class RecordSet(support.Singleton):
 
 
 class SubstitutionSet(support.autosuper):
+    # Templates parsed for in process expansion, shared by all substitution
+    # sets.  Indexed by template file name, each entry records the stamps
+    # returned by support.FileStamps for the template and its includes and
+    # the parsed template.
+    __ParsedTemplates = {}
+    # Templates whose files have been checked for changes since Reset().
+    __CheckedTemplates = set()
+    __TemplateHits = 0
+    __TemplateMisses = 0
+
     def __init__(self):
         # Dictionary indexed by substitution sub-classes.  For each sub-class
         # the entry consists of a list of substitution instances.
@@ -57,9 +81,11 @@ class SubstitutionSet(support.autosuper):
         # substitutions in the order they were originally given.
         self.__Substitutions = support.OrderedDict()
 
-    # Erase all recorded substitution instances.
+    # Erase all recorded substitution instances.  Templates will be checked
+    # for changes again when they are next used.
     def Reset(self):
         self.__Substitutions.clear()
+        self.__CheckedTemplates.clear()
 
     # Ensures that templates which are marked as being overwritten by this
     # template are generated first.  Unfortunately multiple templates which
@@ -73,24 +99,103 @@ class SubstitutionSet(support.autosuper):
         return self.__Substitutions.setdefault(
             substitution.TemplateName(True), (substitution, []))
 
+    # Returns the parsed form of the given template file, only reading the
+    # file the first time it is used or if it or any file it includes has
+    # changed since.  The files are checked for changes at most once
+    # between calls to Reset(), which is once for each IOC built.
+    @classmethod
+    def ParsedTemplate(cls, template):
+        try:
+            stamps, parsed = cls.__ParsedTemplates[template]
+        except KeyError:
+            pass
+        else:
+            if template in cls.__CheckedTemplates or support.FileStamps(
+                    [stamp[0] for stamp in stamps]) == stamps:
+                cls.__CheckedTemplates.add(template)
+                cls.__TemplateHits += 1
+                return parsed
+        cls.__TemplateMisses += 1
+        parsed = msi.ReadTemplate(template)
+        cls.__ParsedTemplates[template] = \
+            (support.FileStamps(parsed.files), parsed)
+        cls.__CheckedTemplates.add(template)
+        return parsed
+
+    # Returns the files read to expand the given template: the template and
+    # the files it includes if it has been parsed for in process expansion
+    # since Reset(), otherwise just the template.
+    @classmethod
+    def TemplateFiles(cls, template):
+        if template in cls.__CheckedTemplates:
+            return cls.__ParsedTemplates[template][1].files
+        else:
+            return [template]
+
+    ## Returns the number of templates parsed and the number of hits and
+    # misses in the parsed template cache.
+    @classmethod
+    def TemplateCacheStatistics(cls):
+        return len(cls.__ParsedTemplates), \
+            cls.__TemplateHits, cls.__TemplateMisses
+
     def AddSubstitution(self, substitution):
         subs_class, subs_list = self.__AddOverwrites(substitution.__class__)
         subs_list.append(substitution)
 
-    # Expand all the substitutions inline.  The path to locate the msi
-    # application used for expanding must be passed in.
-    def ExpandSubstitutions(self):
-        for subs_class, subList in self.__Substitutions.values():
-            for substitution in subList:
-                substitution.ExpandSubstitution()
-
-    # Prints out a substitutions file.
-    def Print(self, macro_name = True):
+    # Expand all the substitutions inline.  If workers is more than one the
+    # instances are expanded in parallel: in a pool of processes for in
+    # process expansion, or in a pool of threads each running msi.  The
+    # output is the same whichever way the expansion is done.
+    def ExpandSubstitutions(self, workers = None, output = None):
+        if output is None:
+            output = sys.stdout
+        substitutions = self.AllSubstitutions()
+        if not workers or workers <= 1 or len(substitutions) <= 1:
+            for substitution in substitutions:
+                timings.Begin('expand', substitution.TemplateName(False))
+                try:
+                    substitution.ExpandSubstitution(output)
+                finally:
+                    timings.End()
+            return
+
+        timings.Begin('expand', 'parallel expansion')
+        try:
+            self.__ExpandParallel(substitutions, workers, output)
+        finally:
+            timings.End()
+
+    def __ExpandParallel(self, substitutions, workers, output):
+
+        jobs = [substitution._ExpansionJob() for substitution in substitutions]
+        if msi.ExternalMsi:
+            pool = multiprocessing.pool.ThreadPool(workers)
+        else:
+            # Parse each template before starting the workers so that they
+            # all inherit the parsed templates.
+            for template, _ in jobs:
+                SubstitutionSet.ParsedTemplate(template)
+            pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_ExpandTemplate, jobs,
+                max(1, len(jobs) // (4 * workers)))
+        finally:
+            pool.close()
+            pool.join()
+        for substitution, result in zip(substitutions, results):
+            substitution._PrintExpansionHeader(output)
+            output.write(result)
+
+    # Prints out a substitutions file to output, or stdout if not specified.
+    def Print(self, macro_name = True, output = None):
+        if output is None:
+            output = sys.stdout
         # Print out the list in canonical order to help with comparison
         # across minor changes.
         for template, (subs_class, subList) in self.__Substitutions.items():
             if subList:
-                print
+                print >> output
                 if hasattr(subs_class, 'ArgInfo'):
                     lines = []
                     for x in subs_class.Arguments:
@@ -100,14 +205,14 @@ class SubstitutionSet(support.autosuper):
                     if lines:
                         format = '#  %%-%ds  %%s' % \
                             max([len(x[0]) for x in lines])
-                        print '# Macros:'
-                        print '\n'.join([format % l for l in lines])
-                print 'file %s' % template
-                print '{'
-                subs_class._PrintPattern()
+                        print >> output, '# Macros:'
+                        print >> output, '\n'.join([format % l for l in lines])
+                print >> output, 'file %s' % template
+                print >> output, '{'
+                subs_class._PrintPattern(output)
                 for substitution in subList:
-                    substitution._PrintSubstitution()
-                print '}'
+                    substitution._PrintSubstitution(output)
+                print >> output, '}'
 
     def CountSubstitutions(self):
         return len(self.__Substitutions)
@@ -173,9 +278,9 @@ class Substitution(libversion.ModuleBase):
     # This is output in a format suitable for inclusion within a substitutions
     # file.
     @classmethod
-    def _PrintPattern(cls):
+    def _PrintPattern(cls, output = None):
         if cls.Arguments:
-            print 'pattern {', ', '.join(cls.Arguments), '}'
+            print >> output, 'pattern {', ', '.join(cls.Arguments), '}'
 
 
     ## Creates a substitution instance with the given arguments.  The
@@ -211,38 +316,65 @@ class Substitution(libversion.ModuleBase):
 
     # Outputs a single substitution line, in order of arguments.  This should
     # be preceded by a call to _PrintPattern().
-    def _PrintSubstitution(self):
+    def _PrintSubstitution(self, output = None):
         if self.Arguments:
-            print '    {', ', '.join(
+            print >> output, '    {', ', '.join(
                 [QuoteArgument(self.args[arg]) for arg in self.Arguments]), \
                 '}'
         else:
             # Work around msi bug if no arguments given!
-            print '    { _ }'
-
-    # Directly expand the substitution inline.
-    def ExpandSubstitution(self):
-        argList = ['%s=%s' % (arg, QuoteArgument(self.args[arg]))
-                   for arg in self.Arguments]
-        template = self.TemplateName(False)
-
-        print
-        print '#', 75 * '-'
-        print '# Template expansion for'
-        print '# %s' % template
-        print '#    %s' % ', '.join(argList)
-        print '#', 75 * '-'
-        print
-
-        if paths.msiPath:
-            runMsi = os.path.join(paths.msiPath, 'msi')
+            print >> output, '    { _ }'
+
+    # Directly expand the substitution inline, writing to output or to
+    # stdout if not specified.
+    def ExpandSubstitution(self, output = None):
+        if output is None:
+            output = sys.stdout
+        self._PrintExpansionHeader(output)
+        output.write(_ExpandTemplate(self._ExpansionJob()))
+
+    def _ArgList(self):
+        return ['%s=%s' % (arg, QuoteArgument(self.args[arg]))
+                for arg in self.Arguments]
+
+    def _PrintExpansionHeader(self, output):
+        rule = '# ' + 75 * '-'
+        output.write('\n'.join([
+            '', rule,
+            '# Template expansion for',
+            '# %s' % self.TemplateName(False),
+            '#    %s' % ', '.join(self._ArgList()),
+            rule, '', '']))
+
+    # Returns the arguments to _ExpandTemplate for this substitution.  These
+    # are plain strings so that expansion can be done in another process.
+    def _ExpansionJob(self):
+        if msi.ExternalMsi:
+            return self.TemplateName(False), self._ArgList()
         else:
-            runMsi = 'msi'
-        msi = [runMsi] + ['-M%s' % arg for arg in argList] + [template]
-        p = subprocess.Popen(msi, stdout=subprocess.PIPE)
-        for line in p.stdout:
-            print line,
-        assert p.wait() == 0, 'Error running msi'
+            # The -M arguments are unquoted by msi, so the values can be
+            # passed straight through.
+            return self.TemplateName(False), dict(
+                (arg, str(self.args[arg])) for arg in self.Arguments)
+
+
+# Expands a template given the (template, macros) pair returned by
+# Substitution._ExpansionJob, returning the expanded text.
+def _ExpandTemplate(job):
+    template, macros = job
+    if not msi.ExternalMsi:
+        parsed = SubstitutionSet.ParsedTemplate(template)
+        return parsed.Expand(msi.Macros(macros))
+
+    if paths.msiPath:
+        runMsi = os.path.join(paths.msiPath, 'msi')
+    else:
+        runMsi = 'msi'
+    command = [runMsi] + ['-M%s' % arg for arg in macros] + [template]
+    p = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = p.communicate()[0]
+    assert p.returncode == 0, 'Error running msi'
+    return output
 
 
 RecordsSubstitutionSet = Substitution.SubstitutionSet
@@ -272,5 +404,7 @@ LookupRecord = RecordSet.LookupRecord
 
 # Special recordset reset.
 def Reset():
+    import recordbase
     RecordSet.Reset()
     RecordsSubstitutionSet.Reset()
+    recordbase.ResetLinks()
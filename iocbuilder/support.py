@@ -7,6 +7,13 @@ import fnmatch
 import types
 import re
 import subprocess
+import cPickle
+import tempfile
+import shutil
+import atexit
+
+import paths
+import msi
 
 __all__ = ['Singleton', 'AutoRegisterClass', 'SameDirFile', 'quote_c_string']
 
@@ -36,9 +43,10 @@ def ExportAllModules(globals):
 
 
 # Creates a fully qualified module from thin air and adds it to the module
-# table.
-def CreateModule(module_name):
-    module = types.ModuleType(module_name)
+# table.  A subclass of ModuleType can be given to create a module with
+# special behaviour.
+def CreateModule(module_name, module_class=types.ModuleType):
+    module = module_class(module_name)
     sys.modules[module_name] = module
     return module
 
@@ -125,6 +133,309 @@ class OrderedDict(dict):
             return value
 
 
+## Returns a list of (filename, mtime, size) stamps for the given files,
+# which can be compared with a later list to detect changes.  The mtime and
+# size of a missing file are None.
+def FileStamps(files):
+    stamps = []
+    for filename in files:
+        try:
+            stat = os.stat(filename)
+            stamps.append((filename, stat.st_mtime, stat.st_size))
+        except OSError:
+            stamps.append((filename, None, None))
+    return stamps
+
+
+## A dictionary of values saved between runs in a file in \ref paths
+# "paths.cache_path".  Each entry is stored with a list of the files it was
+# computed from, and is discarded when any of these files change.  Nothing
+# is cached if \c paths.cache_path is not set.
+class PersistentCache:
+    def __init__(self, name):
+        self.name = name
+        self.__entries = None
+        self.__updates = {}
+
+    def Enabled(self):
+        return paths.cache_path is not None
+
+    def __Filename(self):
+        return os.path.join(paths.cache_path, '%s.cache' % self.name)
+
+    def __Read(self):
+        try:
+            return cPickle.load(open(self.__Filename(), 'rb'))
+        except Exception:
+            # A missing or unreadable cache is simply empty.
+            return {}
+
+    ## Returns the value stored for key, or None if there is no value or any
+    # of the files it was computed from have changed.
+    def Lookup(self, key):
+        if not self.Enabled():
+            return None
+        if self.__entries is None:
+            self.__entries = self.__Read()
+        try:
+            stamps, value = self.__entries[key]
+        except KeyError:
+            return None
+        if FileStamps([stamp[0] for stamp in stamps]) != stamps:
+            return None
+        return value
+
+    ## Stores a value computed from the given list of files.  The cache file
+    # is written when Save() is called or at exit.
+    def Store(self, key, files, value):
+        if not self.Enabled():
+            return
+        if self.__entries is None:
+            self.__entries = self.__Read()
+        if not self.__updates:
+            atexit.register(self.Save)
+        entry = (FileStamps(files), value)
+        self.__entries[key] = entry
+        self.__updates[key] = entry
+
+    ## Writes any new entries to the cache file.  The file is reread first
+    # and replaced atomically so that concurrent builds can share a cache.
+    def Save(self):
+        if not self.__updates:
+            return
+        entries = self.__Read()
+        entries.update(self.__updates)
+        self.__updates = {}
+        if not os.path.isdir(paths.cache_path):
+            os.makedirs(paths.cache_path)
+        handle, temp_name = tempfile.mkstemp(dir = paths.cache_path)
+        output = os.fdopen(handle, 'wb')
+        cPickle.dump(entries, output, cPickle.HIGHEST_PROTOCOL)
+        output.close()
+        os.rename(temp_name, self.__Filename())
+
+
+## A set of generated files held in memory so that an existing tree can be
+# updated by rewriting only the files whose contents have changed.  While a
+# set is made active by SetOutputFileSet(), files below its root opened with
+# OpenOutputFile(), CopyOutputFile() and ChmodOutputFile() are buffered
+# instead of written.  Commit() then replaces each changed file atomically
+# and removes any files written by the previous Commit() which have not been
+# generated this time.  Files outside the root are written as normal.
+#
+# If ignore is given it is a regular expression matching text, such as a
+# generation timestamp, which is ignored when checking whether a file has
+# changed.
+class OutputFileSet:
+    ## Name of the file in the root directory listing the generated files.
+    ListFile = '.iocbuilder_files'
+
+    def __init__(self, root, ignore=None):
+        self.root = os.path.abspath(root)
+        if isinstance(ignore, str):
+            ignore = re.compile(ignore)
+        self.ignore = ignore
+        # Maps each path relative to root to its content and mode.
+        self.__files = OrderedDict()
+        self.__modes = {}
+        # Files already written to disk by Flush().
+        self.__flushed = set()
+
+    # Returns the path of filename relative to root, or None if filename is
+    # not below root.
+    def _Relative(self, filename):
+        filename = os.path.abspath(filename)
+        if filename.startswith(self.root + os.sep):
+            return filename[len(self.root) + 1:]
+        else:
+            return None
+
+    # Returns the current contents of a file, either as buffered or on disk.
+    def __Content(self, relname):
+        try:
+            return self.__files[relname]
+        except KeyError:
+            try:
+                return open(os.path.join(self.root, relname), 'rb').read()
+            except IOError:
+                return ''
+
+    # Returns the current content of the given file if it only differs from
+    # content by ignored text, otherwise None.
+    def __Unchanged(self, filename, content):
+        try:
+            old_content = open(filename, 'rb').read()
+        except IOError:
+            return None
+        if old_content == content or (self.ignore is not None and
+                self.ignore.sub('', old_content) ==
+                    self.ignore.sub('', content)):
+            return old_content
+        else:
+            return None
+
+    ## Returns a list of (filename, content) pairs for all files in the set,
+    # with filenames relative to root.
+    def Files(self):
+        return self.__files.items()
+
+    def _Open(self, relname, mode):
+        if 'a' in mode:
+            content = self.__Content(relname)
+        else:
+            content = ''
+        return _OutputBuffer(self, relname, content)
+
+    def _Store(self, relname, content):
+        self.__files[relname] = content
+        self.__flushed.discard(relname)
+
+    def _Copy(self, source, relname):
+        self._Store(relname, open(source, 'rb').read())
+
+    def _Chmod(self, relname, mode):
+        self.__modes[relname] = mode
+        self.__flushed.discard(relname)
+
+    ## Writes all buffered files which differ from the files on disk.
+    # Unchanged files are left alone so that their timestamps are preserved,
+    # and their buffered content is updated to match the file on disk.
+    # Returns the list of files written.
+    def Flush(self):
+        umask = _Umask()
+        written = []
+        for relname, content in self.__files.items():
+            if relname in self.__flushed:
+                continue
+            filename = os.path.join(self.root, relname)
+            mode = self.__modes.get(relname)
+            old_content = self.__Unchanged(filename, content)
+            if old_content is None:
+                if mode is None:
+                    mode = 0666 & ~umask
+                _ReplaceFile(filename, content, mode)
+                written.append(relname)
+            else:
+                self.__files[relname] = old_content
+                if mode is not None and \
+                        os.stat(filename).st_mode & 07777 != mode:
+                    os.chmod(filename, mode)
+            self.__flushed.add(relname)
+        return written
+
+    ## Flushes all files and removes any files left over from the previous
+    # generation, returning the lists of files written and removed.
+    def Commit(self):
+        written = self.Flush()
+        list_file = os.path.join(self.root, self.ListFile)
+        try:
+            previous = open(list_file).read()
+        except IOError:
+            previous = ''
+        removed = []
+        for relname in previous.split('\n'):
+            if relname and relname not in self.__files:
+                filename = os.path.join(self.root, relname)
+                if os.path.isfile(filename):
+                    os.remove(filename)
+                    removed.append(relname)
+                    self.__RemoveEmptyDirectories(os.path.dirname(filename))
+        file_list = ''.join(
+            [relname + '\n' for relname in sorted(self.__files)])
+        if file_list != previous:
+            _ReplaceFile(list_file, file_list, 0666 & ~_Umask())
+        return written, removed
+
+    def __RemoveEmptyDirectories(self, directory):
+        while directory != self.root and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+
+# File like object returned by OpenOutputFile for a buffered file.  The
+# content is stored in the file set when the file is closed.  As this can be
+# installed as sys.stdout it provides the file methods used on stdout.
+class _OutputBuffer:
+    softspace = 0
+
+    def __init__(self, file_set, relname, content):
+        self.__file_set = file_set
+        self.__relname = relname
+        self.__content = [content]
+
+    def write(self, text):
+        self.__content.append(text)
+
+    def writelines(self, lines):
+        self.__content.extend(lines)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        self.__file_set._Store(self.__relname, ''.join(self.__content))
+
+def _Umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Writes a new file and atomically replaces filename with it.
+def _ReplaceFile(filename, content, mode):
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, temp_name = tempfile.mkstemp(dir = directory)
+    try:
+        output = os.fdopen(handle, 'wb')
+        output.write(content)
+        output.close()
+        os.chmod(temp_name, mode)
+        os.rename(temp_name, filename)
+    except:
+        os.remove(temp_name)
+        raise
+
+_output_file_set = None
+
+## Makes file_set the active OutputFileSet, or writes files directly if None.
+def SetOutputFileSet(file_set):
+    global _output_file_set
+    _output_file_set = file_set
+
+def _OutputName(filename):
+    if _output_file_set is None:
+        return None
+    else:
+        return _output_file_set._Relative(filename)
+
+## Opens a generated file for writing, see OutputFileSet.
+def OpenOutputFile(filename, mode='w'):
+    relname = _OutputName(filename)
+    if relname is None:
+        return open(filename, mode)
+    else:
+        return _output_file_set._Open(relname, mode)
+
+## Copies source to the generated file filename, see OutputFileSet.
+def CopyOutputFile(source, filename):
+    relname = _OutputName(filename)
+    if relname is None:
+        shutil.copyfile(source, filename)
+    else:
+        _output_file_set._Copy(source, relname)
+
+## Sets the mode of a generated file, see OutputFileSet.
+def ChmodOutputFile(filename, mode):
+    relname = _OutputName(filename)
+    if relname is None:
+        os.chmod(filename, mode)
+    else:
+        _output_file_set._Chmod(relname, mode)
+
 
 # The Singleton class has *no* instances: instead, all of its members are
 # automatically converted into class methods, and attempts to create instances
@@ -278,18 +589,37 @@ def AutoRegisterClass(register, ignoreParent=True, superclass=type):
 
     return DoRegister
 
-# Call msi on a piece of text with a dictionary of macros, expensive but needed
-# because of the stupidly complex syntax...
+# Call msi on a piece of text with a dictionary of macros.  The stupidly
+# complex syntax means we have to run msi itself, which is expensive, unless
+# msi.ExternalMsi has been cleared to expand the text in process.
 def msi_replace_macros(d, text):
     if '$(' in text:
-        args = ['msi'] + ['-M%s=%s' % (k, str(v).replace(",undefined)", ")"))
+        defs = ['%s=%s' % (k, str(v).replace(",undefined)", ")"))
             for k, v in d.items()]
-        p = subprocess.Popen(args, stdout = subprocess.PIPE,
-            stdin = subprocess.PIPE)
-        return p.communicate(text)[0]
+        if msi.ExternalMsi:
+            p = subprocess.Popen(['msi'] + ['-M' + x for x in defs],
+                stdout = subprocess.PIPE, stdin = subprocess.PIPE)
+            return p.communicate(text)[0]
+        else:
+            macros = msi.Macros()
+            for x in defs:
+                macros.Install(msi.ParseDefinitions(x))
+            return msi.Template(text).Expand(macros)
     else:
         return text
 
+# Calls function with stdout sent to output.  Used to support code which
+# still writes its output with print when writing to an explicit stream.
+def CallWithStdout(output, function, *args, **kargs):
+    if output is None or output is sys.stdout:
+        return function(*args, **kargs)
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        return function(*args, **kargs)
+    finally:
+        sys.stdout = stdout
+
 # Return the element child nodes of an element
 def elements(node):
     return [n for n in node.childNodes if n.nodeType == n.ELEMENT_NODE]
@@ -0,0 +1,142 @@
+'''Timing of the phases of a builder run.'''
+
+## Profiling of builder runs.
+#
+# When enabled by Enable(), normally by passing \c profile to Configure or
+# the \c --profile option to xmlbuilder, the time taken by each phase of the
+# build is recorded: RELEASE parsing, loading each module and its builder
+# definitions, loading each dbd file, instantiating each XML component,
+# calls to Finalise and the other module hooks, record printing, template
+# expansion and writing each file.
+#
+# At exit a report of the phases sorted by time taken is printed to stderr
+# and, if a trace file was given, the phases are written to it as JSON in the
+# Chrome trace event format, which can be loaded into chrome://tracing or
+# Perfetto or compared across module releases.  The times reported for a
+# phase include the time of any phases nested within it.
+#
+# Phases are recorded by bracketing the work with Begin() and End():
+# \code
+#     timings.Begin('dbd', filename)
+#     try:
+#         ...
+#     finally:
+#         timings.End()
+# \endcode
+
+import sys
+import os
+import time
+import json
+import atexit
+import threading
+
+
+__all__ = []
+
+
+## Set when timings are being recorded.
+Enabled = False
+
+# File to write the trace to at exit, if any.
+_trace_file = None
+# Set once the report has been written.
+_finished = False
+# Time at which recording started, used as the origin of the trace.
+_origin = None
+
+# Completed phases as (category, name, start, duration, depth, thread).
+_events = []
+# The phases in progress are tracked per thread.
+_local = threading.local()
+
+
+## Starts recording timings.  If trace_file is given the trace is written to
+# this file at exit.  May be called more than once.
+def Enable(trace_file = None):
+    global Enabled, _trace_file, _origin
+    if trace_file:
+        _trace_file = trace_file
+    if not Enabled:
+        Enabled = True
+        _origin = time.time()
+        atexit.register(Finish)
+
+
+def _Stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+## Marks the start of a phase of the build.  Every call must be matched by a
+# call to End().
+def Begin(category, name):
+    if Enabled:
+        _Stack().append((category, name, time.time()))
+
+## Marks the end of the phase started by the matching call to Begin().
+def End():
+    if Enabled:
+        stack = _Stack()
+        # Recording may have been enabled after Begin() was called.
+        if stack:
+            category, name, start = stack.pop()
+            _events.append((category, name, start, time.time() - start,
+                len(stack), threading.current_thread().ident))
+
+
+## Writes a report of the time taken by each phase to output, stderr by
+# default.  The phases are summarised by category and then the phases taking
+# the most time are listed, repeated phases of the same name being combined.
+def Report(output = None, limit = 40):
+    if output is None:
+        output = sys.stderr
+    categories = {}
+    phases = {}
+    for category, name, start, duration, depth, thread in _events:
+        for table, key in ((categories, category), (phases, (category, name))):
+            count, total = table.get(key, (0, 0))
+            table[key] = (count + 1, total + duration)
+
+    print >> output, '# Builder timings (seconds)'
+    print >> output, '# %-12s %8s %10s' % ('category', 'count', 'total')
+    for category, (count, total) in sorted(
+            categories.items(), key = lambda item: -item[1][1]):
+        print >> output, '# %-12s %8d %10.3f' % (category, count, total)
+    print >> output, '# %-12s %8s %10s  %s' % (
+        'category', 'count', 'total', 'phase')
+    for (category, name), (count, total) in sorted(
+            phases.items(), key = lambda item: -item[1][1])[:limit]:
+        print >> output, '# %-12s %8d %10.3f  %s' % (
+            category, count, total, name)
+
+
+## Writes the recorded phases to filename as a JSON trace in the Chrome
+# trace event format.
+def WriteTrace(filename):
+    pid = os.getpid()
+    events = [dict(
+            name = name, cat = category, ph = 'X',
+            ts = int((start - _origin) * 1e6), dur = int(duration * 1e6),
+            pid = pid, tid = thread, args = dict(depth = depth))
+        for category, name, start, duration, depth, thread in _events]
+    output = open(filename, 'w')
+    try:
+        json.dump(dict(traceEvents = events, displayTimeUnit = 'ms'),
+            output, indent = 0)
+    finally:
+        output.close()
+
+
+## Writes the report and the trace file, if one was given.  This is called
+# at exit, but should be called explicitly by processes which end without
+# running the exit handlers.  Only the first call has any effect.
+def Finish():
+    global _finished
+    if Enabled and not _finished:
+        _finished = True
+        Report()
+        if _trace_file:
+            WriteTrace(_trace_file)
@@ -0,0 +1,63 @@
+'''Benchmark of the memory used by records.
+
+Creates a large number of ai records, each setting a few fields and linking
+to the previous record, and reports the growth in resident memory and the
+time taken per record.  Run as
+    python tests/bench_records.py [-n COUNT] [--root TREE]
+where TREE is another checkout of the builder to measure, for comparison.'''
+
+import sys
+import os
+import gc
+import time
+from optparse import OptionParser
+
+import fakebase
+
+
+# Returns the resident set size of this process in bytes.
+def ResidentMemory():
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option('-n', dest='count', type='int', default=100000,
+        help='Number of records to create, default %default')
+    parser.add_option('--root', dest='root',
+        help='Measure the builder in this tree')
+    options, args = parser.parse_args()
+    if options.root:
+        sys.path.insert(0, os.path.abspath(options.root))
+
+    from iocbuilder import Configure, records, PP
+    Configure(python_dbd = True)
+    # Create one record first so that the dbd is processed before measuring.
+    records.ai('WARMUP', DESC = 'warm up')
+
+    gc.collect()
+    memory = ResidentMemory()
+    start = time.time()
+    previous = None
+    for i in xrange(options.count):
+        record = records.ai('REC%06d' % i,
+            DESC = 'Record %d' % i, SCAN = '1 second', HOPR = i % 1000)
+        if previous is not None:
+            record.INP = previous.VAL
+            record.FLNK = PP(previous)
+        previous = record
+    elapsed = time.time() - start
+    gc.collect()
+    memory = ResidentMemory() - memory
+
+    print '%d records: %.1f MB, %d bytes and %.1f us per record' % (
+        options.count, memory / 1e6, memory // options.count,
+        elapsed / options.count * 1e6)
+
+
+if __name__ == '__main__':
+    main()
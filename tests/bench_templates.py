@@ -0,0 +1,97 @@
+'''Benchmark of template scanning.
+
+Scans real templates for their macros, as an AutoSubstitution does when it
+is first used, and reports the time taken per template and per line.  Run as
+    python tests/bench_templates.py [-n REPEAT] [--root TREE] [PATH...]
+where each PATH is a template or a directory searched for templates, by
+default the db directories of the modules in IOCBUILDER_TEST_MODULES, and
+TREE is another checkout of the builder to measure, for comparison.'''
+
+import sys
+import os
+import time
+from optparse import OptionParser
+
+import fakebase
+
+
+# Returns the templates found in the given paths.
+def FindTemplates(paths):
+    templates = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                templates.extend([os.path.join(dirpath, filename)
+                    for filename in sorted(filenames)
+                    if filename.endswith(('.template', '.db'))])
+        else:
+            templates.append(path)
+    return templates
+
+
+# Returns the db directories of the modules given in the environment.
+def ModuleDbDirs():
+    return [os.path.join(module, 'db')
+        for module in filter(None,
+            os.environ.get('IOCBUILDER_TEST_MODULES', '').split(':'))]
+
+
+# Returns the time taken to call action on each of the items, repeat times.
+def Time(action, items, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        for item in items:
+            action(item)
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser('usage: %prog [options] [PATH...]')
+    parser.add_option('-n', dest='repeat', type='int', default=20,
+        help='Number of times to scan each template, default %default')
+    parser.add_option('--root', dest='root',
+        help='Measure the builder in this tree')
+    options, args = parser.parse_args()
+    if options.root:
+        sys.path.insert(0, os.path.abspath(options.root))
+
+    templates = FindTemplates(args or ModuleDbDirs())
+    if not templates:
+        parser.error('no templates found, give a PATH or set '
+            'IOCBUILDER_TEST_MODULES')
+
+    from iocbuilder import autosubst
+    if hasattr(autosubst, 'scan_template'):
+        scan = autosubst.scan_template
+    else:
+        # Older trees only scan by populating a class, which must be a fresh
+        # one each time as the results are stored on it.
+        def scan(template):
+            cls = type('Template', (object,),
+                dict(Arguments = None, WarnMacros = False))
+            autosubst.populate_class(cls, template)
+
+    lines = []
+    for template in templates:
+        lines.extend(open(template).readlines())
+
+    # Warnings about the templates are not of interest here.
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        macro_time = Time(autosubst.find_macros, lines, options.repeat)
+        scan_time = Time(scan, templates, options.repeat)
+    finally:
+        sys.stderr = stderr
+
+    print '%d templates, %d lines' % (len(templates), len(lines))
+    print 'find_macros: %.2f us per line' % (
+        macro_time / options.repeat / len(lines) * 1e6)
+    print 'scan: %.1f us per template, %.2f us per line' % (
+        scan_time / options.repeat / len(templates) * 1e6,
+        scan_time / options.repeat / len(lines) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+'''Minimal EPICS installation for running the builder in tests.
+
+Importing this module points EPICS_BASE at a skeleton EPICS base built in a
+temporary directory, unless EPICS_BASE is already set in the environment,
+and puts the builder on the python path.  The skeleton has just enough of
+base for the builder to configure itself with python_dbd: the dbd files
+below and the configure templates copied into every ioc.'''
+
+import sys
+import os
+import shutil
+import tempfile
+import atexit
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+BASE_DBD = '''\
+include "menuScan.dbd"
+recordtype(ai) {
+    include "dbCommon.dbd"
+    field(VAL,DBF_DOUBLE) { prompt("Current EGU Value") }
+    field(INP,DBF_INLINK) { prompt("Input") }
+    field(DTYP,DBF_DEVICE) { prompt("Device Type") }
+    field(HOPR,DBF_SHORT) { prompt("High Operating Range") }
+    field(MDEL,DBF_UCHAR) { prompt("Monitor Deadband") }
+}
+recordtype(stringin) {
+    include "dbCommon.dbd"
+    field(VAL,DBF_STRING) { prompt("Current Value") size(40) }
+    field(DTYP,DBF_DEVICE) { prompt("Device Type") }
+}
+device(ai,CONSTANT,devAiSoft,"Soft Channel")
+device(ai,INST_IO,devAiX,"X")
+'''
+
+COMMON_DBD = '''\
+    field(NAME,DBF_STRING) { prompt("Record Name") special(SPC_NOMOD) size(61) }
+    field(DESC,DBF_STRING) { prompt("Descriptor") size(41) }
+    field(SCAN,DBF_MENU) { prompt("Scan Mechanism") menu(menuScan) }
+    field(FLNK,DBF_FWDLINK) { prompt("Forward Process Link") }
+'''
+
+MENU_SCAN_DBD = '''\
+menu(menuScan) {
+    choice(menuScanPassive,"Passive")
+    choice(menuScan_1_second,"1 second")
+}
+'''
+
+
+## Writes text to the file path, creating its directory if necessary.
+def WriteFile(path, text):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    output = open(path, 'w')
+    try:
+        output.write(text)
+    finally:
+        output.close()
+
+
+## Creates a skeleton EPICS base in directory.
+def MakeEpicsBase(directory):
+    dbd = os.path.join(directory, 'dbd')
+    WriteFile(os.path.join(dbd, 'base.dbd'), BASE_DBD)
+    WriteFile(os.path.join(dbd, 'dbCommon.dbd'), COMMON_DBD)
+    WriteFile(os.path.join(dbd, 'menuScan.dbd'), MENU_SCAN_DBD)
+    WriteFile(os.path.join(dbd, 'system.dbd'), '')
+    configure = os.path.join(
+        directory, 'templates', 'makeBaseApp', 'top', 'configure')
+    for name in ['CONFIG', 'CONFIG_SITE', 'RELEASE', 'RULES', 'RULES_TOP']:
+        WriteFile(os.path.join(configure, name), '# %s\n' % name)
+
+
+## Returns a new temporary directory which is removed at exit.
+def TempDir():
+    directory = tempfile.mkdtemp(prefix = 'iocbuilder-test-')
+    atexit.register(shutil.rmtree, directory, True)
+    return directory
+
+
+if 'EPICS_BASE' not in os.environ:
+    os.environ['EPICS_BASE'] = os.path.join(TempDir(), 'base')
+    MakeEpicsBase(os.environ['EPICS_BASE'])
+EPICS_BASE = os.environ['EPICS_BASE']
+
+
+## Runs the python script in a fresh interpreter, as the builder can only be
+# configured once in each process, and returns its output.  The script is
+# run in directory cwd with the builder on the path, and fails the calling
+# test if it exits with an error.
+def RunScript(script, cwd = None, env = None):
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + filter(None, [environment.get('PYTHONPATH')]))
+    if env:
+        environment.update(env)
+    process = subprocess.Popen(
+        [sys.executable, '-c', script], cwd = cwd, env = environment,
+        stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    output = process.communicate()[0]
+    assert process.returncode == 0, \
+        'Script failed with status %d:\n%s' % (process.returncode, output)
+    return output
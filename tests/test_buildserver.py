@@ -0,0 +1,159 @@
+'''Round trip through the build server: request, zygote, fork and status.'''
+
+import os
+import sys
+import time
+import json
+import socket
+import StringIO
+import subprocess
+import unittest
+
+import fakebase
+
+try:
+    import dls_dependency_tree
+except ImportError:
+    dls_dependency_tree = None
+
+XMLBUILDER = os.path.join(fakebase.ROOT, 'xmlbuilder')
+if XMLBUILDER not in sys.path:
+    sys.path.insert(0, XMLBUILDER)
+
+
+IOC_XML = '''\
+<?xml version="1.0" ?>
+<components arch="linux-x86_64">
+  <records.ai record="%s:AI" DESC="test"/>
+</components>
+'''
+
+SERVER = '''\
+import sys
+sys.path.insert(0, %(xmlbuilder)r)
+import buildserver
+buildserver.BuildServer(%(socket)r).Serve()
+'''
+
+
+class BuildServerTest(unittest.TestCase):
+    def setUp(self):
+        if dls_dependency_tree is None:
+            self.skipTest('dls_dependency_tree not available')
+        self.directory = fakebase.TempDir()
+        self.socket = os.path.join(self.directory, 'server.sock')
+        self.makeIocs = os.path.join(self.directory, 'etc', 'makeIocs')
+        fakebase.WriteFile(
+            os.path.join(self.directory, 'configure', 'RELEASE'),
+            'EPICS_BASE = %s\n' % fakebase.EPICS_BASE)
+        for name in ['TEST-01', 'TEST-02']:
+            fakebase.WriteFile(
+                os.path.join(self.makeIocs, name + '.xml'), IOC_XML % name)
+
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(
+            [fakebase.ROOT] + filter(None, [environment.get('PYTHONPATH')]))
+        self.log = open(os.path.join(self.directory, 'server.log'), 'w')
+        self.server = subprocess.Popen([sys.executable, '-c', SERVER % dict(
+                xmlbuilder = XMLBUILDER, socket = self.socket)],
+            cwd = self.directory, env = environment,
+            stdout = self.log, stderr = subprocess.STDOUT)
+        for i in range(100):
+            if os.path.exists(self.socket):
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        if hasattr(self, 'server'):
+            self.server.kill()
+            self.server.wait()
+            self.log.close()
+
+    # Sends a build request, returning the exit status and output.
+    def Request(self, *argv):
+        import buildserver
+        output = StringIO.StringIO()
+        stdout = sys.stdout
+        cwd = os.getcwd()
+        sys.stdout = output
+        os.chdir(self.makeIocs)
+        try:
+            status = buildserver.request_build(self.socket,
+                ['--python-dbd', '-o', self.directory] + list(argv))
+        finally:
+            sys.stdout = stdout
+            os.chdir(cwd)
+        return status, output.getvalue()
+
+    def Xml(self, name):
+        return os.path.join(self.makeIocs, name + '.xml')
+
+    def Ioc(self, name):
+        return os.path.join(self.directory, name)
+
+    def testBuild(self):
+        status, output = self.Request(self.Xml('TEST-01'))
+        self.assertEqual(status, 0, output)
+        self.assert_(os.path.isfile(
+            os.path.join(self.Ioc('TEST-01'), 'configure', 'RELEASE')))
+        # The second ioc uses the same modules, so is built by the zygote
+        # started for the first.
+        status, output = self.Request(self.Xml('TEST-02'))
+        self.assertEqual(status, 0, output)
+        self.assert_(os.path.isdir(self.Ioc('TEST-02')))
+
+    def testFailure(self):
+        status, output = self.Request(self.Xml('MISSING'))
+        self.assertNotEqual(status, 0)
+
+    def testProfile(self):
+        # Requests sharing a zygote each write their own trace.
+        for name in ['TEST-01', 'TEST-02']:
+            trace = os.path.join(self.directory, name + '.json')
+            status, output = self.Request(
+                '--profile', trace, self.Xml(name))
+            self.assertEqual(status, 0, output)
+            self.assert_('traceEvents' in json.load(open(trace)))
+
+
+
+class StaleSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(fakebase.TempDir(), 'server.sock')
+
+    # Returns a socket bound to the path, listening if listen is set.
+    def Bind(self, listen):
+        bound = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        bound.bind(self.path)
+        if listen:
+            bound.listen(1)
+        return bound
+
+    def testStale(self):
+        import buildserver
+        self.Bind(False).close()
+        buildserver._remove_stale_socket(self.path)
+        self.failIf(os.path.exists(self.path))
+
+    def testRunning(self):
+        import buildserver
+        running = self.Bind(True)
+        try:
+            buildserver._remove_stale_socket(self.path)
+            self.assert_(os.path.exists(self.path))
+        finally:
+            running.close()
+
+    def testNotSocket(self):
+        import buildserver
+        fakebase.WriteFile(self.path, '')
+        buildserver._remove_stale_socket(self.path)
+        self.assert_(os.path.isfile(self.path))
+
+    def testMissing(self):
+        import buildserver
+        buildserver._remove_stale_socket(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+'''Checking the components of an xml ioc without building it.'''
+
+import os
+import unittest
+
+import fakebase
+
+
+BUILDER = '''\
+from iocbuilder import Device
+from iocbuilder.arginfo import *
+
+class Port(Device):
+    def __init__(self, name, speed):
+        self.__super.__init__()
+    ArgInfo = makeArgInfo(__init__,
+        name = Simple('Port name', str),
+        speed = Simple('Baud rate', int))
+
+class User(Device):
+    def __init__(self, name, port):
+        self.__super.__init__()
+    ArgInfo = makeArgInfo(__init__,
+        name = Simple('User name', str),
+        port = Ident('Port used', Port))
+'''
+
+XML = '''\
+<components arch="linux-x86_64">
+  <serial.Port name="good" speed="9600"/>
+  <serial.Port name="bad" speed="fast"/>
+  <serial.User name="u1" port="good"/>
+  <serial.User name="u2" port="bad"/>
+  <serial.User name="u3" port="later"/>
+  <serial.Port name="later" speed="9600"/>
+  <serial.User name="u4" port="u1"/>
+  <serial.Missing name="m"/>
+</components>
+'''
+
+SCRIPT = '''\
+import iocbuilder
+iocbuilder.Configure(python_dbd = True)
+from iocbuilder import ModuleVersion, includeXml
+ModuleVersion('serial', home = %(home)r, use_name = False)
+for error in includeXml.checkXml(%(xml)r):
+    print error
+'''
+
+
+class CheckXmlTest(unittest.TestCase):
+    def testErrors(self):
+        home = os.path.join(fakebase.TempDir(), 'serial')
+        fakebase.WriteFile(os.path.join(home, 'etc', 'builder.py'), BUILDER)
+        output = fakebase.RunScript(SCRIPT % dict(home = home, xml = XML))
+        self.assertEqual(output.splitlines(), [
+            'component 2 <serial.Port> "bad": Invalid value "fast" for speed: '
+                'invalid literal for int() with base 10: \'fast\'',
+            'component 4 <serial.User> "u2": Refers to "bad" which has errors',
+            'component 5 <serial.User> "u3": port refers to "later" before '
+                'it is defined',
+            'component 7 <serial.User> "u4": port refers to "u1" which is a '
+                'serial.User, not a Port',
+            'component 8 <serial.Missing> "m": Can\'t find object '
+                '"serial.Missing"'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+'''The dbd cache must not change how dbd files are read.'''
+
+import os
+import unittest
+
+import fakebase
+
+
+SCRIPT = '''\
+from iocbuilder import *
+from iocbuilder import dbd
+Configure(python_dbd = %(python_dbd)r, cache_path = %(cache)r)
+print records.ai._validate.__class__.__name__
+print sorted(records.ai.FieldInfo())
+'''
+
+
+class DbdCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = os.path.join(fakebase.TempDir(), 'cache')
+
+    def Run(self, python_dbd):
+        return fakebase.RunScript(SCRIPT % dict(
+            python_dbd = python_dbd, cache = self.cache))
+
+    def testPythonDbdCached(self):
+        first = self.Run(True)
+        self.assert_(os.path.exists(os.path.join(self.cache, 'dbd.cache')))
+        self.assertEqual(first.split()[0], 'PyValidateDbField')
+        self.assertEqual(self.Run(True), first)
+
+    def testCacheKeepsLibDbStatic(self):
+        from test_dbd_verify import _LibDbStatic
+        if _LibDbStatic() is None:
+            self.skipTest('libdbStaticHost not found in EPICS_BASE')
+        output = self.Run(False)
+        self.assertEqual(output.split()[0], 'ValidateDbField')
+        self.failIf(os.path.exists(os.path.join(self.cache, 'dbd.cache')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+'''Dbd files are found as dbReadDatabase finds them from their directory.'''
+
+import os
+import unittest
+
+import fakebase
+import iocbuilder
+from iocbuilder import dbd
+
+
+TOP_DBD = '''\
+include "sub/inc.dbd"
+path "sub"
+include "plain.dbd"
+'''
+
+
+class DbdPathTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = fakebase.TempDir()
+        self.top = os.path.join(self.directory, 'top.dbd')
+        self.inc = os.path.join(self.directory, 'sub', 'inc.dbd')
+        self.plain = os.path.join(self.directory, 'sub', 'plain.dbd')
+        fakebase.WriteFile(self.top, TOP_DBD)
+        fakebase.WriteFile(self.inc,
+            'recordtype(inc) {\n'
+            '    field(NAME,DBF_STRING) { prompt("Record Name") size(61) }\n'
+            '}\n')
+        fakebase.WriteFile(self.plain, '')
+        # The files must not be found from the working directory.
+        self.assertNotEqual(os.getcwd(), self.directory)
+
+    def testIncludes(self):
+        definitions, files = dbd.ReadDbdFile(
+            'top.dbd', [self.directory], self.directory)
+        self.assertEqual(files, [self.top, self.inc, self.plain])
+        self.assert_('inc' in definitions.recordtypes)
+
+    def testDirectoryPart(self):
+        definitions, files = dbd.ReadDbdFile(
+            'sub/inc.dbd', [], self.directory)
+        self.assertEqual(files, [self.inc])
+
+    def testListed(self):
+        files = []
+        dbd._ScanDbdFiles('top.dbd', [self.directory], self.directory, files)
+        self.assertEqual(files, [self.top, self.inc, self.plain])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+'''Stress test of dbd files loaded from several threads at once.'''
+
+import os
+import unittest
+
+import fakebase
+
+
+RECORD_DBD = '''\
+recordtype(%(name)s) {
+    include "dbCommon.dbd"
+    field(VAL,DBF_LONG) { prompt("Value") }
+    field(DTYP,DBF_DEVICE) { prompt("Device Type") }
+    field(X%(index)d,DBF_STRING) { prompt("Field %(index)d") size(20) }
+}
+device(%(name)s,CONSTANT,dev%(name)s,"Soft %(index)d")
+'''
+
+SCRIPT = '''\
+import os
+import sys
+import threading
+from iocbuilder import *
+from iocbuilder import dbd
+Configure(python_dbd = %(python_dbd)r)
+
+# Switch threads as often as possible to expose any races.
+sys.setcheckinterval(1)
+
+# Count the times each record type is published.
+published = []
+publish = dbd.RecordTypes._PublishRecordType
+def counting_publish(device, recordType, validate):
+    published.append(recordType)
+    publish(device, recordType, validate)
+dbd.RecordTypes._PublishRecordType = staticmethod(counting_publish)
+
+class Device:
+    @staticmethod
+    def _AutoInstantiate():
+        pass
+
+cwd = os.getcwd()
+loaded = len(dbd.LoadedDbdFiles)
+generation = dbd._generation
+errors = []
+start = threading.Event()
+
+def load(thread):
+    start.wait()
+    try:
+        for index in range(%(files)d):
+            # Each thread loads the files in a different order.
+            index = (index + thread) %% %(files)d
+            dbd.LoadDbdFile(Device,
+                os.path.join(%(directory)r, 'mod%%d' %% index, 'dbd'),
+                'rec%%d.dbd' %% index)
+    except Exception, error:
+        errors.append(error)
+
+threads = [threading.Thread(target = load, args = (thread,))
+    for thread in range(%(threads)d)]
+for thread in threads:
+    thread.start()
+start.set()
+for thread in threads:
+    thread.join()
+
+assert not errors, errors
+assert os.getcwd() == cwd
+assert len(dbd.LoadedDbdFiles) == loaded + %(threads)d * %(files)d
+assert dbd._generation == generation + %(threads)d * %(files)d
+assert sorted(published) == sorted(
+    'rec%%d' %% index for index in range(%(files)d)), sorted(published)
+for index in range(%(files)d):
+    record = getattr(records, 'rec%%d' %% index)
+    fields = record.FieldInfo()
+    assert 'X%%d' %% index in fields and 'DESC' in fields, sorted(fields)
+    assert len([f for f in fields if f.startswith('X')]) == 1
+    r = record('R%%d' %% index, DESC = 'test', DTYP = 'Soft %%d' %% index)
+print 'ok'
+'''
+
+
+class DbdThreadsTest(unittest.TestCase):
+    Threads = 8
+    Files = 50
+
+    def setUp(self):
+        self.directory = fakebase.TempDir()
+        for index in range(self.Files):
+            name = 'rec%d' % index
+            fakebase.WriteFile(os.path.join(self.directory,
+                    'mod%d' % index, 'dbd', name + '.dbd'),
+                RECORD_DBD % dict(name = name, index = index))
+
+    def Run(self, python_dbd):
+        return fakebase.RunScript(SCRIPT % dict(
+            python_dbd = python_dbd, directory = self.directory,
+            threads = self.Threads, files = self.Files))
+
+    def testPythonDbd(self):
+        self.assertEqual(self.Run(True).split()[-1], 'ok')
+
+    def testLibDbStatic(self):
+        from test_dbd_verify import _LibDbStatic
+        if _LibDbStatic() is None:
+            self.skipTest('libdbStaticHost not found in EPICS_BASE')
+        self.assertEqual(self.Run(False).split()[-1], 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
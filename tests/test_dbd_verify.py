@@ -0,0 +1,228 @@
+'''Conformance of the Python field validator with dbVerify.
+
+CORPUS lists values written to fields of every dbd field type together with
+the message dbVerify() in libdbStaticHost returns for them, None if the
+value is accepted.  The Python validator is always checked against the
+corpus.  If libdbStaticHost can be loaded from EPICS_BASE the corpus is
+also checked against dbVerify itself.'''
+
+import os
+import unittest
+
+import fakebase
+import iocbuilder
+from iocbuilder import dbd, mydbstatic, paths
+
+
+CONFORM_DBD = '''\
+menu(menuTest) {
+    choice(menuTestA,"Alpha")
+    choice(menuTestB,"Beta")
+}
+recordtype(conform) {
+    field(NAME,DBF_STRING) { prompt("Record Name") size(61) }
+    field(STR,DBF_STRING) { prompt("String") size(10) }
+    field(CHR,DBF_CHAR) { prompt("Char") }
+    field(UCHR,DBF_UCHAR) { prompt("Unsigned char") }
+    field(SHRT,DBF_SHORT) { prompt("Short") }
+    field(USHT,DBF_USHORT) { prompt("Unsigned short") }
+    field(LNG,DBF_LONG) { prompt("Long") }
+    field(ULNG,DBF_ULONG) { prompt("Unsigned long") }
+    field(ENM,DBF_ENUM) { prompt("Enum") }
+    field(FLT,DBF_FLOAT) { prompt("Float") }
+    field(DBL,DBF_DOUBLE) { prompt("Double") }
+    field(MENU,DBF_MENU) { prompt("Menu") menu(menuTest) }
+    field(DTYP,DBF_DEVICE) { prompt("Device Type") }
+    field(INP,DBF_INLINK) { prompt("Input link") }
+    field(OUT,DBF_OUTLINK) { prompt("Output link") }
+    field(FLNK,DBF_FWDLINK) { prompt("Forward link") }
+    field(PRIV,DBF_NOACCESS) { prompt("Private") extra("void *priv") }
+}
+recordtype(nodevice) {
+    field(NAME,DBF_STRING) { prompt("Record Name") size(61) }
+    field(DTYP,DBF_DEVICE) { prompt("Device Type") }
+}
+device(conform,CONSTANT,devConformSoft,"Soft Channel")
+device(conform,INST_IO,devConformRaw,"Raw Soft Channel")
+'''
+
+NOT_INTEGER = 'not an integer number'
+NOT_NUMBER = 'not a number'
+NOT_CHOICE = 'Not a valid menu choice'
+
+# (record type, field, value, message returned by dbVerify)
+CORPUS = [
+    ('conform', 'STR', '', None),
+    ('conform', 'STR', 'abc', None),
+    ('conform', 'STR', '123456789', None),
+    ('conform', 'STR', '1234567890', 'string to big. max=10'),
+    ('conform', 'STR', '$(P)1234567890', None),
+    ('conform', 'STR', '${P}1234567890', None),
+
+    ('conform', 'CHR', '', None),
+    ('conform', 'CHR', '127', None),
+    ('conform', 'CHR', '-128', None),
+    ('conform', 'CHR', '+3', None),
+    ('conform', 'CHR', ' 5', None),
+    ('conform', 'CHR', '0x7f', None),
+    ('conform', 'CHR', '010', None),
+    ('conform', 'CHR', '128', 'must have -128<=value<=127'),
+    ('conform', 'CHR', '-129', 'must have -128<=value<=127'),
+    ('conform', 'CHR', '0x80', 'must have -128<=value<=127'),
+    ('conform', 'CHR', '5 ', NOT_INTEGER),
+    ('conform', 'CHR', '5\n', NOT_INTEGER),
+    ('conform', 'CHR', '08', NOT_INTEGER),
+    ('conform', 'CHR', '0x', NOT_INTEGER),
+    ('conform', 'CHR', '1.5', NOT_INTEGER),
+    ('conform', 'CHR', 'abc', NOT_INTEGER),
+
+    ('conform', 'UCHR', '255', None),
+    ('conform', 'UCHR', '-0', None),
+    ('conform', 'UCHR', '256', 'must have 0<=value<=255'),
+    ('conform', 'UCHR', '-1', 'must have 0<=value<=255'),
+
+    ('conform', 'SHRT', '32767', None),
+    ('conform', 'SHRT', '-32768', None),
+    ('conform', 'SHRT', '32768', 'must have -32768<=value<=32767'),
+    ('conform', 'SHRT', '-32769', 'must have -32768<=value<=32767'),
+
+    ('conform', 'USHT', '65535', None),
+    ('conform', 'USHT', '65536', 'must have 0<=value<=65535'),
+    ('conform', 'ENM', '65535', None),
+    ('conform', 'ENM', '65536', 'must have 0<=value<=65535'),
+
+    ('conform', 'LNG', '2147483647', None),
+    ('conform', 'LNG', '-2147483648', None),
+    ('conform', 'LNG', '12x', NOT_INTEGER),
+    ('conform', 'ULNG', '4294967295', None),
+    ('conform', 'ULNG', '-1', None),
+    ('conform', 'ULNG', 'x', NOT_INTEGER),
+
+    ('conform', 'DBL', '', None),
+    ('conform', 'DBL', '1.5', None),
+    ('conform', 'DBL', '-.5', None),
+    ('conform', 'DBL', '1e3', None),
+    ('conform', 'DBL', ' 2', None),
+    ('conform', 'DBL', '5.', None),
+    ('conform', 'DBL', 'inf', None),
+    ('conform', 'DBL', '-Infinity', None),
+    ('conform', 'DBL', 'nan', None),
+    ('conform', 'DBL', '0x1p3', None),
+    ('conform', 'DBL', '1.5x', NOT_NUMBER),
+    ('conform', 'DBL', '1.5\n', NOT_NUMBER),
+    ('conform', 'DBL', '1e', NOT_NUMBER),
+    ('conform', 'DBL', '.', NOT_NUMBER),
+    ('conform', 'FLT', '3.25', None),
+    ('conform', 'FLT', 'three', NOT_NUMBER),
+
+    ('conform', 'MENU', 'Alpha', None),
+    ('conform', 'MENU', 'Beta', None),
+    ('conform', 'MENU', 'Gamma', NOT_CHOICE),
+    ('conform', 'MENU', 'alpha', NOT_CHOICE),
+    ('conform', 'MENU', '', NOT_CHOICE),
+    ('conform', 'MENU', '$(SCAN)', None),
+
+    ('conform', 'DTYP', 'Soft Channel', None),
+    ('conform', 'DTYP', 'Raw Soft Channel', None),
+    ('conform', 'DTYP', 'Raw', NOT_CHOICE),
+    ('conform', 'DTYP', '', NOT_CHOICE),
+    # A record type without device support accepts anything
+    ('nodevice', 'DTYP', 'Soft Channel', None),
+    ('nodevice', 'DTYP', '', None),
+
+    ('conform', 'INP', 'OTHER:PV CP MS', None),
+    ('conform', 'INP', '@anything at all', None),
+    ('conform', 'OUT', '', None),
+    ('conform', 'FLNK', 'OTHER:PV', None),
+
+    ('conform', 'PRIV', 'x', 'Not a legal field type'),
+]
+
+
+# Returns the path of libdbStaticHost in EPICS_BASE, or None if it can't be
+# found.
+def _LibDbStatic():
+    lib = os.path.join(fakebase.EPICS_BASE, 'lib')
+    if os.path.isdir(lib):
+        for arch in os.listdir(lib):
+            path = os.path.join(lib, arch, 'libdbStaticHost.so')
+            if os.path.exists(path):
+                return path
+    return None
+
+
+class PythonValidatorTest(unittest.TestCase):
+    def setUp(self):
+        directory = fakebase.TempDir()
+        fakebase.WriteFile(
+            os.path.join(directory, 'conform.dbd'), CONFORM_DBD)
+        self.definitions, _ = dbd.ReadDbdFile('conform.dbd', [directory])
+
+    def Validator(self, recordType):
+        return dbd.PyValidateDbField(self.definitions, recordType)
+
+    def testCorpus(self):
+        validators = {}
+        for recordType, field, value, message in CORPUS:
+            if recordType not in validators:
+                validators[recordType] = self.Validator(recordType)
+            validate = validators[recordType]
+            validate.ValidNamesSet()
+            self.assertEqual(validate._Verify(field, value), message,
+                '%s.%s = %r' % (recordType, field, value))
+
+    def testMissingMenu(self):
+        # dbVerify accepts any value for a menu field whose menu has not
+        # been defined.  libdbStaticHost refuses to load such a file, so
+        # this case is not part of the corpus.
+        directory = fakebase.TempDir()
+        fakebase.WriteFile(os.path.join(directory, 'missing.dbd'),
+            'recordtype(missing) {\n'
+            '    field(MENU,DBF_MENU) { prompt("Menu") menu(menuNone) }\n'
+            '}\n')
+        definitions, _ = dbd.ReadDbdFile('missing.dbd', [directory])
+        validate = dbd.PyValidateDbField(definitions, 'missing')
+        self.assertEqual(validate._Verify('MENU', 'anything'), None)
+
+    def testValidFieldValue(self):
+        validate = self.Validator('conform')
+        validate.ValidFieldValue('CHR', '12')
+        self.assertRaises(AssertionError, validate.ValidFieldValue, 'CHR', 'x')
+        self.assertRaises(AttributeError, validate.ValidFieldValue, 'NONE', '')
+
+
+class LibDbStaticTest(unittest.TestCase):
+    def setUp(self):
+        if _LibDbStatic() is None:
+            self.skipTest('libdbStaticHost not found in EPICS_BASE')
+
+    def testCorpus(self):
+        import ctypes
+        paths.EPICS_BASE = fakebase.EPICS_BASE
+        mydbstatic.ImportFunctions()
+        directory = fakebase.TempDir()
+        fakebase.WriteFile(
+            os.path.join(directory, 'conform.dbd'), CONFORM_DBD)
+        db = ctypes.c_void_p()
+        status = mydbstatic.dbReadDatabase(
+            ctypes.byref(db), 'conform.dbd', directory, None)
+        self.assertEqual(status, 0)
+
+        validators = {}
+        entry = mydbstatic.dbAllocEntry(db)
+        status = mydbstatic.dbFirstRecordType(entry)
+        while status == 0:
+            recordType = mydbstatic.dbGetRecordTypeName(entry)
+            validators[recordType] = dbd.ValidateDbField(entry)
+            status = mydbstatic.dbNextRecordType(entry)
+        mydbstatic.dbFreeEntry(entry)
+
+        for recordType, field, value, message in CORPUS:
+            validate = validators[recordType]
+            validate.ValidNamesSet()
+            self.assertEqual(validate._Verify(field, value), message,
+                '%s.%s = %r' % (recordType, field, value))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+'''The auto_* substitutions only scan their templates when first used.'''
+
+import os
+import unittest
+
+import fakebase
+
+
+TEMPLATE = '''\
+# %% macro, __doc__, The %(name)s template
+# %% macro, P, Device prefix
+record(ai, "$(P):%(name)s") {}
+'''
+
+SCRIPT = '''\
+import iocbuilder
+iocbuilder.Configure(python_dbd = True)
+from iocbuilder import ModuleVersion, AutoSubstitution, includeXml
+module = ModuleVersion('lazy', home = %(home)r, use_name = False)
+AutoSubstitution.fromModuleVersion(module)
+from iocbuilder.modules import lazy
+
+def scanned():
+    return [bool(getattr(lazy, 'auto_' + name).__dict__.get('Scanned'))
+        for name in ['doc', 'arguments', 'arginfo', 'unused']]
+
+lookup = includeXml.createClassLookup()
+print scanned()
+print lazy.auto_doc.__doc__
+print lazy.auto_arguments.Arguments
+print lazy.auto_arginfo.ArgInfo.required_names
+print scanned()
+'''
+
+
+class LazyScanTest(unittest.TestCase):
+    def testScannedOnLookup(self):
+        home = os.path.join(fakebase.TempDir(), 'lazy')
+        fakebase.WriteFile(os.path.join(home, 'etc', 'builder.py'), '')
+        for name in ['doc', 'arguments', 'arginfo', 'unused']:
+            fakebase.WriteFile(
+                os.path.join(home, 'db', name + '.template'),
+                TEMPLATE % dict(name = name))
+        output = fakebase.RunScript(SCRIPT % dict(home = home))
+        self.assertEqual(output.splitlines(), [
+            '[False, False, False, False]',
+            'The doc template',
+            "['P']",
+            "['P']",
+            '[True, True, True, False]'])
+
+
+if __name__ == '__main__':
+    unittest.main()
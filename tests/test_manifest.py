@@ -0,0 +1,124 @@
+'''The manifest records every input and setting which shapes the IOC.'''
+
+import os
+import json
+import unittest
+
+import fakebase
+
+
+SCRIPT = '''\
+import iocbuilder
+from iocbuilder import ConfigureIOC, ParseRelease, iocwriter
+ConfigureIOC(architecture = 'linux-x86_64', python_dbd = True)
+
+class Tree:
+    def __init__(self, parent, release, warnings):
+        self.macros = {}
+        self.leaves = []
+
+class Options:
+    build_root = 'etc/makeIocs'
+    iocname = 'TEST'
+    architecture = 'linux-x86_64'
+    debug = False
+    ioc_writer = iocwriter.DiamondIocWriter
+
+ParseRelease(Options(), Tree)
+iocbuilder.IocDataFile('data.proto')
+iocbuilder.WriteNamedIoc('ioc', 'TEST')
+'''
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = fakebase.TempDir()
+        fakebase.WriteFile(
+            os.path.join(self.directory, 'data.proto'), 'protocol\\n')
+        os.makedirs(os.path.join(self.directory, 'etc', 'makeIocs'))
+        fakebase.RunScript(SCRIPT, cwd = self.directory)
+        from iocbuilder import manifest
+        self.manifest = json.load(open(
+            os.path.join(self.directory, 'ioc', manifest.ManifestFile)))
+        self.inputs = [filename for filename, _ in self.manifest['inputs']]
+        self.ioc = os.path.join(self.directory, 'ioc')
+
+    def testDataFiles(self):
+        self.assert_(
+            os.path.join(self.directory, 'data.proto') in self.inputs)
+
+    def testDbdIncludes(self):
+        dbd = os.path.join(fakebase.EPICS_BASE, 'dbd')
+        for filename in ['base.dbd', 'dbCommon.dbd', 'menuScan.dbd']:
+            self.assert_(os.path.join(dbd, filename) in self.inputs)
+
+    def testConfigureFiles(self):
+        configure = os.path.join(fakebase.EPICS_BASE,
+            'templates', 'makeBaseApp', 'top', 'configure')
+        for filename in ['CONFIG', 'CONFIG_SITE', 'RULES', 'RULES_TOP']:
+            self.assert_(os.path.join(configure, filename) in self.inputs)
+
+    def testSettings(self):
+        settings = self.manifest['settings']
+        self.assertEqual(settings['python_dbd'], True)
+        self.assertEqual(settings['internal_msi'], False)
+        self.assertEqual(settings['simulation'], False)
+
+    def testUpToDate(self):
+        from iocbuilder.manifest import IocUpToDate
+        self.assert_(IocUpToDate(self.ioc, python_dbd = True))
+        self.failIf(IocUpToDate(self.ioc, internal_msi = True))
+        fakebase.WriteFile(
+            os.path.join(self.directory, 'data.proto'), 'changed\\n')
+        self.failIf(IocUpToDate(self.ioc))
+
+    def testMissingInputCreated(self):
+        from iocbuilder.manifest import IocUpToDate
+        extra_release = os.path.join(
+            self.directory, 'etc', 'makeIocs', 'TEST_RELEASE')
+        self.assert_([extra_release, None] in self.manifest['inputs'])
+        self.assert_(IocUpToDate(self.ioc))
+        fakebase.WriteFile(extra_release, 'SUPPORT = /other/support\n')
+        self.failIf(IocUpToDate(self.ioc))
+
+    def testOutputEdited(self):
+        from iocbuilder.manifest import IocUpToDate
+        filename, _ = self.manifest['outputs'][0]
+        output = open(os.path.join(self.ioc, filename), 'a')
+        output.write('# edited\n')
+        output.close()
+        self.failIf(IocUpToDate(self.ioc))
+
+
+TEMPLATE_SCRIPT = '''\
+import iocbuilder
+from iocbuilder import ConfigureIOC, ModuleVersion, AutoSubstitution
+ConfigureIOC(architecture = 'linux-x86_64', python_dbd = True)
+AutoSubstitution.fromModuleVersion(
+    ModuleVersion('templates', home = %(home)r, use_name = False))
+from iocbuilder.modules import templates
+templates.auto_outer(P = 'TEST')
+iocbuilder.WriteNamedIoc('ioc', 'TEST')
+'''
+
+
+class TemplateInputsTest(unittest.TestCase):
+    def testExternalMsi(self):
+        # The includes of templates expanded by msi are not looked for.
+        directory = fakebase.TempDir()
+        home = os.path.join(directory, 'templates')
+        fakebase.WriteFile(os.path.join(home, 'etc', 'builder.py'), '')
+        outer = os.path.join(home, 'db', 'outer.template')
+        fakebase.WriteFile(outer,
+            'record(ai, "$(P)") {}\ninclude "missing.template"\n')
+        output = fakebase.RunScript(
+            TEMPLATE_SCRIPT % dict(home = home), cwd = directory)
+        self.failIf('Can\'t open' in output, output)
+        from iocbuilder import manifest
+        inputs = [filename for filename, _ in json.load(open(os.path.join(
+            directory, 'ioc', manifest.ManifestFile)))['inputs']]
+        self.assert_(outer in inputs)
+
+
+if __name__ == '__main__':
+    unittest.main()
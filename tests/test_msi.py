@@ -0,0 +1,158 @@
+'''Template expansion in process compared with msi.
+
+Each entry of CORPUS gives a template, the macro values it is expanded
+with and the expansion produced by msi.  Expansion in process is always
+checked against the corpus.  If msi is on the path the corpus, together
+with any templates found in the db directories of the modules listed in
+IOCBUILDER_TEST_MODULES (a colon separated list of module paths), is also
+expanded by msi and the results compared.'''
+
+import os
+import subprocess
+import unittest
+from distutils.spawn import find_executable
+
+import fakebase
+import iocbuilder
+from iocbuilder import msi
+from iocbuilder.recordset import QuoteArgument
+
+
+# (template, macros, expansion)
+CORPUS = [
+    ('$(A)\n', dict(A = '1'), '1\n'),
+    ('${A}\n', dict(A = '1'), '1\n'),
+    ('$(U)\n', dict(), '$(U)\n'),
+    ('$(U=d)\n', dict(), 'd\n'),
+    ('$(U="a b")\n', dict(), 'a b\n'),
+    ('"$(A)" \'$(A)\'\n', dict(A = '1'), '"1" \'$(A)\'\n'),
+    ('a\\$(A)\n', dict(A = '1'), 'a\\$(A)\n'),
+    ('no newline $(A)', dict(A = '1'), 'no newline 1'),
+    # Quotes and escapes are removed from values wherever they are used
+    ('$(A)|$(A,Z=1)|$(X=$(A))\n',
+        dict(A = 'a\\b "q"'), 'ab q|ab q|ab q\n'),
+    ('field(DESC, "$(DESC)")\n',
+        dict(DESC = 'say "hi", ok'), 'field(DESC, "say hi, ok")\n'),
+    ('$(A)\n', dict(A = "it's"), 'its\n'),
+    ('$(A)\n', dict(A = 'a,b=c'), 'a,b=c\n'),
+    ('$(B)\n', dict(A = '"1"', B = 'x$(A)y'), 'x1y\n'),
+    ('$($(N))\n', dict(N = 'A', A = 'v'), 'v\n'),
+    ('$(A,B=2)|$(A)\n', dict(A = '$(B)', B = '1'), '2|1\n'),
+    ('$(A)\n', dict(A = '$(A)'), '$(A,recursive)\n'),
+    ('substitute "A=5"\n$(A)\n', dict(A = '1'), '5\n'),
+]
+
+# (line, command) pairs for the include and substitute commands, where
+# command is the (name, argument) pair recognised or None for a text line.
+COMMANDS = [
+    ('include "x.db"\n', ('include', 'x.db')),
+    ('  include  "x.db"  \n', ('include', 'x.db')),
+    ('include "x.db"', ('include', 'x.db')),
+    ('include "x.db"  # comment\n', ('include', 'x.db')),
+    ('include "x.db" "y.db"\n', ('include', 'x.db')),
+    ('include "a\\"b"\n', ('include', 'a\\"b')),
+    ('include ""\n', ('include', '')),
+    ('substitute "A=1,B=2"\n', ('substitute', 'A=1,B=2')),
+    ('substitute"A=1"\n', ('substitute', 'A=1')),
+    ('include x.db\n', None),
+    ('include "x.db\n', None),
+    ('record(ai, "include")\n', None),
+    ('# include "x.db"\n', None),
+    ('included "x.db"\n', None),
+    ('$(include) "x.db"\n', None),
+]
+
+
+# Returns the expansion of template_file by msi.
+def _RunMsi(template_file, macros, includes = []):
+    command = [find_executable('msi')] + \
+        ['-I%s' % include for include in includes] + \
+        ['-M%s=%s' % (name, QuoteArgument(value))
+            for name, value in sorted(macros.items())] + [template_file]
+    process = subprocess.Popen(command,
+        stdout = subprocess.PIPE, stderr = open(os.devnull, 'w'))
+    return process.communicate()[0]
+
+# Returns the template files of the modules given in the environment.
+def _ModuleTemplates():
+    templates = []
+    for module in filter(None,
+            os.environ.get('IOCBUILDER_TEST_MODULES', '').split(':')):
+        db = os.path.join(module, 'db')
+        if os.path.isdir(db):
+            templates.extend([os.path.join(db, filename)
+                for filename in sorted(os.listdir(db))
+                if filename.endswith('.template')])
+    return templates
+
+
+class ExpandTest(unittest.TestCase):
+    def testDefault(self):
+        # msi is run unless expansion in process is asked for.
+        self.assert_(msi.ExternalMsi)
+
+    def testCorpus(self):
+        for template, macros, expected in CORPUS:
+            self.assertEqual(
+                msi.Template(template).Expand(msi.Macros(macros)), expected,
+                '%r with %r' % (template, macros))
+
+    def testCommands(self):
+        for line, command in COMMANDS:
+            self.assertEqual(msi._ParseCommand(line), command, repr(line))
+
+    def testIncludeWithComment(self):
+        directory = fakebase.TempDir()
+        fakebase.WriteFile(os.path.join(directory, 'inner.template'),
+            'inner $(A)\n')
+        template = msi.Template(
+            'include "inner.template"  # the inner records\n', [directory])
+        self.assertEqual(template.Expand(msi.Macros(dict(A = '1'))),
+            'inner 1\n')
+
+    def testInclude(self):
+        directory = fakebase.TempDir()
+        fakebase.WriteFile(os.path.join(directory, 'inner.template'),
+            'inner $(A)\n')
+        fakebase.WriteFile(os.path.join(directory, 'outer.template'),
+            'outer $(A)\ninclude "inner.template"\n')
+        self.assertEqual(
+            msi.ExpandFile(os.path.join(directory, 'outer.template'),
+                dict(A = '1'), [directory]),
+            'outer 1\ninner 1\n')
+
+
+class MsiConformanceTest(unittest.TestCase):
+    def setUp(self):
+        if find_executable('msi') is None:
+            self.skipTest('msi not found on the path')
+
+    def testCorpus(self):
+        directory = fakebase.TempDir()
+        template_file = os.path.join(directory, 'test.template')
+        for template, macros, expected in CORPUS:
+            fakebase.WriteFile(template_file, template)
+            self.assertEqual(
+                msi.ExpandFile(template_file, macros),
+                _RunMsi(template_file, macros),
+                '%r with %r' % (template, macros))
+
+    def testModuleTemplates(self):
+        # Every macro is given a value containing quotes and escapes.
+        for template_file in _ModuleTemplates():
+            parsed = msi.ReadTemplate(template_file)
+            names = set()
+            for command, argument in parsed.commands:
+                if command == 'text':
+                    for part in argument:
+                        if isinstance(part, tuple) and part[1]:
+                            names.add(part[1])
+            macros = dict((name, '%s "v" \\\\x' % name) for name in names)
+            includes = [os.path.dirname(template_file)]
+            self.assertEqual(
+                msi.ExpandFile(template_file, macros, includes),
+                _RunMsi(template_file, macros, includes), template_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
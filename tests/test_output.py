@@ -0,0 +1,46 @@
+'''Writing generated files through an OutputFileSet.'''
+
+import os
+import sys
+import unittest
+
+import fakebase
+import iocbuilder
+from iocbuilder import support, iocwriter
+
+
+# Writes to stdout in the ways builder code does.
+def _Writer():
+    print 'first line'
+    sys.stdout.flush()
+    sys.stdout.writelines(['second line\n', 'third line\n'])
+    print >> sys.stdout, 'fourth', 'line'
+
+
+class OutputFileSetTest(unittest.TestCase):
+    def setUp(self):
+        self.root = fakebase.TempDir()
+        self.file_set = support.OutputFileSet(self.root)
+        support.SetOutputFileSet(self.file_set)
+
+    def tearDown(self):
+        support.SetOutputFileSet(None)
+
+    def Write(self, **argk):
+        stdout = sys.stdout
+        iocwriter.WriteFile(os.path.join(self.root, 'out.txt'), _Writer,
+            header = None, **argk)
+        self.assert_(sys.stdout is stdout)
+        return dict(self.file_set.Files())['out.txt']
+
+    def testRedirect(self):
+        self.assertEqual(self.Write(),
+            'first line\nsecond line\nthird line\nfourth line\n')
+
+    def testRedirectCheckingLength(self):
+        self.assertEqual(self.Write(maxLineLength = 20),
+            'first line\nsecond line\nthird line\nfourth line\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
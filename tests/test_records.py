@@ -0,0 +1,47 @@
+'''Record instances and the links made to them.'''
+
+import unittest
+
+import fakebase
+
+
+SCRIPT = '''\
+from iocbuilder import *
+from iocbuilder import recordbase, recordset
+Configure(python_dbd = True)
+
+a = records.ai('A', DESC = 'first')
+b = records.ai('B', INP = a.VAL, FLNK = PP(a))
+assert not hasattr(a, '__dict__')
+assert a.VAL is a.VAL and b.INP.Value() is a.VAL
+assert PP(a) is PP(a) and PP(a) is not a()
+assert str(a.VAL) == 'A.VAL' and str(CP(a.VAL)) == 'A.VAL CP'
+assert str(PP(MS(a))) == 'A MS PP'
+assert b.FLNK.Value() is PP(a)
+try:
+    a.NOTAFIELD
+except AttributeError:
+    pass
+else:
+    assert False, 'Invalid field accepted'
+
+imported = ImportRecord('OTHER')
+assert imported.VAL is imported.VAL and str(NP(imported)) == 'OTHER NPP'
+
+import cPickle
+link = cPickle.loads(cPickle.dumps(CP(a.VAL)))
+assert str(link) == 'A.VAL CP' and isinstance(link.record, ImportRecord)
+
+recordset.Reset()
+assert not recordbase._links
+print 'ok'
+'''
+
+
+class RecordTest(unittest.TestCase):
+    def testLinks(self):
+        self.assertEqual(fakebase.RunScript(SCRIPT).split()[-1], 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
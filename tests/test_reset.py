@@ -0,0 +1,97 @@
+'''Resetting the builder between IOCs must leave it as it was configured.'''
+
+import os
+import unittest
+
+import fakebase
+
+
+CLEAN_BUILDER = '''\
+from iocbuilder import ModuleBase
+
+class Clean(ModuleBase):
+    def __init__(self, name):
+        self.__super.__init__()
+        self.name = name
+'''
+
+DIRTY_BUILDER = '''\
+from iocbuilder import ModuleBase
+
+names = []
+
+class Dirty(ModuleBase):
+    def __init__(self, name):
+        self.__super.__init__()
+        names.append(name)
+'''
+
+MODULE_SCRIPT = '''\
+from iocbuilder import *
+Configure(python_dbd = True)
+ModuleVersion('clean', home = %(clean)r, use_name = False)
+ModuleVersion('dirty', home = %(dirty)r, use_name = False)
+from iocbuilder.modules import clean, dirty
+print ResetIoc()
+clean.Clean('a')
+print ResetIoc()
+dirty.Dirty('a')
+print ResetIoc()
+'''
+
+WRITER_SCRIPT = '''\
+from iocbuilder import *
+from iocbuilder import iocwriter
+Configure(python_dbd = True)
+
+class Tree:
+    def __init__(self, parent, release, warnings):
+        self.macros = dict(SUPPORT = '/other/support')
+        self.leaves = []
+
+class Options:
+    build_root = %(build_root)r
+    iocname = 'TEST'
+    architecture = 'linux-x86_64'
+    debug = False
+    ioc_writer = iocwriter.DiamondIocWriter
+
+writer = iocwriter.DiamondIocWriter
+macros = dict(writer.macros)
+common = writer.WINDOWS_RELEASE_COMMON
+ParseRelease(Options(), Tree)
+print writer.macros['SUPPORT'], writer.WINDOWS_RELEASE_COMMON
+ResetIoc()
+print writer.macros == macros, writer.WINDOWS_RELEASE_COMMON == common
+'''
+
+
+class ResetIocTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = fakebase.TempDir()
+
+    def testModuleState(self):
+        clean = os.path.join(self.directory, 'clean')
+        dirty = os.path.join(self.directory, 'dirty')
+        fakebase.WriteFile(
+            os.path.join(clean, 'etc', 'builder.py'), CLEAN_BUILDER)
+        fakebase.WriteFile(
+            os.path.join(dirty, 'etc', 'builder.py'), DIRTY_BUILDER)
+        output = fakebase.RunScript(
+            MODULE_SCRIPT % dict(clean = clean, dirty = dirty))
+        self.assertEqual(output.split(), ['True', 'True', 'False'])
+
+    def testWriterState(self):
+        build_root = os.path.join(self.directory, 'ioc', 'etc', 'makeIocs')
+        os.makedirs(build_root)
+        fakebase.WriteFile(os.path.join(
+            self.directory, 'ioc', 'configure', 'RELEASE.linux-x86_64'),
+            'IOC_COMMON')
+        output = fakebase.RunScript(
+            WRITER_SCRIPT % dict(build_root = build_root))
+        self.assertEqual(output.split(),
+            ['/other/support', 'IOC_COMMON', 'True', 'True'])
+
+
+if __name__ == '__main__':
+    unittest.main()
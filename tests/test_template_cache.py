@@ -0,0 +1,72 @@
+'''The parsed template cache used for expansion in process.'''
+
+import os
+import unittest
+
+import fakebase
+import iocbuilder
+from iocbuilder import recordset, msi
+
+
+class TemplateCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = fakebase.TempDir()
+        self.outer = os.path.join(self.directory, 'outer.template')
+        self.inner = os.path.join(self.directory, 'inner.template')
+        fakebase.WriteFile(self.outer,
+            'outer $(A)\ninclude "%s"\n' % self.inner)
+        fakebase.WriteFile(self.inner, 'inner $(A)\n')
+        recordset.Reset()
+
+    def Expand(self):
+        parsed = recordset.SubstitutionSet.ParsedTemplate(self.outer)
+        return parsed.Expand(msi.Macros(dict(A = '1')))
+
+    def testFiles(self):
+        parsed = recordset.SubstitutionSet.ParsedTemplate(self.outer)
+        self.assertEqual(parsed.files, [self.outer, self.inner])
+
+    def testTemplateFiles(self):
+        # the includes are only known once the template has been parsed
+        files = recordset.SubstitutionSet.TemplateFiles
+        self.assertEqual(files(self.outer), [self.outer])
+        self.Expand()
+        self.assertEqual(files(self.outer), [self.outer, self.inner])
+        recordset.Reset()
+        self.assertEqual(files(self.outer), [self.outer])
+
+    def testIncludeChanged(self):
+        self.assertEqual(self.Expand(), 'outer 1\ninner 1\n')
+        fakebase.WriteFile(self.inner, 'inner changed $(A)\n')
+        recordset.Reset()
+        self.assertEqual(self.Expand(), 'outer 1\ninner changed 1\n')
+
+    def testMissingIncludeCreated(self):
+        os.remove(self.inner)
+        self.assertEqual(self.Expand(), 'outer 1\n')
+        fakebase.WriteFile(self.inner, 'inner $(A)\n')
+        recordset.Reset()
+        self.assertEqual(self.Expand(), 'outer 1\ninner 1\n')
+
+    def testCheckedOncePerBuild(self):
+        self.Expand()
+        calls = []
+        stat = os.stat
+        def counting_stat(filename):
+            calls.append(filename)
+            return stat(filename)
+        os.stat = counting_stat
+        try:
+            for i in range(5):
+                self.Expand()
+            self.assertEqual(calls, [])
+            recordset.Reset()
+            for i in range(5):
+                self.Expand()
+            self.assertEqual(calls, [self.outer, self.inner])
+        finally:
+            os.stat = stat
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,378 @@
+#!/bin/env dls-python
+'''Warm start build server for xmlbuilder.
+
+Most of the time taken to build an ioc goes on parsing the RELEASE files,
+loading the builder definitions of every module and loading their dbd
+files.  The build server keeps a process, a zygote, for each set of
+modules it has seen with all of those modules loaded.  Each build request
+received is passed to the zygote for its modules.  The zygote forks a copy
+of itself to build the ioc, so each build starts from the loaded modules
+without reloading anything.
+
+Requests are sent over a Unix socket as a single line of JSON giving the
+xmlbuilder command line arguments and working directory, for example
+    {"argv": ["-o", "../../iocs", "BL99I-EA-IOC-01.xml"], "cwd": "..."}
+The output of the build is sent back over the same connection followed by a
+NUL character and the exit status of the build.  xmlbuilder.py --connect
+sends its arguments to a server in this way.
+
+A zygote is replaced when any of the builder definitions, dbd files or
+iocbuilder files it has loaded change.  Builds are run in the environment
+of the server, not of the client.'''
+
+import sys, os
+import stat
+import socket
+import json
+import errno
+import tempfile
+import traceback
+import multiprocessing
+from multiprocessing import reduction
+from optparse import OptionParser
+
+import xmlbuilder
+from xmlconfig import XmlConfig
+
+
+## Default path of the server socket.
+DEFAULT_SOCKET = os.path.join(
+    tempfile.gettempdir(), 'xmlbuilder-%d.sock' % os.getuid())
+
+
+# Reaps any child processes which have finished.
+def _reap_children():
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except OSError, e:
+        if e.errno != errno.ECHILD:
+            raise
+
+# Sends an error message and failure status to a client.
+def _reply_error(connection, message):
+    connection.sendall('%s\n\0%d\n' % (message, 1))
+
+
+# Removes the socket left at socket_path by a server which is no longer
+# running.  Anything else found there is left alone, so that binding to it
+# fails rather than taking over from a running server or removing a file
+# belonging to another user.
+def _remove_stale_socket(socket_path):
+    try:
+        st = os.lstat(socket_path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            probe.connect(socket_path)
+        except socket.error, e:
+            if e.errno == errno.ECONNREFUSED:
+                os.remove(socket_path)
+    finally:
+        probe.close()
+
+
+# Returns the key identifying the zygote able to build xml_file.  As well as
+# the modules used, this includes all the options which affect how
+# iocbuilder is configured.  This is run in the key worker process so that
+# parsing the RELEASE files leaves no state behind in the server.
+def _request_key(options, xml_file):
+    import iocbuilder
+    xml_text, architecture, simarch = \
+        xmlbuilder.read_xml_file(options, xml_file)
+    config = XmlConfig(arch=architecture, simarch=simarch,
+                       filename=xml_file, configure=False)
+    return (config.parseReleaseKey(iocbuilder),
+        bool(options.debug), bool(options.DbOnly), options.doc,
+        bool(options.python_dbd), bool(options.internal_msi),
+        bool(options.lazy_load), bool(options.profile))
+
+
+# The body of the key worker process: returns the key for each request
+# received on connection, or the error computing it, until the connection
+# is closed.
+def _run_key_worker(connection):
+    while True:
+        try:
+            options, xml_file = connection.recv()
+        except EOFError:
+            return
+        try:
+            connection.send((_request_key(options, xml_file), None))
+        except:
+            connection.send((None, traceback.format_exc()))
+
+
+# Runs a single build in a process forked from a zygote with its output sent
+# to the client connection fd.  Returns the exit status of the build.
+def _run_build(fd, request, previous):
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    status = 1
+    config = previous
+    try:
+        os.chdir(request['cwd'])
+        options, args = xmlbuilder.make_parser().parse_args(request['argv'])
+        if options.profile:
+            # The zygote is shared by requests writing different traces.
+            previous.iocbuilder.timings.Enable(
+                os.path.abspath(options.profile))
+        config = xmlbuilder.build_ioc(options, args[0], previous)
+        status = 0
+    except xmlbuilder.CheckFailed:
+        pass
+    except SystemExit, e:
+        if isinstance(e.code, int):
+            status = e.code
+    except:
+        traceback.print_exc()
+    # We leave by os._exit, which doesn't run the exit handlers.  The build
+    # may have configured a fresh iocbuilder, whose timings are reported.
+    config.iocbuilder.timings.Finish()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.write(1, '\0%d\n' % status)
+    return status
+
+
+# The body of a zygote process: loads the modules needed to build xml_file
+# and then forks a build for every request received on connection until the
+# connection is closed or the loaded files change.
+def _run_zygote(connection, options, xml_file):
+    xml_text, architecture, simarch = \
+        xmlbuilder.read_xml_file(options, xml_file)
+    config = XmlConfig(debug=bool(options.debug),
+                       DbOnly=bool(options.DbOnly),
+                       doc=options.doc, arch=architecture,
+                       simarch=simarch, filename=xml_file,
+                       python_dbd=options.python_dbd,
+                       internal_msi=options.internal_msi,
+                       lazy_load=options.lazy_load,
+                       profile=options.profile)
+    file_stamps = config.iocbuilder.support.FileStamps
+    stamps = file_stamps(config.iocbuilder.manifest.ListInputs())
+    while True:
+        _reap_children()
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if file_stamps([stamp[0] for stamp in stamps]) != stamps:
+            # Something we've loaded has changed: give up and let the server
+            # start a fresh zygote.
+            connection.send('stale')
+            return
+        connection.send('ready')
+        fd = reduction.recv_handle(connection)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork() == 0:
+            connection.close()
+            os._exit(_run_build(fd, request, config))
+        os.close(fd)
+
+
+# A zygote process as seen by the server.
+class Zygote:
+    def __init__(self, server, options, xml_file, client):
+        self.connection, connection = multiprocessing.Pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            # Close everything belonging to the server, including the client
+            # connection, which would otherwise be held open until the zygote
+            # exits.
+            server.Close()
+            client.close()
+            self.connection.close()
+            status = 1
+            try:
+                _run_zygote(connection, options, xml_file)
+                status = 0
+            except:
+                traceback.print_exc()
+            os._exit(status)
+        connection.close()
+
+    # Passes a build request and the client connection to the zygote.
+    # Returns False if the zygote is stale or has died.
+    def Build(self, request, client):
+        try:
+            self.connection.send(request)
+            if self.connection.recv() != 'ready':
+                return False
+            reduction.send_handle(
+                self.connection, client.fileno(), self.pid)
+            return True
+        except (EOFError, IOError, OSError):
+            return False
+
+    def Close(self):
+        self.connection.close()
+
+
+# The process computing the keys of requests for the server.  A single
+# process is kept for all requests so that iocbuilder is only imported once.
+class KeyWorker:
+    def __init__(self, server, client):
+        self.connection, connection = multiprocessing.Pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            # As for a zygote, the client connection must not be held open.
+            server.Close()
+            client.close()
+            self.connection.close()
+            status = 1
+            try:
+                _run_key_worker(connection)
+                status = 0
+            except:
+                traceback.print_exc()
+            os._exit(status)
+        connection.close()
+
+    # Returns the key for building xml_file with options.  Raises an
+    # EOFError, IOError or OSError if the worker has died, or a RuntimeError
+    # with the traceback from the worker if the key can't be computed.
+    def Key(self, options, xml_file):
+        self.connection.send((options, xml_file))
+        key, error = self.connection.recv()
+        if error is not None:
+            raise RuntimeError(error)
+        return key
+
+    def Close(self):
+        self.connection.close()
+
+
+## Server accepting build requests on a Unix socket.
+class BuildServer:
+    def __init__(self, socket_path):
+        _remove_stale_socket(socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(socket_path)
+        self.listener.listen(16)
+        # Zygotes indexed by the key returned by __RequestKey.
+        self.zygotes = {}
+        # Started when the first request is received.
+        self.key_worker = None
+
+    ## Handles requests until interrupted.
+    def Serve(self):
+        while True:
+            client, _ = self.listener.accept()
+            _reap_children()
+            try:
+                try:
+                    self.__Handle(client)
+                except Exception:
+                    traceback.print_exc()
+                    _reply_error(client, traceback.format_exc())
+            finally:
+                client.close()
+
+    # Closes the connections held by the server, in the processes it forks.
+    def Close(self):
+        self.listener.close()
+        for zygote in self.zygotes.values():
+            zygote.Close()
+        if self.key_worker is not None:
+            self.key_worker.Close()
+
+    # Computes the key returned by _request_key in the key worker, starting
+    # a fresh worker if it has died.
+    def __RequestKey(self, options, xml_file, client):
+        for attempt in range(2):
+            if self.key_worker is None:
+                self.key_worker = KeyWorker(self, client)
+            try:
+                return self.key_worker.Key(options, xml_file)
+            except (EOFError, IOError, OSError):
+                self.key_worker.Close()
+                self.key_worker = None
+        raise RuntimeError('Unable to start key worker for %s' % xml_file)
+
+    def __Handle(self, client):
+        line = client.makefile().readline()
+        if not line:
+            # Connections closed without a request, such as those probing
+            # for a running server, are ignored.
+            return
+        request = json.loads(line)
+        options, args = xmlbuilder.make_parser().parse_args(request['argv'])
+        if len(args) != 1:
+            _reply_error(client, 'The build server builds one ioc at a time')
+            return
+        xml_file = os.path.join(request['cwd'], args[0])
+        key = self.__RequestKey(options, xml_file, client)
+
+        # If the zygote has gone stale try once more with a fresh one.
+        for attempt in range(2):
+            zygote = self.zygotes.get(key)
+            if zygote is None:
+                zygote = Zygote(self, options, xml_file, client)
+                self.zygotes[key] = zygote
+            if zygote.Build(request, client):
+                return
+            del self.zygotes[key]
+            zygote.Close()
+        _reply_error(client, 'Unable to start builder for %s' % xml_file)
+
+
+## Sends a build request with the given xmlbuilder arguments to the server
+# listening on socket_path, copying the output of the build to stdout.
+# Returns the exit status of the build.
+def request_build(socket_path, argv):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    client.sendall(json.dumps(dict(argv=argv, cwd=os.getcwd())) + '\n')
+    status = None
+    while True:
+        data = client.recv(65536)
+        if not data:
+            break
+        if status is None:
+            data, nul, rest = data.partition('\0')
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            if nul:
+                status = rest
+        else:
+            status += data
+    client.close()
+    if status is None:
+        print >> sys.stderr, '*** Error: build server failed to complete build'
+        return 1
+    return int(status)
+
+
+def main():
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option(
+        '-s', '--socket', dest='socket', default=DEFAULT_SOCKET,
+        help='Path of the socket to listen on, default %default')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('*** Error: Unexpected arguments')
+    BuildServer(options.socket).Serve()
+
+
+if __name__=='__main__':
+    # Pick up containing IOC builder
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    sys.path.append(root)
+    from pkg_resources import require
+    require('dls_environment')
+    require('dls_dependency_tree')
+    require('dls_edm')
+    main()
@@ -1,9 +1,10 @@
 #!/bin/env dls-python
 import sys, os, shutil, glob
+import traceback
 import re
 from subprocess import *
 from optparse import OptionParser
-import xml.dom.minidom
+import xml.dom.pulldom
 from xmlconfig import XmlConfig
 
 
@@ -15,8 +16,9 @@ def patch_arch(arch):
     return arch
 
 
-def main():
-    parser = OptionParser('usage: %prog [options] <xml-file>')
+# Returns the option parser for the xmlbuilder command line.
+def make_parser():
+    parser = OptionParser('usage: %prog [options] <xml-file>...')
     parser.add_option(
         '-d', action='store_true', dest='debug',
         help='Print lots of debug information')
@@ -45,14 +47,149 @@ def main():
     parser.add_option(
         '--build-debug', action='store_true', dest='build_debug',
         help='Enable debug build of IOC')
+    parser.add_option(
+        '--python-dbd', action='store_true', dest='python_dbd',
+        help='Read dbd files in Python instead of using libdbStaticHost')
+    parser.add_option(
+        '--internal-msi', action='store_true', dest='internal_msi',
+        help='Expand templates without running msi')
+    parser.add_option(
+        '--lazy-load', action='store_true', dest='lazy_load',
+        help='Only load the definitions of modules used by the ioc')
+    parser.add_option(
+        '--profile', dest='profile', metavar='TRACE',
+        help='Report the time taken by each phase of the build and write a '
+        'JSON trace to TRACE')
+    parser.add_option(
+        '-i', '--incremental', action='store_true', dest='incremental',
+        help='Update an existing ioc, only rewriting files which have changed')
+    parser.add_option(
+        '-u', '--if-changed', action='store_true', dest='if_changed',
+        help='Don\'t regenerate the ioc if none of its inputs have changed')
+
+    parser.add_option(
+        '--check', action='store_true', dest='check',
+        help='Check every component of the ioc and report all errors found '
+        'without writing the ioc')
+
+    parser.add_option(
+        '-j', '--jobs', dest='jobs', type='int', default=1,
+        help='Number of worker processes to use when building several iocs')
+    parser.add_option(
+        '--connect', dest='connect', metavar='SOCKET',
+        help='Send the build to the build server listening on SOCKET')
+    return parser
+
+
+def main():
+    parser = make_parser()
 
     # parse arguments
     (options, args) = parser.parse_args()
-    if len(args) != 1:
+    if options.connect:
+        # let a build server do all the work
+        import buildserver
+        sys.exit(buildserver.request_build(options.connect, sys.argv[1:]))
+    if len(args) < 1:
         parser.error(
             '*** Error: Incorrect number of arguments - '
-            'you must supply one input file (.xml)')
+            'you must supply at least one input file (.xml)')
+    xml_files = expand_xml_files(args)
+    if options.doc and len(xml_files) != 1:
+        parser.error('*** Error: --doc only supports one input file')
+
+    if len(xml_files) == 1:
+        try:
+            build_ioc(options, xml_files[0])
+        except CheckFailed:
+            sys.exit(1)
+    else:
+        failed = build_batch(options, xml_files)
+        if failed:
+            print >> sys.stderr, '*** Failed to build: %s' % ' '.join(failed)
+            sys.exit(1)
+
+
+# Expands the list of arguments into a list of xml files: directories are
+# replaced by the xml files they contain and glob patterns are expanded.
+def expand_xml_files(args):
+    xml_files = []
+    for arg in args:
+        if os.path.isdir(arg):
+            xml_files.extend(sorted(glob.glob(os.path.join(arg, '*.xml'))))
+        elif glob.has_magic(arg):
+            xml_files.extend(sorted(glob.glob(arg)))
+        else:
+            xml_files.append(arg)
+    return xml_files
+
+
+# Builds each of the given iocs in turn, returning the list of files that
+# failed to build.  The modules loaded for one ioc are reused for the next if
+# it uses exactly the same modules.  If options.jobs is more than one the
+# iocs are shared out between that many worker processes: the files are
+# kept in order so that iocs from the same directory, which are most likely
+# to share modules, are built by the same worker.
+def build_batch(options, xml_files):
+    jobs = min(options.jobs, len(xml_files))
+    if jobs > 1:
+        import multiprocessing
+        size = (len(xml_files) + jobs - 1) // jobs
+        chunks = [(options, xml_files[i:i + size])
+            for i in range(0, len(xml_files), size)]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_build_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        return [xml_file for failed in results for xml_file in failed]
+
+    failed = []
+    xml_config = None
+    for xml_file in xml_files:
+        print '--- Building %s ---' % xml_file
+        try:
+            xml_config = build_ioc(options, xml_file, xml_config)
+        except CheckFailed:
+            failed.append(xml_file)
+        except Exception:
+            traceback.print_exc()
+            failed.append(xml_file)
+            # Don't trust the state left behind by a failed build
+            xml_config = None
+    return failed
+
+def _build_chunk(args):
+    return build_batch(*args)
+
+
+# Raised when checking an ioc finds errors, which have already been reported.
+class CheckFailed(Exception):
+    pass
+
 
+# Returns the text of xml_file together with the architecture and simulation
+# architecture it is to be built for.  Only the start of the document is
+# parsed, up to the root element which gives the architecture.
+def read_xml_file(options, xml_file):
+    xml_text = open(xml_file).read()
+    for event, components in xml.dom.pulldom.parseString(xml_text):
+        if event == xml.dom.pulldom.START_ELEMENT:
+            break
+    if options.simarch is not None:
+        architecture = patch_arch(options.simarch)
+        simarch = architecture
+    else:
+        architecture = patch_arch(str(components.attributes['arch'].value))
+        simarch = None
+    return xml_text, architecture, simarch
+
+
+# Builds the ioc described by xml_file, returning the XmlConfig used or
+# previous if the ioc is already up to date.  If previous is the XmlConfig
+# used to build another ioc its modules will be reused if possible.
+def build_ioc(options, xml_file, previous=None):
     # define parameters
     if options.debug:
         debug = True
@@ -64,24 +201,47 @@ def main():
         DbOnly = False
 
     # read the xml text for the architecture
-    xml_file = args[0]
     if options.debug:
         print '--- Parsing %s ---' % xml_file
-    xml_text = open(xml_file).read()
-    xml_root = xml.dom.minidom.parseString(xml_text)
-    components = [n
-        for n in xml_root.childNodes if n.nodeType == n.ELEMENT_NODE][0]
-    if options.simarch is not None:
-        architecture = patch_arch(options.simarch)
-        simarch = architecture
-    else:
-        architecture = patch_arch(str(components.attributes['arch'].value))
-        simarch = None
+    xml_text, architecture, simarch = read_xml_file(options, xml_file)
+
+    substitute_boot = not options.no_substitute_boot
+    if architecture == "win32-x86":
+        substitute_boot = False
+
+    # check whether the ioc needs to be generated at all before doing any
+    # expensive work
+    if options.if_changed and not (options.doc or DbOnly or options.check):
+        iocname = os.path.basename(xml_file).replace('.xml', '')
+        iocpath = os.path.join(os.path.abspath(options.out), iocname)
+        if options.simarch:
+            iocpath += '_sim'
+        from iocbuilder.manifest import IocUpToDate
+        if IocUpToDate(iocpath,
+                ioc_name=iocname,
+                architecture=architecture,
+                check_release=not options.no_check_release,
+                substitute_boot=substitute_boot,
+                edm_screen=bool(options.edm_screen),
+                build_debug=bool(options.build_debug),
+                python_dbd=bool(options.python_dbd),
+                internal_msi=bool(options.internal_msi)):
+            if debug:
+                print "%s is up to date" % iocpath
+            return previous
 
     # setup the XmlIocBuilder
     xml_config = XmlConfig(debug=debug, DbOnly=DbOnly,
                            doc=options.doc, arch=architecture,
-                           simarch=simarch, filename=xml_file)
+                           simarch=simarch, filename=xml_file,
+                           python_dbd=options.python_dbd,
+                           internal_msi=options.internal_msi,
+                           lazy_load=options.lazy_load,
+                           profile=options.profile,
+                           previous=previous)
+    if options.check:
+        check_ioc(xml_config, xml_file, xml_text)
+        return xml_config
     xml_config.iocbuilder.SetSource(os.path.realpath(xml_file))
     xml_config.iocbuilder.SetAdditionalHeaderText(get_git_status(xml_file))
 
@@ -102,22 +262,33 @@ def main():
             iocpath += '_sim'
 #            store.iocbuilder.SetEpicsPort(6064)
 
-    substitute_boot = not options.no_substitute_boot
-    if xml_config.architecture == "win32-x86":
-        substitute_boot = False
     if debug:
         print "Writing ioc to %s" % iocpath
     xml_config.iocbuilder.WriteNamedIoc(iocpath,
                                         xml_config.iocname,
                                         check_release=not options.no_check_release,
                                         substitute_boot=substitute_boot,
-                                        edm_screen=options.edm_screen,
-                                        build_debug=options.build_debug)
+                                        edm_screen=bool(options.edm_screen),
+                                        build_debug=bool(options.build_debug),
+                                        incremental=options.incremental)
     if debug:
         print "Done"
 
     # Check for README in same directory as source XML
     check_for_readme(xml_file, iocpath, xml_config.iocname, debug)
+    return xml_config
+
+
+# Checks every component of the ioc in xml_text, printing all of the errors
+# found.  Raises CheckFailed if there are any errors.
+def check_ioc(xml_config, xml_file, xml_text):
+    errors = xml_config.iocbuilder.includeXml.checkXml(xml_text)
+    for error in errors:
+        print >> sys.stderr, '%s: %s' % (xml_file, error)
+    if errors:
+        print >> sys.stderr, '*** %d errors in %s' % (len(errors), xml_file)
+        raise CheckFailed()
+    print '%s: no errors found' % xml_file
 
 
 def readme_exists(xml_file, iocname, debug):
@@ -4,8 +4,14 @@ import sys, os
 class XmlConfig(object):
     def __init__(self, debug=False, DbOnly=False,
                  doc=False, arch='vxWorks-ppc604_long',
-                 simarch=False, filename=""):
+                 simarch=False, filename="", python_dbd=False,
+                 internal_msi=False, lazy_load=False, profile=None,
+                 previous=None, configure=True):
         self.architecture = arch
+        self.python_dbd = python_dbd
+        self.internal_msi = internal_msi
+        self.lazy_load = lazy_load
+        self.profile = profile
         self.simarch = simarch
         self.epics_base = None
         # store the debug state
@@ -20,7 +26,47 @@ class XmlConfig(object):
         if self.debug:
             print "IOC name: %s" % self.iocname
             print "Build root: %s" % self.build_root
-        self.configureIocbuilder()
+        self.ioc_writer = None
+        if not configure:
+            pass
+        elif previous is None or not self.reuseIocbuilder(previous):
+            self.configureIocbuilder()
+
+    # Returns a key identifying the configuration of iocbuilder: IOCs with
+    # the same key can be built without reloading any modules.
+    def releaseKey(self, modules):
+        return (self.architecture, self.simarch, self.epics_base,
+            tuple(sorted((name, version, os.path.realpath(home), use_name)
+                for name, version, home, use_name in modules)))
+
+    # Parses the RELEASE files for this IOC using the given iocbuilder
+    # package and returns its release key without loading any modules.
+    def parseReleaseKey(self, iocbuilder):
+        from dls_dependency_tree import dependency_tree
+        tree = iocbuilder.ParseRelease(self, dependency_tree)
+        return self.releaseKey(iocbuilder.ReleaseModules(tree))
+
+    # Reuses the iocbuilder configured by previous, an XmlConfig for another
+    # IOC, if this IOC uses exactly the same modules.  The state of the
+    # previous IOC is discarded.  Returns False if iocbuilder needs to be
+    # configured from scratch, either because the modules are different or
+    # because the previous IOC left state in the modules which can't be reset.
+    def reuseIocbuilder(self, previous):
+        iocbuilder = previous.iocbuilder
+        if not iocbuilder.ResetIoc():
+            if self.debug:
+                print '# Module state not reset, reloading iocbuilder'
+            return False
+        if self.profile:
+            iocbuilder.timings.Enable(self.profile)
+        self.ioc_writer = previous.ioc_writer
+        self.release_key = self.parseReleaseKey(iocbuilder)
+        if self.release_key != previous.release_key:
+            return False
+        if self.debug:
+            print '# Reusing iocbuilder configuration'
+        self.iocbuilder = iocbuilder
+        return True
 
     def configureIocbuilder(self):
         # Now make sure there is no iocbuilder hanging around
@@ -41,9 +87,15 @@ class XmlConfig(object):
         # do the moduleversion calls
         from dls_dependency_tree import dependency_tree
         vs = self.iocbuilder.ParseAndConfigure(self, dependency_tree)
-        # create AutoSubstitutions and moduleObjects
+        self.release_key = self.releaseKey([
+            (v.Name(), v.version, v.home, v.use_name) for v in vs])
+        # create AutoSubstitutions and moduleObjects, deferred until the
+        # module is loaded if lazy loading
         for v in vs:
-            if self.debug:
-                print 'Making auto objects from %s' % v.LibPath()
-            iocbuilder.AutoSubstitution.fromModuleVersion(v)
-            iocbuilder.Xml.fromModuleVersion(v)
+            v.OnLoad(self.makeAutoObjects)
+
+    def makeAutoObjects(self, v):
+        if self.debug:
+            print 'Making auto objects from %s' % v.LibPath()
+        self.iocbuilder.AutoSubstitution.fromModuleVersion(v)
+        self.iocbuilder.Xml.fromModuleVersion(v)
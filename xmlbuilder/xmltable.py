@@ -5,6 +5,9 @@ import re, time, types
 from commands import ChangeValueCommand, RowCommand
 
 class Table(QAbstractTableModel):
+    # The attributes set by __makeColumns
+    _ColumnAttributes = ['_header', '_tooltips', '_required', '_defaults',
+        '_optional', '_cItems', '_cValues', '_idents', '_types']
 
     def __init__(self, ob, parent):
         QAbstractTableModel.__init__(self)
@@ -12,6 +15,14 @@ class Table(QAbstractTableModel):
         self.ob = ob
         self.stack = QUndoStack()
         self._parent = parent
+        # rows is a list of rows. each row is a list of QVariants
+        self.rows = []
+        # maps (filt, without, upto) -> (timestamp, stringList)
+        self._cachedNameList = {}
+        # this is the top left item visible in the TableView widget
+        self.topLeftIndex = None
+
+    def __makeColumns(self):
         # Make sure we have Name information first
         # _header contains the row headers
         self._header = [
@@ -37,10 +48,8 @@ class Table(QAbstractTableModel):
         self._idents = []
         # _types is a list of types for validation
         self._types = [bool, str, str]
-        # rows is a list of rows. each row is a list of QVariants
-        self.rows = []
         # work out the header and descriptions from the ArgInfo object
-        a = ob.ArgInfo
+        a = self.ob.ArgInfo
         # for required names just process the ArgType object
         for name in a.required_names:
             self.__processArgType(name, a.descriptions[name])
@@ -50,10 +59,14 @@ class Table(QAbstractTableModel):
         # for optional names flag it as optional
         for name in a.optional_names:
             self.__processArgType(name, a.descriptions[name], optional = True)
-        # maps (filt, without, upto) -> (timestamp, stringList)
-        self._cachedNameList = {}
-        # this is the top left item visible in the TableView widget
-        self.topLeftIndex = None
+
+    def __getattr__(self, name):
+        # The columns are only made when one of them is looked up, so that an
+        # AutoSubstitution does not scan its template until its table is used.
+        if name in self._ColumnAttributes:
+            self.__makeColumns()
+            return getattr(self, name)
+        raise AttributeError(name)
 
     def __processArgType(self, name, ob, **args):
         # this is the column index